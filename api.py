@@ -0,0 +1,304 @@
+import asyncio
+import json
+
+from aiohttp import WSMsgType, web
+from yarl import URL
+
+import config
+from batch import enqueue_batch, resolve, resolve_queries, split_queries
+from core import core
+from ingest import enqueue_local_track, submit_download
+from player import claim_auto_play_chance, get_position, release_auto_play_chance, set_volume, skip
+from player import toggle_play_pause
+from song_queue import is_ready, queue_snapshot
+from tracing import traced_request
+
+
+# Public fields of a queue entry; paths, frame indexes and the like stay in the process
+SONG_FIELDS = ('id', 'title', 'video_id', 'duration', 'status')
+PRIVATE_STATE = ('current_song',)  # The playing file's path
+
+
+def public_song(song):
+    """The JSON view of a queue entry"""
+    if song is None:
+        return None
+    view = {field: song[field] for field in SONG_FIELDS if field in song}
+    view['status'] = song.get('status', 'ready')
+    view['requester'] = str(song.get('requester', ''))
+    return view
+
+
+def public_state():
+    state = config.state.snapshot()
+    for name in PRIVATE_STATE:
+        state.pop(name, None)
+    state['currently_playing'] = public_song(state['currently_playing'])
+    return state
+
+
+def queue_message(snapshot):
+    """The queue as pushed to WebSocket clients: its size and the next few entries"""
+    return {
+        'type': 'queue',
+        'version': snapshot.version,
+        'length': len(snapshot.songs),
+        'pending': sum(1 for song in snapshot.songs if not is_ready(song)),
+        'head': [public_song(song) for song in snapshot.songs[:config.API_QUEUE_HEAD]],
+    }
+
+
+def snapshot_message():
+    """Everything a client needs to start over: the whole state and the queue"""
+    return json.dumps({
+        'type': 'snapshot',
+        'version': config.state.version,
+        'state': public_state(),
+        'position': get_position(),
+        'queue': queue_message(queue_snapshot()),
+    })
+
+
+class ApiClient:
+    """One WebSocket subscriber and the messages waiting to be sent to it.
+
+    The queue is bounded: a client too slow to keep up has its backlog
+    dropped and is sent a fresh snapshot instead, so a stuck dashboard costs
+    a fixed amount of memory and never holds up the others.
+    """
+
+    def __init__(self, ws, queue_size):
+        self.ws = ws
+        self.messages = asyncio.Queue(queue_size)
+
+    def offer(self, text):
+        try:
+            self.messages.put_nowait(text)
+        except asyncio.QueueFull:
+            while not self.messages.empty():
+                self.messages.get_nowait()
+            self.messages.put_nowait(None)  # Stands for a snapshot taken when it is sent
+
+    async def send_loop(self):
+        while True:
+            text = await self.messages.get()
+            await self.ws.send_str(snapshot_message() if text is None else text)
+
+
+class Broadcaster:
+    """Pushes state diffs and queue changes to every WebSocket client.
+
+    Runs on the core loop. Each message is serialized once and the same
+    string is queued for every client, so a broadcast costs one json.dumps
+    plus a queue put per client. Diffs carry the new values of the changed
+    fields, never deltas, so applying one twice or after a snapshot is safe.
+    """
+
+    def __init__(self):
+        self.clients = set()
+        self._queue_version = None
+
+    def publish(self, message):
+        if not self.clients:
+            return
+        text = json.dumps(message)
+        for client in self.clients:
+            client.offer(text)
+
+    def publish_change(self, change):
+        """Broadcast a StateChange from the state store"""
+        changes = {name: new for name, (_, new) in change.changes.items() if name not in PRIVATE_STATE}
+        if not changes:
+            return
+        if 'currently_playing' in changes:
+            changes['currently_playing'] = public_song(changes['currently_playing'])
+        self.publish({'type': 'state', 'version': change.version, 'changes': changes, 'position': get_position()})
+
+    async def watch_queue(self):
+        """Broadcast each new queue version; the queue has no change events, so poll its version"""
+        while True:
+            snapshot = queue_snapshot()
+            if snapshot.version != self._queue_version and self.clients:
+                self.publish(queue_message(snapshot))
+            self._queue_version = snapshot.version
+            await asyncio.sleep(config.API_QUEUE_POLL)
+
+
+broadcaster = Broadcaster()
+routes = web.RouteTableDef()
+
+
+@web.middleware
+async def guard(request, handler):
+    """Only this machine may use the API: no other origins, and the API_TOKEN if one is set"""
+    origin = request.headers.get('Origin')
+    if origin and URL(origin).host not in ('127.0.0.1', 'localhost', '::1'):
+        raise web.HTTPForbidden(text="Cross-origin requests are not allowed")
+    if config.API_TOKEN and request.headers.get('Authorization') != f"Bearer {config.API_TOKEN}" \
+            and request.query.get('token') != config.API_TOKEN:
+        raise web.HTTPUnauthorized(text="Missing or wrong API token")
+    return await handler(request)
+
+
+async def _json_body(request):
+    # Requiring JSON also keeps plain HTML forms on other sites from posting here
+    if request.content_type != 'application/json':
+        raise web.HTTPUnsupportedMediaType(text="Send a JSON body")
+    try:
+        body = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text="Invalid JSON") from None
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text="The JSON body must be an object")
+    return body
+
+
+@routes.get('/api/state')
+async def get_state(request):
+    return web.json_response(dict(public_state(), position=get_position()))
+
+
+@routes.get('/api/queue')
+async def get_queue(request):
+    """The queue, a page at a time: ?start=0&count=50"""
+    try:
+        start = max(0, int(request.query.get('start', 0)))
+        count = max(0, min(int(request.query.get('count', 50)), config.API_QUEUE_PAGE_MAX))
+    except ValueError:
+        raise web.HTTPBadRequest(text="start and count must be integers") from None
+    snapshot = queue_snapshot()
+    return web.json_response({
+        'version': snapshot.version,
+        'length': len(snapshot.songs),
+        'start': start,
+        'songs': [public_song(song) for song in snapshot.songs[start:start + count]],
+    })
+
+
+@routes.post('/api/play')
+@traced_request('api.play')
+async def play(request):
+    """Queue a song, or several separated by ; or new lines: {"query": "..."}"""
+    query = str((await _json_body(request)).get('query', '')).strip()
+    if not query:
+        raise web.HTTPBadRequest(text="Missing query")
+    config.state.update(discord_last_command=f"API play {query}")
+
+    queries = split_queries(query)
+    if len(queries) > 1:
+        items = await resolve_queries(queries)
+        await core.run_blocking(enqueue_batch, items, config.API_REQUESTER, on_complete=_report_batch_failures)
+        return web.json_response({
+            'queued': [item.track['title'] for item in items if item.error is None],
+            'errors': [{'query': item.query, 'error': item.error} for item in items if item.error is not None],
+        })
+
+    video_info = await core.run_blocking(resolve, query)
+    if video_info is None:
+        raise web.HTTPNotFound(text="No results found for your query")
+
+    this_song_gets_auto_play_chance = claim_auto_play_chance()
+    if video_info.get('local'):
+        queued = await core.run_blocking(enqueue_local_track, video_info, this_song_gets_auto_play_chance,
+                                         requester=config.API_REQUESTER)  # Indexes the file
+    else:
+        queued = submit_download(video_info, this_song_gets_auto_play_chance, requester=config.API_REQUESTER,
+                                 on_failed=lambda reason: _report_failure(video_info['title'], reason))
+    if queued is None:
+        release_auto_play_chance(this_song_gets_auto_play_chance)
+        raise web.HTTPTooManyRequests(text=f"Queue limit of {config.MAX_QUEUED_PER_USER} songs reached")
+    return web.json_response({'queued': [video_info['title']], 'errors': [], 'autoplay': this_song_gets_auto_play_chance})
+
+
+def _report_failure(title, reason):
+    """Tell WebSocket clients a download failed for good; called from an ingest worker"""
+    print(f"API: Download failed for '{title}': {reason}")
+    core.call(broadcaster.publish, {'type': 'download_failed', 'title': title, 'reason': reason})
+
+
+def _report_batch_failures(failures):
+    for query, reason in failures:
+        _report_failure(query, reason)
+
+
+@routes.post('/api/pause')
+async def pause(request):
+    if not config.state.is_playing:
+        raise web.HTTPConflict(text="Nothing is playing")
+    toggle_play_pause()
+    config.state.update(discord_last_command="API pause")
+    return web.json_response({'is_playing': False})
+
+
+@routes.post('/api/resume')
+async def resume(request):
+    if config.state.is_playing or not config.state.current_song:
+        raise web.HTTPConflict(text="No paused song found")
+    toggle_play_pause()
+    config.state.update(discord_last_command="API resume")
+    return web.json_response({'is_playing': config.state.is_playing})
+
+
+@routes.post('/api/skip')
+async def skip_song(request):
+    if not skip():
+        raise web.HTTPConflict(text="Nothing is playing")
+    config.state.update(discord_last_command="API skip")
+    return web.json_response({'skipped': True})
+
+
+@routes.post('/api/volume')
+async def volume(request):
+    """Set the volume, 0-100: {"level": 40}"""
+    try:
+        level = int((await _json_body(request))['level'])
+    except (KeyError, TypeError, ValueError):
+        raise web.HTTPBadRequest(text="level must be an integer from 0 to 100") from None
+    level = max(0, min(100, level))
+    set_volume(level / 100.0)
+    config.state.update(discord_last_command=f"API volume {level}")
+    return web.json_response({'volume': level})
+
+
+@routes.get('/api/ws')
+async def websocket(request):
+    """Push channel: a snapshot on connect, then state diffs, queue changes and download failures"""
+    ws = web.WebSocketResponse(heartbeat=30)
+    await ws.prepare(request)
+    client = ApiClient(ws, config.API_CLIENT_QUEUE)
+    client.offer(None)
+    broadcaster.clients.add(client)
+    sender = asyncio.ensure_future(client.send_loop())
+    try:
+        async for message in ws:
+            if message.type == WSMsgType.ERROR:
+                break  # Clients only listen, anything they send is ignored
+    finally:
+        broadcaster.clients.discard(client)
+        sender.cancel()
+    return ws
+
+
+async def run_api():
+    """Serve the control API on the core loop"""
+    app = web.Application(middlewares=[guard])
+    app.add_routes(routes)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, config.API_HOST, config.API_PORT).start()
+    except OSError as e:
+        print(f"Control API could not listen on {config.API_HOST}:{config.API_PORT}: {e}")
+        await runner.cleanup()
+        return
+    core.at_stop(runner.cleanup)
+    print(f"Control API listening on http://{config.API_HOST}:{config.API_PORT}/api")
+    # State changes arrive on the state store's dispatcher thread
+    config.state.subscribe(lambda change: core.call(broadcaster.publish_change, change))
+    await broadcaster.watch_queue()
+
+
+def start_api():
+    """Start the local control API on the core event loop"""
+    if config.API_ENABLED:
+        core.submit(run_api())
@@ -1,5 +1,12 @@
+import asyncio
+import os
+import subprocess
+import sys
+
 import sounddevice as sd
 
+import config
+
 
 def get_connected_audio_devices():
     """Get the name of the default audio output device using sounddevice."""
@@ -28,3 +35,48 @@ def sanitize_filename(title):
     for char in invalid_chars:
         title = title.replace(char, '_')
     return title
+
+
+def format_time(seconds):
+    """Format a position in seconds as m:ss (or h:mm:ss for long tracks)"""
+    seconds = int(max(0, seconds))
+    hours, remainder = divmod(seconds, 3600)
+    minutes, secs = divmod(remainder, 60)
+    if hours:
+        return f"{hours}:{minutes:02d}:{secs:02d}"
+    return f"{minutes}:{secs:02d}"
+
+
+def parse_timestamp(text):
+    """Parse "90", "1:30" or "1:02:03" into seconds. Raises ValueError on bad input."""
+    seconds = 0.0
+    for part in text.strip().split(':'):
+        seconds = seconds * 60 + float(part)
+    if seconds < 0:
+        raise ValueError(f"Negative timestamp: {text}")
+    return seconds
+
+
+def start_low_priority(command, **kwargs):
+    """Start a helper process (ffmpeg) below normal priority so it never competes with playback"""
+    process = subprocess.Popen(command, creationflags=_LOW_PRIORITY_FLAGS, **kwargs)
+    _lower_priority(process, command)
+    return process
+
+
+async def start_low_priority_async(command, **kwargs):
+    """start_low_priority as an asyncio subprocess, for the core event loop"""
+    process = await asyncio.create_subprocess_exec(*command, creationflags=_LOW_PRIORITY_FLAGS, **kwargs)
+    _lower_priority(process, command)
+    return process
+
+
+_LOW_PRIORITY_FLAGS = subprocess.BELOW_NORMAL_PRIORITY_CLASS if sys.platform == 'win32' else 0
+
+
+def _lower_priority(process, command):
+    if hasattr(os, 'setpriority'):
+        try:
+            os.setpriority(os.PRIO_PROCESS, process.pid, config.TRANSCODE_NICE)
+        except OSError as e:
+            print(f"Could not lower priority of {command[0]}: {e}")
@@ -0,0 +1,102 @@
+import os
+import threading
+
+import config
+from frame_index import index_path_for
+from fingerprint import fingerprint_path_for
+from silence import trim_path_for
+
+
+def cache_path_for(video_id):
+    """Return where the transcoded mp3 of a video is kept in the cache"""
+    return os.path.join(config.CACHE_DIR, f"{video_id}.mp3")
+
+
+def cached_song_path(video_id):
+    """Return the cached mp3 of a video, or None. A hit counts as a use for LRU eviction."""
+    if not video_id:
+        return None
+    path = cache_path_for(video_id)
+    if not os.path.exists(path):
+        return None
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return path
+
+
+def cache_size():
+    """Return the bytes used by the cache directory"""
+    if not os.path.isdir(config.CACHE_DIR):
+        return 0
+    total = 0
+    for entry in os.scandir(config.CACHE_DIR):
+        if entry.is_file():
+            total += entry.stat().st_size
+    return total
+
+
+def evict_to(max_bytes, keep=()):
+    """Delete least recently used cached songs, other than those in `keep`, until the cache fits in max_bytes.
+
+    Returns the bytes the cache uses afterwards.
+    """
+    if not os.path.isdir(config.CACHE_DIR):
+        return 0
+    keep = {os.path.abspath(path) for path in keep}
+    songs = []
+    total = 0
+    for entry in os.scandir(config.CACHE_DIR):
+        if not entry.is_file():
+            continue
+        stat = entry.stat()
+        total += stat.st_size
+        if entry.name.endswith('.mp3') and os.path.abspath(entry.path) not in keep:
+            songs.append((stat.st_mtime, entry.path))
+
+    for _, path in sorted(songs):
+        if total <= max_bytes:
+            break
+        for victim in (path, index_path_for(path), trim_path_for(path), fingerprint_path_for(path)):
+            try:
+                total -= os.path.getsize(victim)
+                os.remove(victim)
+            except OSError:
+                pass
+        print(f"Evicted from audio cache: {path}")
+    return total
+
+
+class CacheStats:
+    """How much request-to-ready latency prefetched cache hits saved"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.miss_latency_total = 0.0  # Seconds from request to playable for downloaded songs
+        self.prefetched = 0
+
+    def record_hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def record_miss(self, latency):
+        with self._lock:
+            self.misses += 1
+            self.miss_latency_total += latency
+
+    def record_prefetch(self):
+        with self._lock:
+            self.prefetched += 1
+
+    def average_miss_latency(self):
+        return self.miss_latency_total / self.misses if self.misses else 0.0
+
+    def saved_seconds(self):
+        """Estimated latency saved: every hit skipped an average download + transcode"""
+        return self.hits * self.average_miss_latency()
+
+
+cache_stats = CacheStats()
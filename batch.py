@@ -0,0 +1,127 @@
+import asyncio
+import re
+import threading
+from functools import partial
+
+import config
+from core import core
+from ingest import local_song_info, pipeline, placeholder_for, submit_download
+from library import search_library
+from player import claim_auto_play_chance, enqueue_songs
+from song_queue import is_ready
+from tracing import span
+from youtube import search_youtube
+
+
+QUERY_SEPARATORS = re.compile(r'[;\n]+')
+
+
+def split_queries(text):
+    """Split pasted text into queries on semicolons and new lines"""
+    return [query.strip() for query in QUERY_SEPARATORS.split(text) if query.strip()]
+
+
+class BatchItem:
+    """One query of a batch and what became of it"""
+
+    def __init__(self, query):
+        self.query = query
+        self.track = None  # Search result to queue
+        self.error = None  # Why nothing was queued for this query
+
+
+def resolve(query):
+    """Return the best match for a query: a local track, else the top YouTube result, else None"""
+    with span('search', query=query):
+        results = search_library(query, limit=1) or search_youtube(query)
+    return results[0] if results else None
+
+
+async def resolve_queries(queries):
+    """Search every query, at most BATCH_SEARCH_CONCURRENCY at once, and return BatchItems in input order"""
+    items = [BatchItem(query) for query in queries[:config.BATCH_MAX_QUERIES]]
+    searches = asyncio.Semaphore(config.BATCH_SEARCH_CONCURRENCY)
+
+    async def search(item):
+        async with searches:
+            try:
+                item.track = await core.run_blocking(resolve, item.query)
+                if item.track is None:
+                    item.error = "No results"
+            except Exception as e:
+                item.error = f"Search failed: {e}"
+
+    await asyncio.gather(*(search(item) for item in items))
+    for query in queries[config.BATCH_MAX_QUERIES:]:
+        item = BatchItem(query)
+        item.error = f"More than {config.BATCH_MAX_QUERIES} songs in one batch"
+        items.append(item)
+    return items
+
+
+class BatchTracker:
+    """Collects the outcome of a batch's downloads and reports once all of them are settled"""
+
+    def __init__(self, count, on_complete=None):
+        self._remaining = count
+        self._failures = []
+        self._on_complete = on_complete
+        self._lock = threading.Lock()
+        if count == 0:
+            self._finish()
+
+    def settled(self, *args):
+        with self._lock:
+            self._remaining -= 1
+            finished = self._remaining == 0
+        if finished:
+            self._finish()
+
+    def failed(self, slot, reason):
+        with self._lock:
+            self._failures.append((slot, reason))
+        self.settled()
+
+    def _finish(self):
+        if self._on_complete:
+            self._on_complete(sorted(self._failures))
+
+
+def enqueue_batch(items, requester, on_complete=None):
+    """Queue the resolved tracks of a batch in order.
+
+    Every track gets its queue slot at once, downloads as pending
+    placeholders that are filled in place, so the batch keeps its order
+    however the downloads finish. Items that cannot be queued get their
+    `error` set. `on_complete` is called with [(query, reason)] for
+    downloads that failed later, once every download is ready or has failed.
+    """
+    room = config.MAX_QUEUED_PER_USER - pipeline.waiting_count(requester)
+    entries = []
+    for item in items:
+        if item.track is None:
+            continue
+        if len(entries) >= room:
+            item.error = f"Queue limit of {config.MAX_QUEUED_PER_USER} songs reached"
+        elif item.track.get('local'):
+            entries.append((item, local_song_info(item.track, requester)))
+        else:
+            entries.append((item, placeholder_for(item.track, requester)))
+
+    # One lock hold for the whole batch, so nothing lands between its songs
+    enqueue_songs([entry for _, entry in entries], claim_auto_play_chance())
+
+    downloads = [(item, entry) for item, entry in entries if not is_ready(entry)]
+
+    def complete(failures):
+        if on_complete:
+            on_complete([(downloads[slot][0].query, reason) for slot, reason in failures])
+
+    tracker = BatchTracker(len(downloads), complete)
+    for slot, (item, entry) in enumerate(downloads):
+        submit_download(item.track, False, requester,
+                        on_failed=partial(tracker.failed, slot),
+                        on_ready=tracker.settled,
+                        on_cancelled=tracker.settled,
+                        entry_id=entry['id'])
+    return items
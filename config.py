@@ -1,7 +1,9 @@
 import os
 import pygame
 import threading
+from collections import deque
 from dotenv import load_dotenv
+from state import StateStore
 
 # Load environment variables
 load_dotenv()
@@ -26,47 +28,198 @@ AUDIO_CHECK_INTERVAL = 5000  # Check every 5 seconds (in milliseconds)
 # Custom pygame events
 MUSIC_END = pygame.USEREVENT + 1
 NEXT_SONG_EVENT = pygame.USEREVENT + 2
+TRACK_END_EVENT = pygame.USEREVENT + 3  # The playing song reached its trimmed end
 
-# Global state variables
-volume_level = 0.7  # 70% volume
-is_playing = False
-current_song = None
-current_pos = 0.0  # Track the current position in seconds
-paused_time = 0   # Store when we paused
-discord_status = "Discord bot: Disconnected"
-discord_last_command = ""
-
-# Audio device monitoring
-connected_audio_device = "Audio: No devices found"
-last_audio_check = 0
+# Shared player state. Read fields as attributes (state.is_playing), write them
+# with state.update(...), and use state.subscribe(...) to react to changes.
+OptionalStr = (str, type(None))
+OptionalDict = (dict, type(None))
+state = StateStore({
+    'volume_level': (float, 0.7),  # 70% volume
+    'is_playing': (bool, False),
+    'current_song': (OptionalStr, None),
+    'currently_playing': (OptionalDict, None),  # Track currently playing song info
+    'discord_status': (str, "Discord bot: Disconnected"),
+    'discord_last_command': (str, ""),
+    'connected_audio_device': (str, "Audio: No devices found"),  # Audio device monitoring
+    'bot_ready': (bool, False),  # Discord bot state
+})
 
 # Search and UI state
 search_text = ""
 search_active = False
 search_results = []
 result_rects = []
+suggestions = []  # (title, item) pairs from the trigram index
+suggestion_rects = []
 
 # Music queue and playback
 downloaded_songs = []
-currently_playing = None  # Track currently playing song info
 queued_songs = []  # List to maintain order of songs
+queue_snapshot = None  # Latest immutable QueueSnapshot, published by song_queue
+recently_played = deque(maxlen=10)  # Songs played before the current one, newest last, for !back
 
 # Auto-play synchronization
 auto_play_lock = threading.Lock()
 is_auto_play_pending = False # True if a song is currently tasked with initiating auto-play
 queue_lock = threading.Lock() # Lock for thread-safe queue operations
 
-# Discord bot state
-bot_ready = False
-
 # UI element positions and sizes
 SEARCH_BOX = pygame.Rect(50, 50, 500, 32)
 PLAY_BUTTON = pygame.Rect(50, 500, 80, 32)
 SKIP_BUTTON = pygame.Rect(140, 500, 80, 32)
 VOLUME_SLIDER = pygame.Rect(300, 500, 200, 10)
+PROGRESS_BAR = pygame.Rect(50, 425, 500, 8)
 
 # Downloads directory
 DOWNLOADS_DIR = 'downloads'
+COOKIE_FILE = 'cookies.txt'  # Netscape format cookies for yt-dlp, reloaded when it changes
+
+# Local music library, searched before YouTube. Set MUSIC_LIBRARY in .env to
+# one or more folders separated by the OS path separator (':' or ';').
+LIBRARY_DIRS = [folder for folder in os.getenv('MUSIC_LIBRARY', '').split(os.pathsep) if folder]
+LIBRARY_DB = 'library.db'
+LIBRARY_EXTENSIONS = ('.mp3', '.flac', '.ogg', '.opus', '.m4a', '.wav')
+LIBRARY_RESCAN_INTERVAL = 300  # Seconds between incremental rescans
+
+# As-you-type suggestions from searched, downloaded and played titles
+SUGGEST_MAX_ENTRIES = 20000  # Titles kept in the trigram index, oldest are evicted
+SUGGEST_BUDGET_MS = 4  # Time a lookup may take, well inside a 60 fps frame
+SUGGEST_MIN_SIMILARITY = 0.2
+SUGGEST_LIMIT = 5
+
+# Live "now playing" Discord messages
+NOW_PLAYING_EDIT_INTERVAL = 5.0  # Minimum seconds between edits of one message
+NOW_PLAYING_PROGRESS_INTERVAL = 15.0  # How often the progress bar is refreshed while playing
+
+# Ingest pipeline (network fetch stage -> ffmpeg transcode stage)
+CPU_COUNT = os.cpu_count() or 1
+FETCH_WORKERS = max(2, CPU_COUNT)  # Network bound, so at least two even on a single core
+TRANSCODE_WORKERS = max(1, CPU_COUNT - 2)  # Leave cores free for playback, UI and the bot
+TRANSCODE_BACKLOG = TRANSCODE_WORKERS  # Fetched files allowed to wait for a transcoder
+TRANSCODE_NICE = 10  # Niceness given to ffmpeg processes
+TRANSCODE_BITRATE = '192k'
+YTDL_SEARCH_SESSIONS = 4  # Pooled yt-dlp sessions for searches, built on first use
+YTDL_DOWNLOAD_SESSIONS = FETCH_WORKERS + 1  # One per fetch worker plus the prefetcher
+FETCH_RETRIES = 4  # Extra attempts after a transient download error
+FETCH_BACKOFF_BASE = 2.0  # Seconds, doubled on every retry
+FETCH_BACKOFF_MAX = 60.0  # Longest wait between two attempts
+
+# Play history and idle-time prefetch into a persistent audio cache
+CACHE_DIR = 'cache'  # Not cleared on startup, unlike DOWNLOADS_DIR
+HISTORY_DB = 'history.db'
+HISTORY_HALF_LIFE_DAYS = 14  # A play counts half as much after this many days
+PREFETCH_ENABLED = True
+PREFETCH_INTERVAL = 30  # Seconds between idle checks
+PREFETCH_CANDIDATES = 50  # Top history entries considered for prefetch
+PREFETCH_MAX_BYTES = 2 * 1024 ** 3  # Disk budget of the cache
+PREFETCH_SONG_BYTES = 16 * 1024 ** 2  # Room made in a full cache before a prefetch (a long song at 192 kbps)
+PREFETCH_RATE_LIMIT = 512 * 1024  # Bytes per second a prefetch may download
+PREFETCH_MAX_LOAD = 0.5  # Only prefetch while the load average per core is below this
+
+# Hot set of decoded PCM for instant replay, back and seeks of recent tracks
+PCM_CACHE_ENABLED = True
+PCM_CACHE_DIR = 'pcm_cache'  # Cleared on startup
+PCM_CACHE_TRACKS = 4  # The current track plus the last few
+PCM_CACHE_MAX_BYTES = 512 * 1024 ** 2  # About 50 minutes of 44.1 kHz stereo
+PCM_SAMPLE_RATE = 44100
+
+# Playback engine: 'pygame' (mixer.music) or 'sounddevice' (software mixing, needs numpy)
+AUDIO_ENGINE = os.getenv('AUDIO_ENGINE', 'pygame')
+ENGINE_SAMPLE_RATE = 44100
+ENGINE_BLOCKSIZE = 1024  # Frames per output callback
+ENGINE_BUFFER_SECONDS = 5.0  # Decoded audio buffered per source, must exceed the crossfade
+ENGINE_CROSSFADE_SECONDS = 3.0  # Overlap of a finishing song and the next one
+ENGINE_RAMP_SECONDS = 0.03  # Fade used for volume changes, pause, stop and seeks
+ENGINE_MAX_VOICES = 3  # Sources mixed at once, bounds the callback's work
+ENGINE_CALLBACK_BUDGET = 0.5  # Share of a block's duration the callback may take
+EQ_ENABLED = True
+EQ_BASS_HZ = 200
+EQ_TREBLE_HZ = 4000
+
+# Silence trimming (silence.py): ingest measures the silent ends of each
+# download and playback skips them, so songs follow each other without dead air
+TRIM_ENABLED = True  # Needs numpy
+ANALYSIS_SAMPLE_RATE = 8000  # Mono rate downloads are decoded at for trimming and fingerprinting
+TRIM_WINDOW = 0.05  # Seconds per level measurement
+TRIM_THRESHOLD_DB = -48  # RMS level below which a window counts as silent, in dBFS
+TRIM_MIN_SILENCE = 0.5  # Shorter silence at an end is left alone
+TRIM_PAD = 0.1  # Seconds kept before the first and after the last audible window
+TRIM_MAX_SECONDS = 30  # Most cut from either end, so a quiet intro or outro is never lost
+
+# Duplicate detection (fingerprint.py): a download that is another upload of a
+# song already on disk plays that file instead of being transcoded again
+FINGERPRINT_ENABLED = True  # Needs numpy
+FINGERPRINT_SECONDS = 45  # Audio after the leading silence that is fingerprinted
+FINGERPRINT_MIN_MATCHES = 40  # Hashes that must line up at one offset for a match
+FINGERPRINT_MIN_RATIO = 0.1  # ...and at least this share of the new song's hashes
+FINGERPRINT_LENGTH_TOLERANCE = 10.0  # Seconds the audible lengths may differ, telling edits apart
+WARN_DUPLICATES = True  # Tell Discord users when a song they add is already queued
+
+# Download format policy: smallest audio-only stream meeting the target bitrate
+FORMAT_TIERS_KBPS = (128, 96, 64, 48)  # Target bitrates, first is used when nothing is degraded
+CODEC_PREFERENCE = ('opus', 'mp4a', 'vorbis')  # Tie-breaker between equally sized streams
+FORMAT_DEEP_QUEUE = 6  # Waiting downloads that drop one tier (twice this drops two)
+FORMAT_SLOW_NETWORK_BPS = 256 * 1024  # Measured download speed below this drops one tier
+
+# Per-user fairness for downloads and queue placement
+LOCAL_REQUESTER = 'local'  # Requester id used for songs added from the pygame UI
+MAX_INFLIGHT_PER_USER = 2  # Downloads of one user being fetched/transcoded at once
+MAX_QUEUED_PER_USER = 25  # Songs one user may have waiting (downloading or queued)
+
+# A request holds its queue slot as a pending placeholder while it downloads.
+# When the head is still pending: 'wait' up to HEAD_PENDING_WAIT seconds for it,
+# then play the first ready song; 'play_ready' plays the first ready song at once.
+HEAD_PENDING_POLICY = 'wait'
+HEAD_PENDING_WAIT = 8.0
+
+# Batch enqueue ("!play a; b; c" or a pasted list)
+BATCH_SEARCH_CONCURRENCY = YTDL_SEARCH_SESSIONS  # More would only wait for a search session
+BATCH_MAX_QUERIES = MAX_QUEUED_PER_USER
+
+# Core event loop (core.py): executor threads for the blocking calls of both
+# yt-dlp pools, plus a couple for frame indexing and other short file work
+CORE_EXECUTOR_WORKERS = YTDL_DOWNLOAD_SESSIONS + YTDL_SEARCH_SESSIONS + 2
+WORKER_RESTART_DELAY = 1.0  # Seconds before a core loop worker that crashed is started again
+
+# Thumbnails of search results and the current song (thumbnails.py)
+THUMBNAIL_DIR = 'thumbnails'  # Kept across runs, like CACHE_DIR
+THUMBNAIL_DISK_MAX_BYTES = 32 * 1024 * 1024
+THUMBNAIL_MEMORY_BYTES = 8 * 1024 * 1024  # Pixel data of scaled surfaces held in memory
+THUMBNAIL_FETCH_WIDTH = 320  # Smallest source width worth downloading for the sizes drawn
+THUMBNAIL_FETCHES = 4  # Concurrent image downloads
+THUMBNAIL_FETCH_TIMEOUT = 10
+THUMBNAIL_RETRY_DELAY = 30  # Seconds before a thumbnail whose download failed is tried again
+RESULT_THUMBNAIL_SIZE = (56, 32)
+NOW_PLAYING_THUMBNAIL = pygame.Rect(600, 310, 160, 90)
+
+# Queue panel of the pygame UI (queue_view.py)
+QUEUE_PANEL = pygame.Rect(570, 50, 220, 242)
+QUEUE_ROW_HEIGHT = 22
+QUEUE_ROW_CACHE = 512  # Rendered row texts kept, a few screens' worth
+
+# Process layout: 'single' runs everything in one process, 'split' runs the pygame
+# UI and the Discord bot in child processes (processes.py), so neither a UI crash
+# nor the bot's searches can stall playback
+PROCESS_LAYOUT = os.getenv('PROCESS_LAYOUT', 'single')
+UI_RESTART_DELAY = 2.0  # Seconds before a crashed UI process is started again
+BOT_RESTART_DELAY = 10.0  # Seconds before a crashed bot process is started again (and reconnects to Discord)
+STATUS_POLL_INTERVAL = 0.1  # How often a child process checks the status block for its state subscribers
+
+# Local HTTP/WebSocket control API (api.py), for dashboards and scripts on this machine
+API_ENABLED = True
+API_HOST = '127.0.0.1'  # Never bind this to a public interface, it has no per-user limits
+API_PORT = int(os.getenv('API_PORT', '8780'))
+API_TOKEN = os.getenv('API_TOKEN')  # If set, required as "Authorization: Bearer <token>" or ?token=
+API_REQUESTER = 'api'  # Requester id of songs queued through the API
+API_CLIENT_QUEUE = 64  # Messages buffered per WebSocket client before it is resynced with a snapshot
+API_QUEUE_POLL = 0.25  # Seconds between checks for a new queue version to push
+API_QUEUE_HEAD = 10  # Queue entries included in pushed queue updates
+API_QUEUE_PAGE_MAX = 500  # Most entries one GET /api/queue returns
+
+# Request tracing (tracing.py): spans of each request across threads, dumped with !trace
+TRACING_ENABLED = os.getenv('TRACING') == '1'  # Can also be switched at runtime with !trace on/off
+TRACE_BUFFER_SPANS = 20000  # Most recent spans kept; older ones are dropped
 
 def ensure_downloads_directory():
     """Create downloads directory if it doesn't exist and clear it on startup"""
@@ -0,0 +1,529 @@
+import itertools
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+from types import SimpleNamespace
+
+import pygame
+
+import config
+import player
+from audio import get_connected_audio_devices
+from audio_cache import cache_size, cache_stats
+from batch import enqueue_batch
+from formats import choose_target_kbps, fetch_stats
+from ingest import cancel_downloads, enqueue_local_track, remove_queued, submit_download
+from pcm_cache import pcm_cache
+from player import back, claim_auto_play_chance, get_duration, get_position, handle_music_end_event
+from player import handle_next_song_event, handle_track_end_event, move_entry, release_auto_play_chance
+from player import replay, seek, set_eq, set_volume, skip, toggle_play_pause
+from song_queue import QueueSnapshot, is_ready, queue_snapshot
+from state import StateChange
+from status_block import StatusBlock
+from tracing import current_trace_id, tracer
+from ytdl_pool import download_pool, search_pool
+
+
+class LocalControl:
+    """The player as the pygame UI and the Discord bot see it, in the engine process.
+
+    MusicPlayerUI and the bot only talk to the player through a control, so
+    the same code runs in the engine process (this class) or a process of
+    its own (RemoteControl). The methods a remote process may call are
+    REMOTE_METHODS.
+    """
+
+    REMOTE_METHODS = {'toggle_play_pause', 'skip', 'seek', 'set_volume', 'enqueue', 'enqueue_batch',
+                      'move_entry', 'remove_queued', 'queue_rows', 'cancel_downloads', 'replay', 'back',
+                      'set_eq', 'stats', 'update_bot_state', 'set_tracing', 'clear_trace', 'trace_exports'}
+    BOT_STATE_FIELDS = ('bot_ready', 'discord_status', 'discord_last_command')
+
+    def __init__(self):
+        self.last_audio_check = -config.AUDIO_CHECK_INTERVAL
+
+    @property
+    def state(self):
+        return config.state
+
+    def state_version(self):
+        return config.state.version
+
+    def subscribe(self, callback, keys=None):
+        config.state.subscribe(callback, keys)
+
+    def update_bot_state(self, fields):
+        """Publish the Discord bot's fields of the state store, e.g. {'discord_status': ...}"""
+        unknown = set(fields) - set(self.BOT_STATE_FIELDS)
+        if unknown:
+            raise ValueError(f"Not a bot state field: {', '.join(sorted(unknown))}")
+        config.state.update(**fields)
+
+    def poll(self):
+        """Called once per frame: periodically update audio device information"""
+        current_time = pygame.time.get_ticks()
+        if current_time - self.last_audio_check > config.AUDIO_CHECK_INTERVAL:
+            config.state.update(connected_audio_device=get_connected_audio_devices())
+            self.last_audio_check = current_time
+
+    def handle_player_event(self, event):
+        """Dispatch the player's end and timer events. Returns True if `event` was one of them."""
+        if event.type == config.MUSIC_END:
+            handle_music_end_event()
+        elif event.type == config.NEXT_SONG_EVENT:
+            handle_next_song_event()
+        elif event.type == config.TRACK_END_EVENT:
+            handle_track_end_event()
+        else:
+            return False
+        return True
+
+    def toggle_play_pause(self):
+        toggle_play_pause()
+
+    def skip(self):
+        return skip()
+
+    def seek(self, seconds):
+        """Seek in the current song and return the new position, or None if nothing is playing"""
+        return get_position() if seek(seconds) else None
+
+    def set_volume(self, level):
+        set_volume(level)
+
+    def get_position(self):
+        return get_position()
+
+    def get_duration(self):
+        return get_duration()
+
+    def enqueue(self, video_info, requester=config.LOCAL_REQUESTER, on_failed=None, on_ready=None,
+                on_cancelled=None):
+        """Queue a search result, downloading it unless it is a local track.
+
+        Returns None at the requester's queue limit, else whether the song got
+        the auto-play chance. The callbacks are submit_download's, except that
+        `on_ready` gets the title of another queued or playing song with the
+        same file (WARN_DUPLICATES), or None.
+        """
+        this_song_gets_auto_play_chance = claim_auto_play_chance()
+        if video_info.get('local'):
+            queued = enqueue_local_track(video_info, this_song_gets_auto_play_chance, requester)
+        else:
+            report_ready = on_ready and (lambda song_info: on_ready(_duplicate_of(song_info)))
+            queued = submit_download(video_info, this_song_gets_auto_play_chance, requester, on_failed=on_failed,
+                                     on_ready=report_ready, on_cancelled=on_cancelled)
+        if queued is None:
+            release_auto_play_chance(this_song_gets_auto_play_chance)
+            return None
+        return this_song_gets_auto_play_chance
+
+    def enqueue_batch(self, items, requester=config.LOCAL_REQUESTER, on_complete=None):
+        """Queue resolved batch items and return them with their errors set"""
+        def report_failures(failures):
+            for query, reason in failures:
+                print(f"Pygame: Download failed for '{query}': {reason}")
+
+        enqueue_batch(items, requester, on_complete=on_complete or report_failures)
+        return items
+
+    def cancel_downloads(self, requester):
+        return cancel_downloads(requester)
+
+    def replay(self):
+        return replay()
+
+    def back(self):
+        """Play the previous song again and return its title, or None if there is none"""
+        song_info = back()
+        return song_info['title'] if song_info else None
+
+    def set_eq(self, bass_db, treble_db):
+        return set_eq(bass_db, treble_db)
+
+    def stats(self):
+        """Cache, download, audio engine and yt-dlp counters for !stats, as plain values"""
+        music = player.music
+        engine = None
+        if hasattr(music, 'underruns'):
+            engine = SimpleNamespace(underruns=music.underruns, budget_overruns=music.budget_overruns,
+                                     average_callback_ms=music.average_callback_ms(),
+                                     callback_max=music.callback_max)
+        return SimpleNamespace(
+            cache=SimpleNamespace(hits=cache_stats.hits, misses=cache_stats.misses,
+                                  prefetched=cache_stats.prefetched, size=cache_size(),
+                                  average_miss_latency=cache_stats.average_miss_latency(),
+                                  saved_seconds=cache_stats.saved_seconds()),
+            fetch=SimpleNamespace(tracks=fetch_stats.tracks, bytes_fetched=fetch_stats.bytes_fetched,
+                                  bytes_saved=fetch_stats.bytes_saved(), throughput=fetch_stats.throughput,
+                                  target_kbps=choose_target_kbps(0)),
+            pcm=SimpleNamespace(tracks=len(pcm_cache), resident_bytes=pcm_cache.resident_bytes(),
+                                hit_rate=pcm_cache.hit_rate(), hits=pcm_cache.hits, misses=pcm_cache.misses),
+            engine=engine,
+            pools=[search_pool.stats(), download_pool.stats()])
+
+    def set_tracing(self, enabled):
+        tracer.enabled = enabled
+
+    def clear_trace(self):
+        tracer.clear()
+
+    def trace_exports(self):
+        """The buffered spans of every process taking part, for tracing.chrome_trace()"""
+        return [tracer.export()]
+
+    def move_entry(self, entry_id, before_id=None):
+        return move_entry(entry_id, before_id)
+
+    def remove_queued(self, entry_id):
+        return remove_queued(entry_id)
+
+    def queue_snapshot(self):
+        return queue_snapshot()
+
+    def pending_count(self, snapshot):
+        return sum(1 for song in snapshot.songs if not is_ready(song))
+
+    def queue_rows(self, start, count):
+        """The fields the queue panel draws, for `count` entries from `start`"""
+        return [{'id': song['id'], 'title': song['title'], 'status': song.get('status', 'ready')}
+                for song in queue_snapshot().songs[start:start + count]]
+
+
+def _duplicate_of(song_info):
+    """Title of another queued or playing song with the same file as `song_info`, or None.
+
+    Different uploads of one recording share a file once fingerprinting has
+    matched them, so comparing paths catches those as well.
+    """
+    if not config.WARN_DUPLICATES:
+        return None
+    same = [song for song in queue_snapshot().songs if song.get('path') == song_info['path']]
+    currently_playing = config.state.currently_playing
+    if currently_playing and currently_playing.get('path') == song_info['path']:
+        same.append(currently_playing)
+    if len(same) < 2:
+        return None  # Only the entry just added
+    return next((song for song in same if song['title'] != song_info['title']), same[0])['title']
+
+
+class RemoteCallback:
+    """Stands in for a callable argument of a remote call, which the server calls back over an events connection"""
+
+    def __init__(self, listener, callback_id):
+        self.listener = listener
+        self.callback_id = callback_id
+
+
+class ControlServer:
+    """Serves a LocalControl to the UI and bot processes over a local connection.
+
+    Each request is a pickled (method, args, trace id) tuple answered with
+    (ok, result), over a socket bound to localhost and guarded by a random
+    authkey, so the overhead per call is one round trip on the loopback
+    interface. State goes the other way through the StatusBlock, which never
+    needs a call, and callbacks over a second "events" connection per client.
+    """
+
+    def __init__(self, control, authkey):
+        self.control = control
+        self.authkey = authkey
+        self.listener = Listener(('127.0.0.1', 0), authkey=authkey)
+        self.address = self.listener.address
+        self._listeners = {}  # listener key -> (events connection, send lock)
+        self._thread = threading.Thread(target=self._accept_loop, name="control-server")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                connection = self.listener.accept()
+            except OSError:
+                return  # Listener closed
+            except Exception as e:
+                print(f"Control server: Rejected a connection: {e}")
+                continue
+            thread = threading.Thread(target=self._serve, args=(connection,), name="control-client")
+            thread.daemon = True
+            thread.start()
+
+    def _serve(self, connection):
+        with connection:
+            while True:
+                try:
+                    name, args, trace_id = connection.recv()
+                except (EOFError, OSError):
+                    return  # The client process exited or crashed
+                if name == 'listen':
+                    self._listen(connection, *args)
+                    return
+                if name not in LocalControl.REMOTE_METHODS:
+                    connection.send((False, f"Unknown control method: {name}"))
+                    continue
+                args = [self._callback(arg) if isinstance(arg, RemoteCallback) else arg for arg in args]
+                token = current_trace_id.set(trace_id)  # The engine's spans join the caller's request
+                try:
+                    result = getattr(self.control, name)(*args)
+                except Exception as e:
+                    print(f"Control server: {name} failed: {e}")
+                    connection.send((False, str(e)))
+                    continue
+                finally:
+                    current_trace_id.reset(token)
+                connection.send((True, result))
+
+    def _listen(self, connection, listener):
+        """Use `connection` for the callbacks of one client until its process goes away"""
+        self._listeners[listener] = (connection, threading.Lock())
+        connection.send((True, None))
+        try:
+            connection.recv()  # The client never sends on it, this returns once it is closed
+        except (EOFError, OSError):
+            pass
+        finally:
+            del self._listeners[listener]
+
+    def _callback(self, stand_in):
+        """The function that calls a RemoteCallback back in its client's process"""
+        def call_back(*args):
+            listener = self._listeners.get(stand_in.listener)
+            if listener is None:
+                return  # The client process is gone
+            connection, lock = listener
+            try:
+                with lock:  # Callbacks come from any engine thread
+                    connection.send((stand_in.callback_id, args))
+            except OSError:
+                pass  # Gone meanwhile
+        return call_back
+
+    def close(self):
+        self.listener.close()
+
+
+class RemoteQueueRows:
+    """The queue entries of one queue version, fetched from the engine a page at a time as they are drawn"""
+
+    PAGE = 64
+
+    def __init__(self, control, length):
+        self._control = control
+        self._length = length
+        self._pages = {}
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if not 0 <= index < self._length:
+            raise IndexError(index)
+        page, offset = divmod(index, self.PAGE)
+        rows = self._pages.get(page)
+        if rows is None:
+            rows = self._pages[page] = self._control.call('queue_rows', page * self.PAGE, self.PAGE)
+        if offset >= len(rows):
+            # The queue shrank after this version was published, the next frame sees the new one
+            return {'id': None, 'title': "", 'status': 'pending'}
+        return rows[offset]
+
+
+class RemoteControl:
+    """The same controls for a UI or Discord bot running in its own process.
+
+    Reads come from the engine's StatusBlock without a round trip; commands
+    and queue rows go over the control connection. Callable arguments are
+    called back from the engine over an events connection, opened by the
+    first call that passes one. The process exits when the engine does.
+    """
+
+    def __init__(self, address, authkey, status_name):
+        self._address = address
+        self._authkey = authkey
+        self._connection = Client(address, authkey=authkey)
+        self._lock = threading.Lock()  # Searches and batches call from the core loop as well
+        self._status = StatusBlock(status_name)
+        self._snapshot = None
+        self._listener = os.urandom(16).hex()
+        self._events = None
+        self._callbacks = {}  # callback id -> (callback, ids of the callbacks of the same call)
+        self._callback_ids = itertools.count(1)
+        self._callbacks_lock = threading.Lock()
+        self._subscribers = []  # (callback, keys)
+        self._watcher = None
+
+    @property
+    def state(self):
+        return self._status.read()
+
+    def subscribe(self, callback, keys=None):
+        """Call `callback(change)` on a watcher thread whenever any of `keys` (or any field) of the status changes"""
+        self._subscribers.append((callback, keys))
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=self._watch_status, name="status-watcher")
+            self._watcher.daemon = True
+            self._watcher.start()
+
+    def _watch_status(self):
+        previous = vars(self._status.read())
+        version = 0
+        while True:
+            time.sleep(config.STATUS_POLL_INTERVAL)
+            current = vars(self._status.read())
+            if current is previous:
+                continue  # Nothing was written, read() returned the cached status
+            changes = {key: (previous.get(key), value) for key, value in current.items() if previous.get(key) != value}
+            previous = current
+            version += 1
+            change = StateChange(version, changes)
+            for callback, keys in list(self._subscribers):
+                if keys is None or any(key in changes for key in keys):
+                    try:
+                        callback(change)
+                    except Exception as e:
+                        print(f"Error in state subscriber {getattr(callback, '__name__', callback)}: {e}")
+
+    def update_bot_state(self, fields):
+        self.call('update_bot_state', fields)
+
+    def handle_player_event(self, event):
+        return False  # The engine process pumps the player's events
+
+    def state_version(self):
+        return self._status.seq()
+
+    def poll(self):
+        """Called once per frame: leave when the engine process is gone"""
+        parent = multiprocessing.parent_process()
+        if parent is not None and not parent.is_alive():
+            print("Engine process exited, closing the UI")
+            sys.exit(0)
+
+    def call(self, name, *args):
+        """Call a REMOTE_METHODS method in the engine.
+
+        The callables among `args` are called back from a thread of this
+        process. Those passed in one call are alternative outcomes: once the
+        engine calls one of them, the others are forgotten.
+        """
+        if any(callable(arg) for arg in args):
+            args = self._stand_ins(args)
+        with self._lock:
+            try:
+                self._connection.send((name, args, current_trace_id.get()))
+                ok, result = self._connection.recv()
+            except (EOFError, OSError) as e:
+                raise ConnectionError("Lost the connection to the engine process") from e
+        if not ok:
+            raise RuntimeError(result)
+        return result
+
+    def _stand_ins(self, args):
+        """Register the callable arguments of a call and replace them with RemoteCallbacks"""
+        with self._callbacks_lock:
+            if self._events is None:
+                self._open_events()
+            ids = [next(self._callback_ids) if callable(arg) else None for arg in args]
+            group = [callback_id for callback_id in ids if callback_id is not None]
+            for arg, callback_id in zip(args, ids):
+                if callback_id is not None:
+                    self._callbacks[callback_id] = (arg, group)
+        return tuple(arg if callback_id is None else RemoteCallback(self._listener, callback_id)
+                     for arg, callback_id in zip(args, ids))
+
+    def _open_events(self):
+        events = Client(self._address, authkey=self._authkey)
+        events.send(('listen', (self._listener,), None))
+        events.recv()  # Registered: callbacks may arrive from here on
+        self._events = events
+        thread = threading.Thread(target=self._dispatch_callbacks, name="control-callbacks")
+        thread.daemon = True
+        thread.start()
+
+    def _dispatch_callbacks(self):
+        while True:
+            try:
+                callback_id, args = self._events.recv()
+            except (EOFError, OSError):
+                return  # The engine process exited
+            with self._callbacks_lock:
+                callback, group = self._callbacks.get(callback_id, (None, ()))
+                for sibling in group:
+                    self._callbacks.pop(sibling, None)
+            if callback is None:
+                continue
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"Error in control callback {getattr(callback, '__name__', callback)}: {e}")
+
+    def toggle_play_pause(self):
+        self.call('toggle_play_pause')
+
+    def skip(self):
+        return self.call('skip')
+
+    def seek(self, seconds):
+        return self.call('seek', seconds)
+
+    def set_volume(self, level):
+        self.call('set_volume', level)
+
+    def get_position(self):
+        return self._status.position() if self._status.read().currently_playing else 0.0
+
+    def get_duration(self):
+        return self._status.read().duration
+
+    def enqueue(self, video_info, requester=config.LOCAL_REQUESTER, on_failed=None, on_ready=None,
+                on_cancelled=None):
+        return self.call('enqueue', video_info, requester, on_failed, on_ready, on_cancelled)
+
+    def enqueue_batch(self, items, requester=config.LOCAL_REQUESTER, on_complete=None):
+        return self.call('enqueue_batch', items, requester, on_complete)
+
+    def cancel_downloads(self, requester):
+        return self.call('cancel_downloads', requester)
+
+    def replay(self):
+        return self.call('replay')
+
+    def back(self):
+        return self.call('back')
+
+    def set_eq(self, bass_db, treble_db):
+        return self.call('set_eq', bass_db, treble_db)
+
+    def stats(self):
+        stats = self.call('stats')
+        # This process runs its own searches, so show its search pool instead of the engine's
+        stats.pools = [search_pool.stats()] + [pool for pool in stats.pools if pool.name != search_pool.name]
+        return stats
+
+    def set_tracing(self, enabled):
+        tracer.enabled = enabled
+        self.call('set_tracing', enabled)
+
+    def clear_trace(self):
+        tracer.clear()
+        self.call('clear_trace')
+
+    def trace_exports(self):
+        return [tracer.export()] + self.call('trace_exports')
+
+    def move_entry(self, entry_id, before_id=None):
+        return self.call('move_entry', entry_id, before_id)
+
+    def remove_queued(self, entry_id):
+        return self.call('remove_queued', entry_id)
+
+    def queue_snapshot(self):
+        status = self._status.read()
+        if self._snapshot is None or self._snapshot.version != status.queue_version:
+            self._snapshot = QueueSnapshot(status.queue_version, RemoteQueueRows(self, status.queue_length))
+        return self._snapshot
+
+    def pending_count(self, snapshot):
+        return self._status.read().pending
@@ -0,0 +1,106 @@
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import config
+
+
+class CoreService:
+    """One asyncio event loop for everything that is not the pygame UI.
+
+    The Discord bot, searches, the ingest pipeline and the prefetcher run as
+    tasks on this loop, in a single background thread. ffmpeg runs as
+    asyncio subprocesses; libraries that can only block (yt-dlp, frame
+    indexing) run on one bounded executor instead of threads of their own.
+    Other threads, the pygame UI above all, never touch the loop directly:
+    they hand work over with submit() and call().
+    """
+
+    def __init__(self, executor_workers):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers, thread_name_prefix="core-io")
+        self.loop.set_default_executor(self.executor)
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._cleanups = []  # Coroutine functions awaited by stop(), e.g. to close HTTP sessions
+
+    def start(self):
+        """Start the loop thread"""
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="core-loop")
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def stop(self, timeout=2.0):
+        """Cancel every task on the loop and stop it, so shutdown does not leave tasks pending"""
+        if self._thread is None:
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._cancel_tasks(), self.loop).result(timeout)
+        except Exception as e:
+            print(f"Core loop did not wind down cleanly: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+
+    def at_stop(self, cleanup):
+        """Have stop() await `cleanup()` before it cancels the remaining tasks"""
+        self._cleanups.append(cleanup)
+
+    async def _cancel_tasks(self):
+        for cleanup in self._cleanups:
+            try:
+                await cleanup()
+            except Exception as e:
+                print(f"Error during core shutdown: {e}")
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def submit(self, coro):
+        """Run a coroutine on the core loop from any thread and return a concurrent.futures.Future"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def keep_running(self, coro_func, name):
+        """Run the worker coroutine `coro_func()` on the core loop, starting it again whenever it crashes.
+
+        Returns the future of the first run. Workers loop forever, so an
+        error that escapes one is logged and the worker restarted after
+        WORKER_RESTART_DELAY rather than left to vanish silently.
+        """
+        future = self.submit(coro_func())
+
+        def restart_on_error(done):
+            if done.cancelled() or done.exception() is None:
+                return  # Shut down, or finished on purpose
+            print(f"{name} crashed, restarting it: {done.exception()!r}")
+            self.loop.call_soon_threadsafe(self.loop.call_later, config.WORKER_RESTART_DELAY,
+                                           self.keep_running, coro_func, name)
+
+        future.add_done_callback(restart_on_error)
+        return future
+
+    def call(self, func, *args):
+        """Call a plain function on the core loop as soon as possible, from any thread"""
+        self.start()
+        self.loop.call_soon_threadsafe(func, *args)
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """Await a blocking call on the core executor, in a copy of the caller's context (trace ids)"""
+        return await self.loop.run_in_executor(None, partial(contextvars.copy_context().run, func, *args, **kwargs))
+
+
+core = CoreService(config.CORE_EXECUTOR_WORKERS)
+
+
+def start_core():
+    """Start the core event loop"""
+    core.start()
@@ -1,33 +1,61 @@
 import discord
 from discord.ext import commands
 
-import threading
-import pygame
-from pygame import mixer
+import io
+import time
 import config
-from youtube import search_youtube, download_audio_worker
+from audio import format_time, parse_timestamp
+from batch import resolve, resolve_queries, split_queries
+from control import LocalControl
+from core import core
+from now_playing import NowPlayingBoard
+from song_queue import is_ready
+from tracing import chrome_trace, traced_request, tracer
 
 
 # Discord bot setup
 bot = commands.Bot(command_prefix='!', intents=discord.Intents.all())
 
+# The player as the bot drives it: directly in the engine process, or through
+# a RemoteControl when the bot runs in a process of its own (use_control)
+control = LocalControl()
+
+
+def use_control(new_control):
+    """Drive the player through `new_control`, e.g. the RemoteControl of the split layout's bot process"""
+    global control
+    control = new_control
+    now_playing_board.control = new_control
+
+
+def update_state(**fields):
+    """Publish the bot's fields of the player state (bot_ready, discord_status, discord_last_command)"""
+    control.update_bot_state(fields)
+
 
 @bot.event
 async def on_ready():
     """Called when the bot is ready"""
     print(f'Discord bot connected as {bot.user}')
-    config.bot_ready = True
-    config.discord_status = f"Discord bot: Connected as {bot.user.name}"
+    update_state(bot_ready=True, discord_status=f"Discord bot: Connected as {bot.user.name}")
     await bot.change_presence(activity=discord.Game(name="!help for commands"))
 
 
 @bot.command()
+@traced_request('discord.play')
 async def play(ctx, *, query):
     """Play a song from YouTube"""
-    config.discord_last_command = f"!play {query}"
+    update_state(discord_last_command=f"!play {query}")
 
-    results = search_youtube(query)
-    if not results:
+    queries = split_queries(query)
+    if len(queries) > 1:
+        await play_batch(ctx, queries)
+        return
+
+    # Local library hits play straight from disk, with no YouTube round trip.
+    # The search blocks, so it runs on the core executor instead of stalling the loop.
+    video_info = await core.run_blocking(resolve, query)
+    if video_info is None:
         embed = discord.Embed(
             title="❌ No Results Found",
             description="No results found for your query.",
@@ -36,24 +64,24 @@ async def play(ctx, *, query):
         await ctx.send(embed=embed)
         return
 
-    # Get the first result
-    video_info = results[0]
-
-    # Check if this download should get auto-play chance
-    this_song_gets_auto_play_chance = False
-    if not config.is_playing and not mixer.music.get_busy():
-        with config.auto_play_lock:
-            if not config.is_auto_play_pending:
-                config.is_auto_play_pending = True
-                this_song_gets_auto_play_chance = True
-
-    # Start download in a separate thread
-    thread = threading.Thread(
-        target=download_audio_worker,
-        args=(video_info, this_song_gets_auto_play_chance)
-    )
-    thread.daemon = True
-    thread.start()
+    # Local tracks are queued as-is (their file is indexed first), everything else goes
+    # through the ingest pipeline. Either way the engine answers, so it runs on the executor.
+    if video_info.get('local'):
+        this_song_gets_auto_play_chance = await core.run_blocking(control.enqueue, video_info, ctx.author.id)
+    else:
+        this_song_gets_auto_play_chance = await core.run_blocking(
+            control.enqueue, video_info, ctx.author.id,
+            on_failed=download_failed_reporter(ctx, video_info['title']),
+            on_ready=duplicate_warner(ctx, video_info['title']),
+            on_cancelled=_nothing_to_report)
+    if this_song_gets_auto_play_chance is None:
+        embed = discord.Embed(
+            title="🚫 Queue Limit Reached",
+            description=f"You already have {config.MAX_QUEUED_PER_USER} songs waiting. Let some play first!",
+            color=discord.Color.red()
+        )
+        await ctx.send(embed=embed)
+        return
 
     embed = discord.Embed(
         title="🎵 Song Added to Queue",
@@ -65,7 +93,120 @@ async def play(ctx, *, query):
         embed.add_field(name="Status", value="Will play immediately", inline=False)
     else:
         embed.add_field(name="Status", value="Added to queue", inline=False)
+    if video_info.get('local'):
+        embed.add_field(name="Source", value="Local library", inline=False)
+
+    await ctx.send(embed=embed)
+
+
+@bot.command()
+@traced_request('discord.playmany')
+async def playmany(ctx, *, queries):
+    """Queue several songs at once, separated by ; or new lines"""
+    update_state(discord_last_command="!playmany")
+    await play_batch(ctx, split_queries(queries))
+
+
+def _embed_lines(lines, limit=1024):
+    """Join lines for an embed field, cutting off what does not fit"""
+    text = ""
+    for i, line in enumerate(lines):
+        more = f"\n...and {len(lines) - i} more"
+        if len(text) + len(line) + 1 + len(more) > limit:
+            return text + more
+        text += ("\n" if text else "") + line
+    return text
+
+
+async def play_batch(ctx, queries):
+    """Search all queries concurrently and queue the results in the order given"""
+    items = await resolve_queries(queries)
+
+    def report_failures(failures):
+        if not failures:
+            return
+        embed = discord.Embed(
+            title="❌ Some Downloads Failed",
+            description=_embed_lines([f"**{query}**: {reason[:200]}" for query, reason in failures], 4096),
+            color=discord.Color.red()
+        )
+        core.submit(ctx.send(content=ctx.author.mention, embed=embed))
 
+    # Indexes local files, and the items come back from the engine with their errors set
+    items = await core.run_blocking(control.enqueue_batch, items, ctx.author.id, on_complete=report_failures)
+
+    queued = [item for item in items if item.error is None]
+    failed = [item for item in items if item.error is not None]
+    embed = discord.Embed(
+        title=f"🎵 {len(queued)} of {len(items)} Songs Added to Queue",
+        color=discord.Color.green() if queued else discord.Color.red()
+    )
+    if queued:
+        embed.add_field(name="Queued in order",
+                        value=_embed_lines([f"{i}. {item.track['title']}" for i, item in enumerate(queued, 1)]),
+                        inline=False)
+    if failed:
+        embed.add_field(name="Not added",
+                        value=_embed_lines([f"**{item.query}**: {item.error}" for item in failed]),
+                        inline=False)
+    await ctx.send(embed=embed)
+
+
+def download_failed_reporter(ctx, title):
+    """Build an on_failed callback that tells the requester their download failed for good"""
+    def report(reason):
+        embed = discord.Embed(
+            title="❌ Download Failed",
+            description=f"**{title}** could not be downloaded.\n{reason[:500]}",
+            color=discord.Color.red()
+        )
+        # Called from an ingest task or from another thread, so schedule the send on the core loop
+        core.submit(ctx.send(content=ctx.author.mention, embed=embed))
+    return report
+
+
+def duplicate_warner(ctx, title):
+    """Build an on_ready callback that warns when the song is already queued or playing"""
+    def warn(duplicate):
+        if duplicate is None:
+            return  # The engine found no other entry with the same file
+        embed = discord.Embed(
+            title="⚠️ Possible Duplicate",
+            description=f"**{title}** is already in the queue"
+                        + (f" as **{duplicate}**." if duplicate != title else "."),
+            color=discord.Color.orange()
+        )
+        core.submit(ctx.send(content=ctx.author.mention, embed=embed))
+    return warn
+
+
+def _nothing_to_report():
+    """on_cancelled of a download: the requester cancelled it themselves.
+
+    Passed anyway so that a RemoteControl forgets the download's other
+    callbacks once it is cancelled.
+    """
+
+
+@bot.command()
+async def cancel(ctx):
+    """Cancel your songs that are still downloading"""
+    titles = control.cancel_downloads(ctx.author.id)
+    if titles:
+        embed = discord.Embed(
+            title="🛑 Downloads Cancelled",
+            description="\n".join(f"• {title}" for title in titles[:10]),
+            color=discord.Color.blue()
+        )
+        if len(titles) > 10:
+            embed.add_field(name="...", value=f"And {len(titles) - 10} more songs", inline=False)
+        update_state(discord_last_command="!cancel")
+    else:
+        embed = discord.Embed(
+            title="❌ Nothing to Cancel",
+            description="You have no songs downloading.",
+            color=discord.Color.red()
+        )
     await ctx.send(embed=embed)
 
 
@@ -73,14 +214,13 @@ async def play(ctx, *, query):
 async def pause(ctx):
     """Pause the current song"""
 
-    if config.is_playing:
-        from player import toggle_play_pause
-        toggle_play_pause()
+    if control.state.is_playing:
+        control.toggle_play_pause()
         embed = discord.Embed(
             title="⏸️ Playback Paused",
             color=discord.Color.blue()
         )
-        config.discord_last_command = "!pause"
+        update_state(discord_last_command="!pause")
     else:
         embed = discord.Embed(
             title="❌ Nothing is Playing",
@@ -95,14 +235,14 @@ async def pause(ctx):
 async def resume(ctx):
     """Resume playback"""
 
-    if not config.is_playing and config.current_song:
-        from player import toggle_play_pause
-        toggle_play_pause()
+    state = control.state
+    if not state.is_playing and state.currently_playing:
+        control.toggle_play_pause()
         embed = discord.Embed(
             title="▶️ Playback Resumed",
             color=discord.Color.green()
         )
-        config.discord_last_command = "!resume"
+        update_state(discord_last_command="!resume")
     else:
         embed = discord.Embed(
             title="❌ Nothing to Resume",
@@ -117,19 +257,12 @@ async def resume(ctx):
 async def skip(ctx):
     """Skip to the next song"""
 
-    skipped = False
-    with config.queue_lock:
-        if config.is_playing or mixer.music.get_busy():
-            mixer.music.stop()
-            skipped = True
-            pygame.time.set_timer(config.NEXT_SONG_EVENT, 10)
-
-    if skipped:
+    if control.skip():
         embed = discord.Embed(
             title="⏭️ Song Skipped",
             color=discord.Color.blue()
         )
-        config.discord_last_command = "!skip"
+        update_state(discord_last_command="!skip")
     else:
         embed = discord.Embed(
             title="❌ Nothing to Skip",
@@ -140,6 +273,36 @@ async def skip(ctx):
     await ctx.send(embed=embed)
 
 
+# Queue fields of the !queue embed, rebuilt only when the queue version changes
+_queue_fields_cache = (None, [])
+
+
+def _queue_entry_text(song):
+    """Queue line of a song, marking placeholders that are still downloading"""
+    if is_ready(song):
+        return song['title']
+    return f"⏳ {song['title']} (downloading)"
+
+
+def _queue_fields(snapshot):
+    """Return the (name, value) embed fields listing a queue snapshot"""
+    global _queue_fields_cache
+    if _queue_fields_cache[0] == snapshot.version:
+        return _queue_fields_cache[1]
+
+    songs = snapshot.songs  # Indexed one by one, a remote snapshot fetches its rows on demand
+    if songs:
+        queue_list = [f"{i + 1}. {_queue_entry_text(songs[i])}" for i in range(min(10, len(songs)))]  # Show first 10 songs
+        fields = [(f"📋 Up Next ({len(songs)} songs)", "\n".join(queue_list))]
+        if len(songs) > 10:
+            fields.append(("...", f"And {len(songs) - 10} more songs"))
+    else:
+        fields = [("📋 Queue", "Queue is empty")]
+
+    _queue_fields_cache = (snapshot.version, fields)
+    return fields
+
+
 @bot.command()
 async def queue(ctx):
     """Show the current queue"""
@@ -148,73 +311,319 @@ async def queue(ctx):
         color=discord.Color.blue()
     )
 
-    # Lock the queue while reading it
-    with config.queue_lock:
-        if config.currently_playing:
-            embed.add_field(
-                name="🎶 Now Playing",
-                value=config.currently_playing['title'],
-                inline=False
-            )
+    # Everything below reads published state, so no lock is needed
+    currently_playing = control.state.currently_playing
+    if currently_playing:
+        embed.add_field(
+            name="🎶 Now Playing",
+            value=currently_playing['title'],
+            inline=False
+        )
 
-        if config.queued_songs:
-            queue_list = []
-            for i, song in enumerate(config.queued_songs[:10], 1):  # Show first 10 songs
-                queue_list.append(f"{i}. {song['title']}")
+    for name, value in _queue_fields(control.queue_snapshot()):
+        embed.add_field(name=name, value=value, inline=False)
 
-            embed.add_field(
-                name=f"📋 Up Next ({len(config.queued_songs)} songs)",
-                value="\n".join(queue_list) if queue_list else "Queue is empty",
-                inline=False
-            )
+    await ctx.send(embed=embed)
+
+
+@bot.command()
+async def replay(ctx):
+    """Restart the current song from the beginning"""
+    if control.replay():
+        embed = discord.Embed(
+            title="🔁 Replaying",
+            description=f"**{control.state.currently_playing['title']}**",
+            color=discord.Color.blue()
+        )
+        update_state(discord_last_command="!replay")
+    else:
+        embed = discord.Embed(
+            title="❌ Nothing to Replay",
+            description="No song is currently playing.",
+            color=discord.Color.red()
+        )
+    await ctx.send(embed=embed)
+
+
+@bot.command()
+async def back(ctx):
+    """Play the previous song again"""
+    title = control.back()
+    if title:
+        embed = discord.Embed(
+            title="⏮️ Back",
+            description=f"**{title}**",
+            color=discord.Color.blue()
+        )
+        update_state(discord_last_command="!back")
+    else:
+        embed = discord.Embed(
+            title="❌ Nothing to Go Back To",
+            description="No previously played song is available.",
+            color=discord.Color.red()
+        )
+    await ctx.send(embed=embed)
+
+
+def progress_bar(position, duration, width=20):
+    """Render a text progress bar for an embed"""
+    filled = int(width * min(1.0, position / duration)) if duration else 0
+    return "▬" * filled + "🔘" + "▬" * (width - filled)
 
-            if len(config.queued_songs) > 10:
-                embed.add_field(
-                    name="...",
-                    value=f"And {len(config.queued_songs) - 10} more songs",
-                    inline=False
-                )
+
+@bot.command()
+async def seek(ctx, position: str):
+    """Seek in the current song (seconds, m:ss, or +/- offset)"""
+    try:
+        if position[0] in '+-':
+            target = control.get_position() + (1 if position[0] == '+' else -1) * parse_timestamp(position[1:])
         else:
-            embed.add_field(name="📋 Queue", value="Queue is empty", inline=False)
+            target = parse_timestamp(position)
+    except ValueError:
+        embed = discord.Embed(
+            title="❌ Invalid Position",
+            description="Use seconds (`90`), `m:ss` (`1:30`) or an offset (`+15`, `-10`).",
+            color=discord.Color.red()
+        )
+        await ctx.send(embed=embed)
+        return
+
+    new_position = control.seek(target)
+    if new_position is not None:
+        embed = discord.Embed(
+            title="⏩ Seeked",
+            description=f"Now at {format_time(new_position)}",
+            color=discord.Color.blue()
+        )
+        update_state(discord_last_command=f"!seek {position}")
+    else:
+        embed = discord.Embed(
+            title="❌ Nothing to Seek",
+            description="No song is currently playing.",
+            color=discord.Color.red()
+        )
 
     await ctx.send(embed=embed)
 
 
+def now_playing_embed():
+    """Build the now playing embed with elapsed and total time"""
+    state = control.state
+    song_info = state.currently_playing
+    if not song_info:
+        return discord.Embed(
+            title="❌ Nothing is Playing",
+            description="No song is currently playing.",
+            color=discord.Color.red()
+        )
+
+    position = control.get_position()
+    duration = control.get_duration()
+    total = format_time(duration) if duration else "?"
+    embed = discord.Embed(
+        title="🎶 Now Playing",
+        description=f"**{song_info['title']}**",
+        color=discord.Color.blue()
+    )
+    embed.add_field(
+        name="Paused" if not state.is_playing else "Progress",
+        value=f"{progress_bar(position, duration)}\n{format_time(position)} / {total}",
+        inline=False
+    )
+    return embed
+
+
+# Opt-in live now playing messages, one per channel
+now_playing_board = NowPlayingBoard(now_playing_embed, control)
+
+
+@bot.command()
+async def nowplaying(ctx, mode: str = None):
+    """Show the current song. `live` keeps a message updated in this channel, `off` stops it."""
+    if mode == "live":
+        now_playing_board.enable(ctx.channel)
+        update_state(discord_last_command="!nowplaying live")
+    elif mode == "off":
+        if now_playing_board.disable(ctx.channel):
+            embed = discord.Embed(
+                title="⏹️ Live Now Playing Stopped",
+                color=discord.Color.blue()
+            )
+        else:
+            embed = discord.Embed(
+                title="❌ No Live Message",
+                description="This channel has no live now playing message.",
+                color=discord.Color.red()
+            )
+        await ctx.send(embed=embed)
+    else:
+        await ctx.send(embed=now_playing_embed())
+
+
 @bot.command()
 async def volume(ctx, level: int):
     """Set volume (0-100)"""
 
-    new_level = max(0, min(100, level)) / 100.0
-    config.volume_level = new_level
-    mixer.music.set_volume(config.volume_level)
+    control.set_volume(max(0, min(100, level)) / 100.0)
 
     embed = discord.Embed(
         title="🔊 Volume Changed",
         description=f"Volume set to {level}%",
         color=discord.Color.green()
     )
-    config.discord_last_command = f"!volume {level}"
+    update_state(discord_last_command=f"!volume {level}")
     await ctx.send(embed=embed)
 
 
-def run_discord_bot():
-    """Run the Discord bot in a separate thread"""
+@bot.command()
+async def eq(ctx, bass: float, treble: float):
+    """Set the equalizer: bass and treble in dB (-12 to 12)"""
+    bass = max(-12.0, min(12.0, bass))
+    treble = max(-12.0, min(12.0, treble))
+    if control.set_eq(bass, treble):
+        embed = discord.Embed(
+            title="🎚️ Equalizer Set",
+            description=f"Bass {bass:+.1f} dB, treble {treble:+.1f} dB",
+            color=discord.Color.green()
+        )
+        update_state(discord_last_command=f"!eq {bass:g} {treble:g}")
+    else:
+        embed = discord.Embed(
+            title="❌ Equalizer Unavailable",
+            description="The equalizer needs the software audio engine (`AUDIO_ENGINE=sounddevice`).",
+            color=discord.Color.red()
+        )
+    await ctx.send(embed=embed)
+
+
+@bot.command()
+async def stats(ctx):
+    """Show cache and prefetch statistics"""
+    stats = await core.run_blocking(control.stats)  # Sizes up the cache directory
+    embed = discord.Embed(
+        title="📊 Player Stats",
+        color=discord.Color.blue()
+    )
+    cache = stats.cache
+    embed.add_field(
+        name="Prefetch Cache",
+        value=(f"{cache.hits} hits, {cache.misses} downloads, {cache.prefetched} prefetched\n"
+               f"{cache.size / 1024 ** 2:.0f} MB of {config.PREFETCH_MAX_BYTES / 1024 ** 2:.0f} MB used\n"
+               f"Average download wait {cache.average_miss_latency:.1f}s, "
+               f"~{cache.saved_seconds:.0f}s saved by hits"),
+        inline=False
+    )
+    fetch = stats.fetch
+    throughput = f"{fetch.throughput / 1024:.0f} KiB/s" if fetch.throughput else "not measured yet"
+    embed.add_field(
+        name="Downloads",
+        value=(f"{fetch.tracks} tracks, {fetch.bytes_fetched / 1024 ** 2:.1f} MB fetched, "
+               f"{fetch.bytes_saved / 1024 ** 2:.1f} MB saved by format selection\n"
+               f"Network {throughput}, current target {fetch.target_kbps} kbps"),
+        inline=False
+    )
+    pcm = stats.pcm
+    embed.add_field(
+        name="PCM Cache",
+        value=(f"{pcm.tracks} tracks, {pcm.resident_bytes / 1024 ** 2:.0f} MB mapped "
+               f"of {config.PCM_CACHE_MAX_BYTES / 1024 ** 2:.0f} MB\n"
+               f"{pcm.hit_rate:.0%} of playback starts and seeks served from PCM "
+               f"({pcm.hits} hits, {pcm.misses} misses)"),
+        inline=False
+    )
+    engine = stats.engine
+    if engine is not None:
+        embed.add_field(
+            name="Audio Engine",
+            value=(f"{engine.underruns} underruns, {engine.budget_overruns} callbacks over budget\n"
+                   f"Callback {engine.average_callback_ms:.2f} ms average, {1000 * engine.callback_max:.2f} ms max"),
+            inline=False
+        )
+    embed.add_field(
+        name="yt-dlp Sessions",
+        value="\n".join(
+            f"{pool.name.capitalize()}: {pool.created}/{pool.size} built ({pool.average_build_ms:.0f} ms each), "
+            f"{pool.checkouts} calls ({pool.average_checkout_ms:.2f} ms setup each)"
+            for pool in stats.pools
+        ),
+        inline=False
+    )
+    update_state(discord_last_command="!stats")
+    await ctx.send(embed=embed)
+
+
+@bot.command()
+async def trace(ctx, mode: str = None):
+    """Send the recent request trace as Chrome trace JSON, or turn tracing on/off"""
+    update_state(discord_last_command=f"!trace {mode or ''}".strip())
+    if mode in ('on', 'off'):
+        control.set_tracing(mode == 'on')
+        embed = discord.Embed(
+            title="🔍 Tracing",
+            description=f"Request tracing is now {mode}.",
+            color=discord.Color.blue()
+        )
+        await ctx.send(embed=embed)
+        return
+    if mode == 'clear':
+        control.clear_trace()
+        embed = discord.Embed(
+            title="🔍 Tracing",
+            description="Trace buffer cleared.",
+            color=discord.Color.blue()
+        )
+        await ctx.send(embed=embed)
+        return
+    if mode is not None:
+        embed = discord.Embed(
+            title="Error",
+            description="Use `!trace`, `!trace on`, `!trace off` or `!trace clear`.",
+            color=discord.Color.red()
+        )
+        await ctx.send(embed=embed)
+        return
+
+    # The spans of the bot's process, and the engine's if that is another one
+    exports = await core.run_blocking(control.trace_exports)
+    spans = sum(len(export['spans']) for export in exports)
+    if not spans:
+        state = "on" if tracer.enabled else "off (`!trace on` or TRACING=1)"
+        embed = discord.Embed(
+            title="🔍 Tracing",
+            description=f"No spans recorded yet. Tracing is {state}.",
+            color=discord.Color.orange()
+        )
+        await ctx.send(embed=embed)
+        return
+
+    trace_json = await core.run_blocking(chrome_trace, exports)
+    embed = discord.Embed(
+        title="🔍 Request Trace",
+        description=(f"The last {spans} spans. Open the file in chrome://tracing or https://ui.perfetto.dev; "
+                     f"arrows follow each request across threads."),
+        color=discord.Color.blue()
+    )
+    filename = f"trace-{time.strftime('%Y%m%d-%H%M%S')}.json"
+    await ctx.send(embed=embed, file=discord.File(io.BytesIO(trace_json.encode()), filename=filename))
+
+
+async def run_discord_bot():
+    """Run the Discord bot on the core loop until it disconnects"""
     if config.DISCORD_TOKEN:
+        discord.utils.setup_logging()  # What bot.run() would set up
         try:
-            bot.run(config.DISCORD_TOKEN)
+            await bot.start(config.DISCORD_TOKEN)
         except Exception as e:
             print(f"Discord bot error: {str(e)}")
-            config.discord_status = f"Discord bot: Error - {str(e)[:30]}"
+            update_state(discord_status=f"Discord bot: Error - {str(e)[:30]}")
     else:
         print("Error: No Discord token found. Set DISCORD_TOKEN in .env file.")
 
 
 def start_discord_bot():
-    """Start the Discord bot in a daemon thread"""
+    """Start the Discord bot on the core event loop"""
 
     if config.DISCORD_TOKEN:
-        bot_thread = threading.Thread(target=run_discord_bot)
-        bot_thread.daemon = True
-        bot_thread.start()
+        core.submit(run_discord_bot())
     else:
-        config.discord_status = "Discord bot: No token found"
+        update_state(discord_status="Discord bot: No token found")
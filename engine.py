@@ -0,0 +1,351 @@
+import subprocess
+import threading
+import time
+
+import numpy as np
+import pygame
+import sounddevice as sd
+
+import config
+
+
+def ramp(current, target, frames, step):
+    """Return a per-frame gain ramp from `current` toward `target`, moving at most `step` per frame"""
+    if current == target:
+        return np.full(frames, current, dtype=np.float32)
+    direction = 1.0 if target > current else -1.0
+    gains = current + direction * step * np.arange(1, frames + 1, dtype=np.float32)
+    return np.clip(gains, min(current, target), max(current, target)).astype(np.float32)
+
+
+class RingBuffer:
+    """Single producer, single consumer ring of float32 frames.
+
+    The decoder thread writes and the audio callback reads. Each side only
+    advances its own counter, so the callback never takes a lock.
+    """
+
+    def __init__(self, frames, channels):
+        self._data = np.zeros((frames, channels), dtype=np.float32)
+        self.capacity = frames
+        self._written = 0
+        self._read = 0
+
+    def available(self):
+        return self._written - self._read
+
+    def write(self, frames, cancelled):
+        """Copy frames in, waiting for space. Returns False if `cancelled` was set while waiting."""
+        while len(frames):
+            space = self.capacity - self.available()
+            if space == 0:
+                if cancelled.wait(0.005):
+                    return False
+                continue
+            count = min(space, len(frames))
+            start = self._written % self.capacity
+            first = min(count, self.capacity - start)
+            self._data[start:start + first] = frames[:first]
+            self._data[:count - first] = frames[first:count]
+            self._written += count
+            frames = frames[count:]
+        return True
+
+    def read_into(self, out, frames):
+        """Copy up to `frames` frames into `out` and return how many were available"""
+        count = min(frames, self.available())
+        start = self._read % self.capacity
+        first = min(count, self.capacity - start)
+        out[:first] = self._data[start:start + first]
+        out[first:count] = self._data[:count - first]
+        self._read += count
+        return count
+
+
+class FirEqualizer:
+    """Bass and treble shelves as one linear-phase FIR, applied by FFT overlap-save"""
+
+    def __init__(self, sample_rate, channels, taps=511):
+        self.sample_rate = sample_rate
+        self.taps = taps
+        self._history = np.zeros((taps - 1, channels), dtype=np.float32)
+        self._spectra = {}
+        self.set_gains(0.0, 0.0)
+
+    def set_gains(self, bass_db, treble_db):
+        n = np.arange(self.taps) - (self.taps - 1) / 2
+        window = np.blackman(self.taps)
+
+        def lowpass(cutoff):
+            kernel = np.sinc(2 * cutoff / self.sample_rate * n) * window
+            return kernel / kernel.sum()
+
+        impulse = np.zeros(self.taps)
+        impulse[(self.taps - 1) // 2] = 1.0
+        kernel = (impulse
+                  + (10 ** (bass_db / 20) - 1) * lowpass(config.EQ_BASS_HZ)
+                  + (10 ** (treble_db / 20) - 1) * (impulse - lowpass(config.EQ_TREBLE_HZ)))
+        self.bass_db = bass_db
+        self.treble_db = treble_db
+        self._kernel = kernel
+        self._spectra = {}  # Swapped whole, the callback may be reading the old one
+
+    def process(self, block):
+        frames = len(block)
+        size = 1 << (frames + self.taps - 2).bit_length()
+        spectra = self._spectra
+        spectrum = spectra.get(size)
+        if spectrum is None:
+            spectrum = spectra[size] = np.fft.rfft(self._kernel, size)[:, None]
+        signal = np.concatenate((self._history, block))
+        filtered = np.fft.irfft(np.fft.rfft(signal, size, axis=0) * spectrum, size, axis=0)
+        self._history = signal[frames:]
+        return filtered[self.taps - 1:self.taps - 1 + frames].astype(np.float32)
+
+
+class Voice:
+    """One playing source: an ffmpeg decoder thread feeding a ring buffer the callback mixes from"""
+
+    def __init__(self, engine, source, namehint, start):
+        self.engine = engine
+        self.ring = RingBuffer(int(config.ENGINE_BUFFER_SECONDS * engine.sample_rate), engine.channels)
+        self.gain = 0.0
+        self.target = 1.0
+        self.step = 1.0
+        self.started = False  # Set once the ring holds enough to play without underrunning
+        self.eof = False
+        self.ending = False  # End event posted, the tail is still being mixed
+        self.done = False
+        self.cancelled = threading.Event()
+        self._thread = threading.Thread(target=self._decode, args=(source, namehint, start), name="engine-decoder")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def fade_to(self, target, seconds):
+        self.step = 1.0 / max(1, int(seconds * self.engine.sample_rate))
+        self.target = target
+
+    def stop(self):
+        self.cancelled.set()
+
+    def _decode(self, source, namehint, start):
+        command = ['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error']
+        if start:
+            command += ['-ss', f"{start:.3f}"]
+        if isinstance(source, str):
+            command += ['-i', source]
+        else:
+            command += ['-f', namehint or 'mp3', '-i', 'pipe:0']
+        command += ['-vn', '-f', 'f32le', '-ac', str(self.engine.channels), '-ar', str(self.engine.sample_rate),
+                    'pipe:1']
+        process = subprocess.Popen(command, stdin=None if isinstance(source, str) else subprocess.PIPE,
+                                   stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if not isinstance(source, str):
+            feeder = threading.Thread(target=self._feed, args=(source, process.stdin), name="engine-feeder")
+            feeder.daemon = True
+            feeder.start()
+
+        frame_bytes = 4 * self.engine.channels
+        chunk_bytes = config.ENGINE_BLOCKSIZE * frame_bytes
+        prefill = min(self.ring.capacity, 4 * config.ENGINE_BLOCKSIZE)
+        try:
+            while not self.cancelled.is_set():
+                data = process.stdout.read(chunk_bytes)
+                if not data:
+                    break
+                frames = np.frombuffer(data[:len(data) - len(data) % frame_bytes], dtype=np.float32)
+                if not self.ring.write(frames.reshape(-1, self.engine.channels), self.cancelled):
+                    break
+                if not self.started and self.ring.available() >= prefill:
+                    self.started = True
+        finally:
+            process.kill()
+            process.wait()
+        self.started = True
+        self.eof = True
+
+        # Post the end event early, so the next song starts while this one's tail fades out
+        tail = int(config.ENGINE_CROSSFADE_SECONDS * self.engine.sample_rate)
+        while not self.cancelled.is_set() and self.ring.available() > tail:
+            time.sleep(0.02)
+        if not self.cancelled.is_set():
+            self.ending = True
+            self.engine._post_end_event()
+
+    def _feed(self, source, stdin):
+        try:
+            while not self.cancelled.is_set():
+                data = source.read(64 * 1024)
+                if not data:
+                    break
+                stdin.write(data)
+        except (BrokenPipeError, ValueError, OSError):
+            pass
+        finally:
+            try:
+                stdin.close()
+            except OSError:
+                pass
+
+
+class SoftwareEngine:
+    """Playback engine built on a sounddevice output callback.
+
+    A drop-in for the parts of `pygame.mixer.music` player.py uses: load,
+    play, pause, unpause, stop, get_busy, set_volume and set_endevent.
+    Every source is decoded by ffmpeg into its own NumPy ring buffer; the
+    callback mixes them with vectorized per-block gain ramps, so volume
+    changes, pauses and stops never click, and a new song crossfades with
+    the tail of the one that just ended. A FIR equalizer runs on the mix.
+
+    The callback does a fixed amount of vectorized work per block and mixes
+    at most ENGINE_MAX_VOICES sources. Its duration is measured against the
+    block length; blocks over ENGINE_CALLBACK_BUDGET of it are counted, as
+    are underruns (a playing source whose decoder fell behind).
+    """
+
+    def __init__(self, sample_rate=None, channels=2):
+        self.sample_rate = sample_rate or config.ENGINE_SAMPLE_RATE
+        self.channels = channels
+        self.equalizer = FirEqualizer(self.sample_rate, channels) if config.EQ_ENABLED else None
+        self._voices = ()  # Replaced whole, never mutated, so the callback can iterate safely
+        self._current = None
+        self._loaded = None
+        self._paused = False
+        self._volume = 1.0
+        self._master = 0.0
+        self._endevent = None
+        self._lock = threading.Lock()
+        self._ramp_step = 1.0 / max(1, int(config.ENGINE_RAMP_SECONDS * self.sample_rate))
+        self.underruns = 0
+        self.budget_overruns = 0
+        self.callbacks = 0
+        self.callback_seconds = 0.0
+        self.callback_max = 0.0
+        self._stream = sd.OutputStream(samplerate=self.sample_rate, channels=channels, dtype='float32',
+                                       blocksize=config.ENGINE_BLOCKSIZE, callback=self._callback)
+        self._stream.start()
+
+    # pygame.mixer.music compatible API
+
+    def load(self, source, namehint=''):
+        """Remember what to play; a path, or a file object with a format hint"""
+        with self._lock:
+            self._loaded = (source, namehint)
+
+    def play(self, loops=0, start=0.0, fade_ms=0):
+        with self._lock:
+            if self._loaded is None:
+                raise RuntimeError("No music loaded")
+            previous = self._current
+            voice = Voice(self, self._loaded[0], self._loaded[1], start)
+            if previous is not None and previous.ending and not previous.done:
+                # The last song is finishing on its own: crossfade into the new one
+                previous.fade_to(0.0, config.ENGINE_CROSSFADE_SECONDS)
+                voice.fade_to(1.0, config.ENGINE_CROSSFADE_SECONDS)
+            else:
+                if previous is not None:
+                    self._fade_out(previous)
+                voice.fade_to(1.0, config.ENGINE_RAMP_SECONDS)
+            self._current = voice
+            self._paused = False
+            self._set_voices(voice)
+
+    def stop(self):
+        with self._lock:
+            voice = self._current
+            self._current = None
+            self._paused = False
+            if voice is None or voice.done:
+                return
+            was_busy = not voice.ending
+            self._fade_out(voice)
+            self._set_voices()
+        if was_busy:
+            self._post_end_event()
+
+    def pause(self):
+        self._paused = True
+
+    def unpause(self):
+        self._paused = False
+
+    def get_busy(self):
+        voice = self._current
+        return voice is not None and not voice.ending and not voice.done and not self._paused
+
+    def set_volume(self, volume):
+        self._volume = max(0.0, min(1.0, float(volume)))
+
+    def set_endevent(self, event_type=None):
+        self._endevent = event_type
+
+    # Extras of the software engine
+
+    def set_eq(self, bass_db, treble_db):
+        """Set the bass and treble shelves in dB. Returns False if the equalizer is disabled."""
+        if self.equalizer is None:
+            return False
+        self.equalizer.set_gains(bass_db, treble_db)
+        return True
+
+    def average_callback_ms(self):
+        return 1000 * self.callback_seconds / self.callbacks if self.callbacks else 0.0
+
+    def _fade_out(self, voice):
+        voice.fade_to(0.0, config.ENGINE_RAMP_SECONDS)
+        voice.stop()
+
+    def _set_voices(self, *new_voices):
+        """Drop finished voices and cap how many the callback mixes. Lock must be held."""
+        voices = [voice for voice in self._voices if not voice.done and voice not in new_voices]
+        voices.extend(new_voices)
+        for voice in voices[:-config.ENGINE_MAX_VOICES]:
+            voice.stop()
+            voice.done = True
+        self._voices = tuple(voices[-config.ENGINE_MAX_VOICES:])
+
+    def _post_end_event(self):
+        if self._endevent is not None:
+            try:
+                pygame.event.post(pygame.event.Event(self._endevent))
+            except pygame.error as e:
+                print(f"Could not post music end event: {e}")
+
+    def _callback(self, outdata, frames, time_info, status):
+        started = time.perf_counter()
+        mix = np.zeros((frames, self.channels), dtype=np.float32)
+        block = np.empty((frames, self.channels), dtype=np.float32)
+        master_target = 0.0 if self._paused else self._volume
+
+        if not (self._paused and self._master == 0.0):
+            for voice in self._voices:
+                if voice.done or not voice.started:
+                    continue
+                count = voice.ring.read_into(block, frames)
+                if count < frames:
+                    block[count:] = 0.0
+                    if not voice.eof:
+                        self.underruns += 1
+                    elif not voice.ring.available():
+                        voice.done = True
+                gains = ramp(voice.gain, voice.target, frames, voice.step)
+                voice.gain = float(gains[-1])
+                mix += block * gains[:, None]
+                if voice.gain == 0.0 and voice.target == 0.0:
+                    voice.done = True
+                    voice.stop()
+
+            if self.equalizer is not None:
+                mix = self.equalizer.process(mix)
+
+        gains = ramp(self._master, master_target, frames, self._ramp_step)
+        self._master = float(gains[-1])
+        np.clip(mix * gains[:, None], -1.0, 1.0, out=outdata)
+
+        elapsed = time.perf_counter() - started
+        self.callbacks += 1
+        self.callback_seconds += elapsed
+        self.callback_max = max(self.callback_max, elapsed)
+        if elapsed > config.ENGINE_CALLBACK_BUDGET * frames / self.sample_rate:
+            self.budget_overruns += 1
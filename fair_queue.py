@@ -0,0 +1,108 @@
+import threading
+from collections import deque
+
+
+class FairQueue:
+    """Queue that serves users by deficit round-robin.
+
+    Every user with waiting items takes a turn. On a turn a user is granted
+    `quantum` credit and may dispatch items while their cost fits in the
+    accumulated credit, so one user with fifty requests gets no more
+    dispatches per round than a user with one. Users that already have
+    `max_inflight_per_user` items being processed are skipped until one of
+    them is marked done.
+
+    Nothing blocks in here: event loop tasks poll get_nowait() and wait for
+    their own wakeup after put() and done().
+    """
+
+    def __init__(self, quantum=1.0, max_inflight_per_user=None):
+        self.quantum = quantum
+        self.max_inflight_per_user = max_inflight_per_user
+        self._queues = {}  # user -> deque of (item, cost)
+        self._deficit = {}
+        self._active = deque()  # Round-robin order of users with waiting items
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def put(self, user, item, cost=1.0):
+        """Add an item for a user"""
+        with self._lock:
+            if user not in self._queues:
+                self._queues[user] = deque()
+                self._deficit[user] = self.quantum
+                self._active.append(user)
+            self._queues[user].append((item, cost))
+
+    def get_nowait(self):
+        """Return (user, item) if an item is dispatchable right now, else None. Call done(user) when finished."""
+        with self._lock:
+            user = self._next_user()
+            return self._take(user) if user is not None else None
+
+    def _take(self, user):
+        """Dispatch the head item of a user. Lock must be held."""
+        queue = self._queues[user]
+        item, cost = queue.popleft()
+        self._deficit[user] -= cost
+        if not queue:
+            del self._queues[user]
+            del self._deficit[user]
+            self._active.remove(user)
+        self._inflight[user] = self._inflight.get(user, 0) + 1
+        return user, item
+
+    def _next_user(self):
+        """Rotate through active users until one has credit for its head item"""
+        eligible = [user for user in self._active if not self._at_cap(user)]
+        if not eligible:
+            return None
+
+        # Every eligible user gains quantum per full rotation, so this terminates
+        while True:
+            user = self._active[0]
+            if not self._at_cap(user) and self._deficit[user] >= self._queues[user][0][1]:
+                return user
+            if not self._at_cap(user):
+                self._deficit[user] += self.quantum
+            self._active.rotate(-1)
+
+    def _at_cap(self, user):
+        return (self.max_inflight_per_user is not None
+                and self._inflight.get(user, 0) >= self.max_inflight_per_user)
+
+    def done(self, user):
+        """Mark one dispatched item of a user as finished"""
+        with self._lock:
+            remaining = self._inflight.get(user, 0) - 1
+            if remaining > 0:
+                self._inflight[user] = remaining
+            else:
+                self._inflight.pop(user, None)
+
+    def is_idle(self):
+        """Return True if nothing is waiting or in flight"""
+        with self._lock:
+            return not self._queues and not self._inflight
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(queue) for queue in self._queues.values())
+
+
+def fair_insert_index(songs, requester):
+    """Return where a new song of `requester` goes so the queue interleaves users.
+
+    A song's round is how many songs of the same requester are ahead of it.
+    The new song joins the end of its round, so a user who queues a lot
+    only fills later rounds instead of pushing everyone else back.
+    """
+    seen = {}
+    new_round = sum(1 for song in songs if song.get('requester') == requester)
+    index = 0
+    for i, song in enumerate(songs):
+        song_round = seen.get(song.get('requester'), 0)
+        seen[song.get('requester')] = song_round + 1
+        if song_round <= new_round:
+            index = i + 1
+    return index
@@ -0,0 +1,200 @@
+import os
+import struct
+import threading
+
+try:
+    import numpy as np
+except ImportError:  # Duplicate detection is skipped without numpy
+    np = None
+
+import config
+
+
+FINGERPRINT_MAGIC = b'AFP1\0\0\0\0'
+FINGERPRINT_HEADER = struct.Struct('<8sdI')  # magic, audible length in seconds, hash count
+
+FFT_SIZE = 1024
+HOP = 512  # 64 ms per frame at 8 kHz
+BANDS = ((8, 24), (24, 48), (48, 96), (96, 160), (160, 256), (256, 512))  # FFT bins, roughly octaves
+FAN_OUT = 6  # Later peaks each peak is paired with
+MAX_DT = 63  # Frames between paired peaks, the 6 bits the hash keeps
+
+
+def fingerprint_of(samples, sample_rate, trim=None):
+    """Return (hashes, times, length) for the mono int16 samples of a song.
+
+    The spectrogram of the first FINGERPRINT_SECONDS after the leading
+    silence is reduced to its strongest peak per frequency band and frame,
+    and each peak is paired with the next few: a pair hashes its two
+    frequencies and their distance in frames, and `times` holds the frame
+    of the first peak. Pairs survive re-encoding and volume changes, and
+    comparing hash times rather than absolute positions makes the match
+    indifferent to where each upload starts. `length` is the audible length
+    in seconds, so radio edits and extended mixes are not taken for one another.
+    """
+    start, end = trim or (0.0, None)
+    length = (end or len(samples) / sample_rate) - start
+    window = samples[int(start * sample_rate):int((start + config.FINGERPRINT_SECONDS) * sample_rate)]
+    frames = 1 + (len(window) - FFT_SIZE) // HOP
+    if frames < 2:
+        return np.zeros(0, np.uint32), np.zeros(0, np.uint16), length
+
+    positions = np.arange(FFT_SIZE)[None, :] + HOP * np.arange(frames)[:, None]
+    spectrum = np.abs(np.fft.rfft(window[positions] * np.hanning(FFT_SIZE).astype(np.float32), axis=1))
+    levels = np.log1p(spectrum)
+
+    peak_times, peak_bins = [], []
+    for low, high in BANDS:
+        band = levels[:, low:high]
+        bins = band.argmax(axis=1)
+        strength = band[np.arange(frames), bins]
+        # Only peaks that stand out from the band's usual level, which drops silence and hiss
+        keep = np.flatnonzero(strength > strength.mean() + 0.5 * strength.std())
+        peak_times.append(keep)
+        peak_bins.append(bins[keep] + low)
+    times = np.concatenate(peak_times)
+    bins = np.concatenate(peak_bins)
+    order = np.lexsort((bins, times))
+    times, bins = times[order], bins[order]
+
+    hashes, anchors = [], []
+    for k in range(1, FAN_OUT + 1):
+        dt = times[k:] - times[:-k]
+        paired = (dt > 0) & (dt <= MAX_DT)
+        hashes.append((bins[:-k][paired].astype(np.uint32) << 16) | (bins[k:][paired].astype(np.uint32) << 6)
+                      | dt[paired].astype(np.uint32))
+        anchors.append(times[:-k][paired])
+    return np.concatenate(hashes), np.concatenate(anchors).astype(np.uint16), length
+
+
+def fingerprint_path_for(song_path):
+    """Return the sidecar path the fingerprint of a song is stored at"""
+    return f"{song_path}.fp"
+
+
+def save_fingerprint(song_path, fingerprint):
+    hashes, times, length = fingerprint
+    with open(fingerprint_path_for(song_path), 'wb') as f:
+        f.write(FINGERPRINT_HEADER.pack(FINGERPRINT_MAGIC, length, len(hashes)))
+        hashes.astype('<u4').tofile(f)
+        times.astype('<u2').tofile(f)
+
+
+def load_fingerprint(song_path):
+    """Load the sidecar fingerprint of a song, or None if it is missing or stale"""
+    fingerprint_path = fingerprint_path_for(song_path)
+    try:
+        if os.path.getmtime(fingerprint_path) < os.path.getmtime(song_path):
+            return None
+        with open(fingerprint_path, 'rb') as f:
+            magic, length, count = FINGERPRINT_HEADER.unpack(f.read(FINGERPRINT_HEADER.size))
+            if magic != FINGERPRINT_MAGIC:
+                return None
+            hashes = np.fromfile(f, dtype='<u4', count=count)
+            times = np.fromfile(f, dtype='<u2', count=count)
+    except (OSError, struct.error, ValueError):
+        return None
+    if len(hashes) != count or len(times) != count:
+        return None
+    return hashes, times, length
+
+
+class FingerprintIndex:
+    """Fingerprints of the songs on disk, searched for other uploads of a recording.
+
+    Every hash of every song is kept in one array sorted by hash, so a
+    lookup is a binary search per query hash. A song matches when enough of
+    its hashes line up with the query's at one and the same time offset.
+    The songs of the audio cache are loaded from their sidecars on first
+    use; downloads are added as they are transcoded. Lookups run on the
+    core executor.
+    """
+
+    def __init__(self):
+        self._songs = {}  # path -> (hashes, times, length)
+        self._lock = threading.Lock()
+        self._sorted = None  # (hashes, song numbers, times, paths, lengths), rebuilt after changes
+        self._loaded = False
+
+    def add(self, song_path, fingerprint):
+        """Index a song on disk and store its fingerprint next to it"""
+        save_fingerprint(song_path, fingerprint)
+        with self._lock:
+            self._songs[song_path] = fingerprint
+            self._sorted = None
+
+    def forget(self, song_path):
+        with self._lock:
+            if self._songs.pop(song_path, None) is not None:
+                self._sorted = None
+
+    def match(self, fingerprint):
+        """Return the path of a song on disk that is the same recording, or None"""
+        hashes, times, length = fingerprint
+        if len(hashes) < config.FINGERPRINT_MIN_MATCHES:
+            return None
+        self._load_cache()
+        with self._lock:
+            if self._sorted is None:
+                self._sorted = self._build()
+            all_hashes, songs, all_times, paths, lengths = self._sorted
+        if not paths:
+            return None
+
+        left = np.searchsorted(all_hashes, hashes, 'left')
+        counts = np.searchsorted(all_hashes, hashes, 'right') - left
+        total = int(counts.sum())
+        if total == 0:
+            return None
+        # Every (query hash, indexed hash) pair with equal hashes, as positions into the sorted arrays
+        firsts = np.repeat(left, counts)
+        positions = firsts + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        offsets = all_times[positions].astype(np.int64) - np.repeat(times, counts).astype(np.int64)
+        keys = songs[positions].astype(np.int64) << 20 | (offsets + (1 << 16))
+        candidates, votes = np.unique(keys, return_counts=True)
+        best = int(votes.argmax())
+        song = int(candidates[best] >> 20)
+        if votes[best] < max(config.FINGERPRINT_MIN_MATCHES, config.FINGERPRINT_MIN_RATIO * len(hashes)):
+            return None
+        if abs(lengths[song] - length) > config.FINGERPRINT_LENGTH_TOLERANCE:
+            return None
+        if not os.path.exists(paths[song]):
+            self.forget(paths[song])
+            return None
+        return paths[song]
+
+    def _build(self):
+        paths = list(self._songs)
+        fingerprints = [self._songs[path] for path in paths]
+        if not paths:
+            return None, None, None, [], []
+        hashes = np.concatenate([fingerprint[0] for fingerprint in fingerprints])
+        songs = np.concatenate([np.full(len(fingerprint[0]), number, np.int32)
+                                for number, fingerprint in enumerate(fingerprints)])
+        times = np.concatenate([fingerprint[1] for fingerprint in fingerprints])
+        order = np.argsort(hashes, kind='stable')
+        return hashes[order], songs[order], times[order], paths, [fingerprint[2] for fingerprint in fingerprints]
+
+    def _load_cache(self):
+        """Index the fingerprints stored in the audio cache, once"""
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+        if not os.path.isdir(config.CACHE_DIR):
+            return
+        loaded = {}
+        for entry in os.scandir(config.CACHE_DIR):
+            if entry.name.endswith('.mp3'):
+                fingerprint = load_fingerprint(entry.path)
+                if fingerprint is not None:
+                    loaded[entry.path] = fingerprint
+        with self._lock:
+            self._songs = {**loaded, **self._songs}
+            self._sorted = None
+
+    def __len__(self):
+        return len(self._songs)
+
+
+fingerprints = FingerprintIndex()
@@ -0,0 +1,109 @@
+import threading
+
+import config
+
+
+def estimated_bytes(fmt, duration):
+    """Best guess of a format's download size"""
+    size = fmt.get('filesize') or fmt.get('filesize_approx')
+    if size:
+        return size
+    bitrate = fmt.get('abr') or fmt.get('tbr')
+    if bitrate and duration:
+        return int(bitrate * 1000 / 8 * duration)
+    return None
+
+
+def codec_rank(fmt):
+    """Position of a format's codec in CODEC_PREFERENCE, lower is better"""
+    acodec = (fmt.get('acodec') or '').lower()
+    for rank, codec in enumerate(config.CODEC_PREFERENCE):
+        if acodec.startswith(codec):
+            return rank
+    return len(config.CODEC_PREFERENCE)
+
+
+def select_audio_format(formats, target_kbps, duration=None):
+    """Pick the smallest audio-only format meeting the target bitrate.
+
+    Among formats at or above `target_kbps` the smallest download wins, with
+    codec preference breaking ties. If nothing reaches the target, the
+    highest bitrate audio-only format is used. Returns None if the video
+    has no audio-only formats.
+    """
+    audio_only = [fmt for fmt in formats
+                  if fmt.get('vcodec') == 'none' and fmt.get('acodec') not in (None, 'none')]
+    if not audio_only:
+        return None
+
+    # Every format has the same duration, so bitrate ranks size when sizes are unknown
+    if duration or all(fmt.get('filesize') or fmt.get('filesize_approx') for fmt in audio_only):
+        def size_key(fmt):
+            size = estimated_bytes(fmt, duration)
+            return (size if size is not None else float('inf'), codec_rank(fmt))
+    else:
+        def size_key(fmt):
+            return (fmt.get('abr') or fmt.get('tbr') or float('inf'), codec_rank(fmt))
+
+    meeting_target = [fmt for fmt in audio_only if (fmt.get('abr') or 0) >= target_kbps]
+    if meeting_target:
+        return min(meeting_target, key=size_key)
+    return max(audio_only, key=lambda fmt: ((fmt.get('abr') or 0), -codec_rank(fmt)))
+
+
+class FetchStats:
+    """Bytes fetched per track, the formats chosen and the measured download speed"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.tracks = 0
+        self.bytes_fetched = 0
+        self.bytes_best = 0  # What the largest audio-only format would have cost
+        self.throughput = None  # Exponentially weighted bytes per second
+
+    def record(self, bytes_fetched, bytes_best, seconds):
+        with self._lock:
+            self.tracks += 1
+            self.bytes_fetched += bytes_fetched
+            self.bytes_best += max(bytes_best or 0, bytes_fetched)
+            if seconds > 0:
+                speed = bytes_fetched / seconds
+                self.throughput = speed if self.throughput is None else 0.7 * self.throughput + 0.3 * speed
+
+    def bytes_saved(self):
+        return self.bytes_best - self.bytes_fetched
+
+
+fetch_stats = FetchStats()
+
+
+def choose_target_kbps(queue_depth):
+    """Return the bitrate tier to fetch at, stepping down when the queue is deep or the network slow"""
+    tier = 0
+    if queue_depth >= config.FORMAT_DEEP_QUEUE:
+        tier += 1
+    if queue_depth >= 2 * config.FORMAT_DEEP_QUEUE:
+        tier += 1
+    if fetch_stats.throughput is not None and fetch_stats.throughput < config.FORMAT_SLOW_NETWORK_BPS:
+        tier += 1
+    return config.FORMAT_TIERS_KBPS[min(tier, len(config.FORMAT_TIERS_KBPS) - 1)]
+
+
+def format_selector(target_kbps):
+    """Build a yt-dlp `format` callable applying the bitrate policy"""
+    def select(ctx):
+        formats = ctx['formats']
+        chosen = select_audio_format(formats, target_kbps)
+        if chosen is None:
+            # No audio-only stream (rare), fall back to the best combined format
+            chosen = max(formats, key=lambda fmt: fmt.get('quality') or 0) if formats else None
+        if chosen is not None:
+            yield chosen
+    return select
+
+
+def largest_audio_bytes(formats, duration):
+    """Size of the biggest audio-only format, used to report what the policy saved"""
+    sizes = [estimated_bytes(fmt, duration) or 0 for fmt in formats
+             if fmt.get('vcodec') == 'none' and fmt.get('acodec') not in (None, 'none')]
+    return max(sizes, default=0)
@@ -0,0 +1,193 @@
+import io
+import os
+import struct
+from array import array
+
+
+# MPEG audio header lookup tables (Layer III only, which is all we transcode to)
+BITRATES_KBPS = {
+    'mpeg1': [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 0],
+    'mpeg2': [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160, 0],
+}
+SAMPLE_RATES = {
+    'mpeg1': [44100, 48000, 32000],
+    'mpeg2': [22050, 24000, 16000],
+    'mpeg2.5': [11025, 12000, 8000],
+}
+
+INDEX_MAGIC = b'MP3IDX1\0'
+INDEX_HEADER = struct.Struct('<8sIII')  # magic, sample rate, samples per frame, frame count
+
+
+class FrameIndex:
+    """Byte offset of every audio frame in an mp3 file.
+
+    All frames of a Layer III stream hold the same number of samples, so the
+    frame that contains a timestamp is found by a single division and the
+    seek itself is a lookup in the offsets array.
+    """
+
+    def __init__(self, path, sample_rate, samples_per_frame, offsets):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.samples_per_frame = samples_per_frame
+        self.offsets = offsets
+        self.frame_duration = samples_per_frame / sample_rate
+        self.duration = len(offsets) * self.frame_duration
+
+    def frame_at(self, seconds):
+        """Return the number of the frame playing at the given time"""
+        frame = int(max(0.0, seconds) / self.frame_duration)
+        return min(frame, len(self.offsets) - 1)
+
+    def time_of(self, frame):
+        """Return the start time of a frame in seconds"""
+        return frame * self.frame_duration
+
+    def open_at(self, seconds):
+        """Open the track positioned at the frame containing `seconds`.
+
+        Returns the file object and the exact start time of that frame.
+        """
+        frame = self.frame_at(seconds)
+        return OffsetFile(self.path, self.offsets[frame]), self.time_of(frame)
+
+    def save(self, index_path):
+        """Write the index to a sidecar file"""
+        with open(index_path, 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, self.sample_rate, self.samples_per_frame, len(self.offsets)))
+            self.offsets.tofile(f)
+
+
+class OffsetFile(io.RawIOBase):
+    """Read-only view of a file that starts at a byte offset.
+
+    The mixer sees the frame at the offset as the beginning of the stream,
+    which lets it start decoding there without scanning from byte zero.
+    """
+
+    def __init__(self, path, offset):
+        super().__init__()
+        self._file = open(path, 'rb')
+        self._offset = offset
+        self._file.seek(offset)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self._file.readinto(buffer)
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos += self._offset
+        return self._file.seek(pos, whence) - self._offset
+
+    def tell(self):
+        return self._file.tell() - self._offset
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+def index_path_for(song_path):
+    """Return the sidecar path the index of a song is stored at"""
+    return f"{song_path}.idx"
+
+
+def _parse_header(header):
+    """Decode a 4 byte frame header, returning (frame length, sample rate, samples per frame) or None"""
+    b1, b2 = header[1], header[2]
+    if header[0] != 0xFF or (b1 & 0xE0) != 0xE0:
+        return None
+
+    version_bits = (b1 >> 3) & 0x03
+    layer_bits = (b1 >> 1) & 0x03
+    bitrate_index = (b2 >> 4) & 0x0F
+    rate_index = (b2 >> 2) & 0x03
+    padding = (b2 >> 1) & 0x01
+
+    if version_bits == 1 or layer_bits != 1 or rate_index == 3:  # Reserved version, not Layer III
+        return None
+    version = {3: 'mpeg1', 2: 'mpeg2', 0: 'mpeg2.5'}[version_bits]
+    bitrate = BITRATES_KBPS['mpeg1' if version == 'mpeg1' else 'mpeg2'][bitrate_index] * 1000
+    if not bitrate:
+        return None
+
+    sample_rate = SAMPLE_RATES[version][rate_index]
+    samples_per_frame = 1152 if version == 'mpeg1' else 576
+    frame_length = (samples_per_frame // 8) * bitrate // sample_rate + padding
+    return frame_length, sample_rate, samples_per_frame
+
+
+def _skip_id3v2(data):
+    """Return the offset of the first byte after a leading ID3v2 tag"""
+    if len(data) >= 10 and data[:3] == b'ID3':
+        size = (data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9]
+        footer = 10 if data[5] & 0x10 else 0
+        return 10 + size + footer
+    return 0
+
+
+def build_index(song_path):
+    """Scan an mp3 file once and return its FrameIndex"""
+    with open(song_path, 'rb') as f:
+        data = f.read()
+
+    offsets = array('I')
+    sample_rate = samples_per_frame = None
+    pos = _skip_id3v2(data)
+    end = len(data) - 4
+
+    while pos <= end:
+        parsed = _parse_header(data[pos:pos + 4])
+        if parsed is None or (sample_rate and parsed[1] != sample_rate):
+            pos = data.find(b'\xff', pos + 1)  # Lost sync, scan forward for the next frame header
+            if pos == -1:
+                break
+            continue
+
+        frame_length, rate, spf = parsed
+        if sample_rate is None:
+            sample_rate, samples_per_frame = rate, spf
+            # The first frame may be a Xing/Info header that holds no audio
+            if b'Xing' in data[pos:pos + 64] or b'Info' in data[pos:pos + 64]:
+                pos += frame_length
+                continue
+
+        offsets.append(pos)
+        pos += frame_length
+
+    if not offsets:
+        raise ValueError(f"No mp3 frames found in {song_path}")
+    return FrameIndex(song_path, sample_rate, samples_per_frame, offsets)
+
+
+def load_index(song_path):
+    """Load the sidecar index of a song, or None if it is missing or stale"""
+    index_path = index_path_for(song_path)
+    try:
+        if os.path.getmtime(index_path) < os.path.getmtime(song_path):
+            return None
+        with open(index_path, 'rb') as f:
+            magic, sample_rate, samples_per_frame, count = INDEX_HEADER.unpack(f.read(INDEX_HEADER.size))
+            if magic != INDEX_MAGIC:
+                return None
+            offsets = array('I')
+            offsets.fromfile(f, count)
+    except (OSError, EOFError, struct.error):
+        return None
+    return FrameIndex(song_path, sample_rate, samples_per_frame, offsets)
+
+
+def load_or_build_index(song_path):
+    """Return the index of a song, building and saving it if needed"""
+    index = load_index(song_path)
+    if index is None:
+        index = build_index(song_path)
+        index.save(index_path_for(song_path))
+    return index
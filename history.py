@@ -0,0 +1,76 @@
+import sqlite3
+import threading
+import time
+
+import config
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS plays (
+    video_id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    url TEXT NOT NULL,
+    play_count INTEGER NOT NULL DEFAULT 0,
+    last_played REAL NOT NULL
+);
+"""
+
+
+class PlayHistory:
+    """Play counts and recency of every YouTube track that was played"""
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()  # One connection per thread
+        self._connect().executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def record_play(self, video_id, title, url):
+        conn = self._connect()
+        conn.execute(
+            """INSERT INTO plays (video_id, title, url, play_count, last_played) VALUES (?, ?, ?, 1, ?)
+               ON CONFLICT(video_id) DO UPDATE SET play_count = play_count + 1,
+                   last_played = excluded.last_played, title = excluded.title, url = excluded.url""",
+            (video_id, title, url, time.time())
+        )
+        conn.commit()
+
+    def top_tracks(self, limit):
+        """Return the most likely next requests: play count decayed by time since last play"""
+        half_life = config.HISTORY_HALF_LIFE_DAYS * 86400
+        now = time.time()
+        rows = self._connect().execute('SELECT * FROM plays').fetchall()
+        scored = sorted(rows, key=lambda row: row['play_count'] * 0.5 ** ((now - row['last_played']) / half_life),
+                        reverse=True)
+        return [{'id': row['video_id'], 'title': row['title'], 'url': row['url']} for row in scored[:limit]]
+
+
+_history = None
+_history_lock = threading.Lock()
+
+
+def get_history():
+    """Return the shared PlayHistory, opening the database on first use"""
+    global _history
+    with _history_lock:
+        if _history is None:
+            _history = PlayHistory(config.HISTORY_DB)
+        return _history
+
+
+def record_play(song_info):
+    """Count a play of a song, if it came from YouTube"""
+    if not song_info.get('video_id'):
+        return
+    try:
+        get_history().record_play(song_info['video_id'], song_info['title'], song_info['url'])
+    except sqlite3.Error as e:
+        print(f"Could not record play of '{song_info['title']}': {e}")
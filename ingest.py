@@ -0,0 +1,553 @@
+import asyncio
+import os
+import random
+import subprocess
+import threading
+import time
+
+import yt_dlp
+
+import config
+from audio import start_low_priority_async
+from audio_cache import cached_song_path, cache_stats
+from core import core
+from fair_queue import FairQueue
+from formats import choose_target_kbps
+from frame_index import build_index, load_or_build_index
+from player import enqueue_song, enqueue_songs, fill_placeholder, release_auto_play_chance
+from player import remove_entry, remove_placeholder
+from fingerprint import fingerprint_of, fingerprints
+from silence import decode_for_analysis, find_trim, load_trim, save_trim
+from song_queue import queue_snapshot
+from suggest import remember
+from tracing import current_trace_id, instant, span
+from youtube import fetch_audio, song_path_for
+
+
+# Download errors that no amount of retrying will fix
+PERMANENT_ERRORS = (
+    'video unavailable', 'private video', 'sign in to confirm your age', 'members-only',
+    'copyright', 'has been removed', 'not available in your country', 'unsupported url',
+)
+
+
+class JobCancelled(Exception):
+    """Raised inside a worker task when every request for its job was cancelled"""
+
+
+class IngestRequest:
+    """One requester waiting for a song. Requests for the same video share a single IngestJob."""
+
+    def __init__(self, job, has_auto_play_chance, requester, on_failed=None, on_ready=None, on_cancelled=None,
+                 entry_id=None):
+        self.job = job
+        self.has_auto_play_chance = has_auto_play_chance
+        self.requester = requester
+        self.on_failed = on_failed  # Called with a reason string if the download fails for good
+        self.on_ready = on_ready  # Called with the song_info once its placeholder is playable
+        self.on_cancelled = on_cancelled
+        self.entry_id = entry_id  # The queue placeholder this request fills
+        self.title = job.title
+        self.trace_id = current_trace_id.get()  # Carried by hand from here on, workers outlive requests
+
+
+class IngestJob:
+    """A single song moving through the ingest pipeline"""
+
+    def __init__(self, video_info, requester):
+        self.video_info = video_info
+        self.requester = requester  # Whose fetch slot the job occupies
+        self.requests = []  # Live IngestRequests, the job is cancelled when this empties
+        self.cancelled = threading.Event()
+        self.title = video_info['title']
+        self.song_path = song_path_for(video_info)
+        self.fetched_path = None
+        self.format_info = None
+        self.requested_at = time.monotonic()
+        self.trace_id = current_trace_id.get()  # Of the request that started the job
+
+    def check_cancelled(self, progress=None):
+        """yt-dlp progress hook that aborts the download once the job is cancelled"""
+        if self.cancelled.is_set():
+            raise yt_dlp.utils.DownloadCancelled(f"Download of '{self.title}' cancelled")
+
+
+class IngestPipeline:
+    """Two stage ingest: network bound fetch workers feed CPU bound transcode workers.
+
+    Both stages are worker tasks on the core event loop. Fetch workers run
+    yt-dlp on the core executor, transcode workers await ffmpeg as an
+    asyncio subprocess, so a transcode costs a process but no thread. The
+    queue between the stages is bounded, so when transcoding falls behind
+    the fetch workers wait instead of piling more raw files onto the disk.
+
+    Jobs are dispatched to fetch workers by deficit round-robin over the
+    requesting users, so a burst from one user cannot starve the others.
+
+    Requests for a video that is already being ingested join the running
+    job instead of downloading it twice. A job is cancelled as soon as its
+    last request is, which aborts the download or transcode in progress.
+
+    Every request holds its place in the song queue from the start as a
+    pending placeholder, which is filled in place once the song is ready
+    and removed if the request fails or is cancelled.
+    """
+
+    def __init__(self, fetch_workers=None, transcode_workers=None, transcode_backlog=None):
+        self.fetch_workers = fetch_workers or config.FETCH_WORKERS
+        self.transcode_workers = transcode_workers or config.TRANSCODE_WORKERS
+        self.fetch_queue = FairQueue(max_inflight_per_user=config.MAX_INFLIGHT_PER_USER)
+        self.transcode_queue = asyncio.Queue(maxsize=transcode_backlog or config.TRANSCODE_BACKLOG)
+        self._fetch_wakeup = asyncio.Event()  # Set when a job may have become dispatchable
+        self._jobs = {}  # video id -> IngestJob still being fetched or transcoded
+        self._jobs_lock = threading.Lock()
+        self._workers = []
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start the worker tasks of both stages on the core loop"""
+        with self._start_lock:
+            if self._workers:
+                return
+            self._workers = [core.keep_running(self._fetch_loop, "Fetch worker") for _ in range(self.fetch_workers)]
+            self._workers += [core.keep_running(self._transcode_loop, "Transcode worker")
+                              for _ in range(self.transcode_workers)]
+            print(f"Ingest pipeline started: {self.fetch_workers} fetch, {self.transcode_workers} transcode workers")
+
+    def submit(self, video_info, has_auto_play_chance, requester, on_failed=None, on_ready=None, on_cancelled=None,
+               entry_id=None):
+        """Queue a video for download and transcoding, or return None if the requester is at their limit.
+
+        Reserves a placeholder at the end of the song queue, unless the
+        caller already reserved one and passes its `entry_id` (the limit is
+        not checked again then). Returns an IngestRequest that can be
+        passed to cancel().
+        """
+        self.start()
+        if entry_id is None and self.waiting_count(requester) >= config.MAX_QUEUED_PER_USER:
+            return None
+
+        # Prefetched songs are already transcoded and indexed, queue them right away
+        cached_path = cached_song_path(video_info.get('id'))
+        if cached_path:
+            request = IngestRequest(IngestJob(video_info, requester), has_auto_play_chance, requester,
+                                    on_failed, on_ready, on_cancelled, entry_id)
+            cache_stats.record_hit()
+            instant('ingest.cache_hit', title=request.title)
+            song_info = self._song_info(request.job, cached_path, requester)
+            if entry_id is None:
+                instant('queue.ready', title=request.title)
+                enqueue_song(song_info, has_auto_play_chance)
+                if on_ready:
+                    on_ready(song_info)
+            else:
+                self._deliver(request, song_info, downloaded=False)
+            remember(request.title, video_info)
+            return request
+
+        if entry_id is None:
+            placeholder = placeholder_for(video_info, requester)
+            enqueue_songs([placeholder], False)
+            entry_id = placeholder['id']
+
+        with self._jobs_lock:
+            job = self._jobs.get(video_info.get('id'))
+            is_new = job is None
+            if is_new:
+                job = IngestJob(video_info, requester)
+                if video_info.get('id'):
+                    self._jobs[video_info['id']] = job
+            request = IngestRequest(job, has_auto_play_chance, requester, on_failed, on_ready, on_cancelled, entry_id)
+            job.requests.append(request)
+
+        instant('ingest.submit', title=job.title, joined=not is_new)
+        if is_new:
+            self.fetch_queue.put(requester, job)
+            core.call(self._fetch_wakeup.set)  # submit() runs on any thread, the event belongs to the loop
+        else:
+            print(f"Joined the running download of '{job.title}'")
+        return request
+
+    def cancel(self, request):
+        """Withdraw a request. Returns False if its song was already queued or failed."""
+        with self._jobs_lock:
+            job = request.job
+            if request not in job.requests:
+                return False
+            job.requests.remove(request)
+            if not job.requests:
+                job.cancelled.set()
+                if self._jobs.get(job.video_info.get('id')) is job:
+                    del self._jobs[job.video_info['id']]
+        remove_placeholder(request.entry_id)
+        release_auto_play_chance(request.has_auto_play_chance)
+        print(f"Cancelled request for '{request.title}'")
+        if request.on_cancelled:
+            request.on_cancelled()
+        return True
+
+    def cancel_requester(self, requester):
+        """Cancel every pending download of a requester and return the cancelled requests"""
+        cancelled = []
+        for request in self.pending_requests(requester):
+            if self.cancel(request):
+                cancelled.append(request)
+        return cancelled
+
+    def cancel_entry(self, entry_id):
+        """Cancel the request filling a queue placeholder. Returns False if none is pending."""
+        with self._jobs_lock:
+            jobs = list(self._jobs.values())
+            requests = [request for job in jobs for request in job.requests if request.entry_id == entry_id]
+        return any(self.cancel(request) for request in requests)
+
+    def pending_requests(self, requester):
+        """Return the requests of a requester that are still downloading or transcoding"""
+        with self._jobs_lock:
+            jobs = list(self._jobs.values())
+            return [request for job in jobs for request in job.requests if request.requester == requester]
+
+    def is_idle(self):
+        """Return True if no user download is waiting, fetching or transcoding"""
+        return self.fetch_queue.is_idle() and self.transcode_queue.empty()
+
+    def waiting_count(self, requester):
+        """Return how many songs of a requester are queued, counting placeholders of downloads"""
+        return sum(1 for song in queue_snapshot().songs if song.get('requester') == requester)
+
+    async def _next_fetch(self):
+        """Wait until the fair queue dispatches a job"""
+        while True:
+            dispatched = self.fetch_queue.get_nowait()
+            if dispatched is not None:
+                return dispatched
+            # No await between the check and the clear, so no wakeup is lost
+            self._fetch_wakeup.clear()
+            await self._fetch_wakeup.wait()
+
+    def _fetch_done(self, job):
+        """Free the job's fetch slot, which may let a waiting job of the same requester through"""
+        self.fetch_queue.done(job.requester)
+        self._fetch_wakeup.set()
+
+    async def _fetch_loop(self):
+        while True:
+            _, job = await self._next_fetch()
+            try:
+                if job.cancelled.is_set():
+                    raise JobCancelled()
+                job.fetched_path, job.format_info = await self._fetch_with_retry(job)
+            except (JobCancelled, yt_dlp.utils.DownloadCancelled):
+                # The .part file is left for a later request to resume, startup clears the rest
+                print(f"Stopped downloading '{job.title}', nobody is waiting for it")
+                self._fetch_done(job)
+                continue
+            except Exception as e:
+                print(f"Error downloading '{job.title}': {e}")
+                self._fail(job, str(e))
+                continue
+
+            # Waits while the transcode backlog is full (backpressure)
+            await self.transcode_queue.put(job)
+
+    async def _fetch_with_retry(self, job):
+        """Fetch a job's audio, retrying transient errors with exponential backoff and jitter.
+
+        yt-dlp continues from the .part file of the previous attempt, so a
+        retry only downloads what is missing. The bitrate target is fixed
+        for the whole job so every attempt asks for the same stream.
+        """
+        target_kbps = choose_target_kbps(len(self.fetch_queue))
+        for attempt in range(config.FETCH_RETRIES + 1):
+            try:
+                with span('ingest.fetch', job.trace_id, title=job.title, attempt=attempt, kbps=target_kbps):
+                    return await core.run_blocking(fetch_audio, job.video_info, target_kbps=target_kbps,
+                                                   extra_opts={'progress_hooks': [job.check_cancelled]})
+            except yt_dlp.utils.DownloadCancelled:
+                raise
+            except Exception as e:
+                if attempt == config.FETCH_RETRIES or not is_transient(e):
+                    raise
+                delay = backoff_delay(attempt)
+                print(f"Download of '{job.title}' failed ({e}), retry {attempt + 1}/{config.FETCH_RETRIES} "
+                      f"in {delay:.1f}s")
+                if await _wait_for(job.cancelled, delay):
+                    raise JobCancelled()
+
+    async def _transcode_loop(self):
+        while True:
+            job = await self.transcode_queue.get()
+            try:
+                if job.cancelled.is_set():
+                    raise JobCancelled()
+                with span('ingest.transcode', job.trace_id, title=job.title):
+                    song_path = await transcode_analysed(job.fetched_path, job.song_path, cancelled=job.cancelled)
+                if song_path != job.song_path:
+                    print(f"'{job.title}' is the same recording as {song_path}, reusing that file")
+                with span('ingest.index', job.trace_id):
+                    song_info = await core.run_blocking(self._song_info, job, song_path, job.requester)
+                # Requests that were cancelled meanwhile are gone; ones that joined meanwhile are served too
+                requests = self._finish(job)
+                for request in requests:
+                    self._deliver(request, dict(song_info, requester=request.requester), downloaded=True)
+                if requests:
+                    cache_stats.record_miss(time.monotonic() - job.requested_at)
+                    remember(job.title, job.video_info)
+                elif song_path == job.song_path:
+                    _remove_quietly(job.song_path)  # Cancelled while the transcode was finishing
+            except JobCancelled:
+                print(f"Stopped transcoding '{job.title}', nobody is waiting for it")
+                self._fetch_done(job)
+            except Exception as e:
+                print(f"Error transcoding '{job.title}': {e}")
+                self._fail(job, f"Transcoding failed: {e}")
+            else:
+                self._fetch_done(job)
+            finally:
+                _remove_quietly(job.fetched_path)
+
+    def _deliver(self, request, song_info, downloaded):
+        """Fill a request's placeholder with its ready song"""
+        if request.trace_id is not None:
+            song_info = dict(song_info, trace_id=request.trace_id)  # Followed on to playback
+        instant('queue.ready', request.trace_id, title=request.title)
+        if not fill_placeholder(request.entry_id, song_info, downloaded):
+            print(f"'{request.title}' is ready but was removed from the queue meanwhile")
+        # Filling the placeholder starts playback if the player is idle
+        release_auto_play_chance(request.has_auto_play_chance)
+        if request.on_ready:
+            try:
+                request.on_ready(song_info)
+            except Exception as e:
+                print(f"Error reporting ready song '{request.title}': {e}")
+
+    def _finish(self, job):
+        """Detach a job from the running set and return the requests still waiting for it"""
+        with self._jobs_lock:
+            if self._jobs.get(job.video_info.get('id')) is job:
+                del self._jobs[job.video_info['id']]
+            requests, job.requests = job.requests, []
+        return requests
+
+    def _song_info(self, job, song_path, requester):
+        song_info = {
+            'title': job.title,
+            'path': song_path,
+            'requester': requester,
+            'video_id': job.video_info.get('id'),
+            'url': job.video_info['url'],
+        }
+        if job.trace_id is not None:
+            song_info['trace_id'] = job.trace_id
+        if job.format_info:
+            song_info['format'] = job.format_info
+        try:
+            # Built once here so seeks during playback are a table lookup
+            index = load_or_build_index(song_path)
+            song_info['frame_index'] = index
+            song_info['duration'] = index.duration
+        except Exception as e:
+            print(f"Could not index '{job.title}', seeking will be slower: {e}")
+        trim = load_trim(song_path)
+        if trim is not None:
+            song_info['trim_start'], song_info['trim_end'] = trim
+        return song_info
+
+    def _fail(self, job, reason):
+        """Give up on a job and tell everyone waiting for it"""
+        for request in self._finish(job):
+            remove_placeholder(request.entry_id)
+            release_auto_play_chance(request.has_auto_play_chance)
+            if request.on_failed:
+                try:
+                    request.on_failed(reason)
+                except Exception as e:
+                    print(f"Error reporting failed download of '{job.title}': {e}")
+        self._fetch_done(job)
+
+
+def is_transient(error):
+    """Return True if a download error is worth retrying (network trouble rather than a dead video)"""
+    cause = getattr(error, 'exc_info', None)
+    if cause and isinstance(cause[1], yt_dlp.utils.ExtractorError) and cause[1].expected:
+        return False
+    message = str(error).lower()
+    return not any(marker in message for marker in PERMANENT_ERRORS)
+
+
+def backoff_delay(attempt):
+    """Seconds to wait before retry `attempt`: exponential, capped, with full jitter"""
+    return random.uniform(0, min(config.FETCH_BACKOFF_MAX, config.FETCH_BACKOFF_BASE * 2 ** attempt))
+
+
+async def _wait_for(event, timeout):
+    """Wait up to `timeout` seconds for a threading.Event without blocking the loop. Returns whether it is set."""
+    deadline = time.monotonic() + timeout
+    while not event.is_set():
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        await asyncio.sleep(min(0.25, remaining))
+    return True
+
+
+async def transcode_audio(source_path, song_path, cancelled=None):
+    """Transcode a fetched audio file to mp3 with a low priority, single threaded ffmpeg.
+
+    If the `cancelled` event is set while ffmpeg runs, the process is killed
+    and JobCancelled is raised.
+    """
+    temp_path = f"{song_path}.part"
+    command = [
+        'ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-y',
+        '-threads', '1',
+        '-i', source_path,
+        '-vn', '-codec:a', 'libmp3lame', '-b:a', config.TRANSCODE_BITRATE,
+        '-f', 'mp3', temp_path,
+    ]
+
+    with span('ffmpeg.transcode'):
+        process = await start_low_priority_async(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        communicate = asyncio.ensure_future(process.communicate())
+        try:
+            while True:
+                done, _ = await asyncio.wait({communicate}, timeout=0.25)
+                if done:
+                    _, stderr = communicate.result()
+                    break
+                if cancelled is not None and cancelled.is_set():
+                    raise JobCancelled()
+        except (JobCancelled, asyncio.CancelledError):
+            if process.returncode is None:
+                process.kill()
+            await asyncio.shield(communicate)
+            _remove_quietly(temp_path)
+            raise
+
+    if process.returncode != 0:
+        _remove_quietly(temp_path)
+        raise RuntimeError(f"ffmpeg exited with {process.returncode}: {stderr.decode(errors='replace').strip()}")
+    os.replace(temp_path, song_path)
+
+
+async def transcode_analysed(source_path, song_path, cancelled=None, reuse=True):
+    """Transcode a fetched file while analysing it, and return the path of the playable song.
+
+    Alongside the transcode, the source is decoded once at a low rate: the
+    silence at its ends is measured for trimming, and its fingerprint is
+    looked up among the songs on disk. If another upload of the same
+    recording is there and `reuse` is set, the transcode is stopped and
+    that song's path is returned instead of `song_path`.
+    """
+    transcoding = asyncio.ensure_future(transcode_audio(source_path, song_path, cancelled=cancelled))
+    trim = fingerprint = None
+    try:
+        with span('ffmpeg.decode_for_analysis'):
+            samples = await decode_for_analysis(source_path)
+        if samples is not None:
+            if config.TRIM_ENABLED:
+                trim = find_trim(samples, config.ANALYSIS_SAMPLE_RATE)
+            if config.FINGERPRINT_ENABLED:
+                with span('fingerprint.match'):
+                    fingerprint = await core.run_blocking(fingerprint_of, samples, config.ANALYSIS_SAMPLE_RATE,
+                                                          trim)
+                    duplicate = await core.run_blocking(fingerprints.match, fingerprint) if reuse else None
+                if duplicate is not None and duplicate != song_path:
+                    transcoding.cancel()
+                    await asyncio.gather(transcoding, return_exceptions=True)
+                    return duplicate
+        await transcoding
+    except BaseException:
+        transcoding.cancel()
+        raise
+
+    # Stored once the song exists, so the sidecars are newer than it
+    if trim is not None:
+        save_trim(song_path, trim)
+    if fingerprint is not None:
+        await core.run_blocking(fingerprints.add, song_path, fingerprint)
+    return song_path
+
+
+def _remove_quietly(path):
+    if path and os.path.exists(path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            print(f"Could not remove {path}: {e}")
+
+
+pipeline = IngestPipeline()
+
+
+def start_ingest():
+    """Start the ingest pipeline worker threads"""
+    pipeline.start()
+
+
+def placeholder_for(video_info, requester):
+    """Build the pending queue entry that holds a video's place while it is ingested"""
+    return {
+        'status': 'pending',
+        'title': video_info['title'],
+        'path': song_path_for(video_info),
+        'requester': requester,
+        'video_id': video_info.get('id'),
+        'url': video_info['url'],
+    }
+
+
+def enqueue_local_track(track, has_auto_play_chance, requester=config.LOCAL_REQUESTER):
+    """Queue a track from the local library directly, with no download or transcode.
+
+    Returns None if the requester already has MAX_QUEUED_PER_USER songs waiting.
+    """
+    if pipeline.waiting_count(requester) >= config.MAX_QUEUED_PER_USER:
+        return None
+
+    song_info = local_song_info(track, requester)
+    if current_trace_id.get() is not None:
+        song_info['trace_id'] = current_trace_id.get()
+    instant('queue.ready', title=song_info['title'])
+    enqueue_song(song_info, has_auto_play_chance)
+    return song_info
+
+
+def local_song_info(track, requester):
+    """Build the queue entry of a local library track"""
+    song_info = dict(track, requester=requester)
+    if song_info['path'].lower().endswith('.mp3'):
+        try:
+            # Kept in memory only, we never write next to the user's music
+            index = build_index(song_info['path'])
+            song_info['frame_index'] = index
+            song_info['duration'] = index.duration
+        except Exception as e:
+            print(f"Could not index '{song_info['title']}', seeking will be slower: {e}")
+    return song_info
+
+
+def submit_download(video_info, has_auto_play_chance, requester=config.LOCAL_REQUESTER, on_failed=None,
+                    on_ready=None, on_cancelled=None, entry_id=None):
+    """Queue a video for download, transcoding and enqueueing.
+
+    The song holds its queue slot as a pending placeholder meanwhile, pass
+    `entry_id` to fill a placeholder reserved beforehand. `on_failed(reason)`
+    is called from a worker thread if the download fails for good and
+    `on_ready(song_info)` once the song is playable. Returns None if the
+    requester already has MAX_QUEUED_PER_USER songs waiting.
+    """
+    return pipeline.submit(video_info, has_auto_play_chance, requester, on_failed, on_ready, on_cancelled,
+                           entry_id)
+
+
+def remove_queued(entry_id):
+    """Remove a queue entry, cancelling its download if it is still pending. Returns False if it was not queued."""
+    if pipeline.cancel_entry(entry_id):
+        return True  # Cancelling took the placeholder out of the queue
+    return remove_entry(entry_id) is not None
+
+
+def cancel_downloads(requester):
+    """Cancel every pending download of a requester and return their titles"""
+    return [request.title for request in pipeline.cancel_requester(requester)]
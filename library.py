@@ -0,0 +1,189 @@
+import os
+import sqlite3
+import threading
+import time
+
+import mutagen
+
+import config
+from suggest import remember
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tracks (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    mtime REAL NOT NULL,
+    size INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    artist TEXT NOT NULL DEFAULT '',
+    album TEXT NOT NULL DEFAULT '',
+    duration REAL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+    title, artist, album, content='tracks', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS tracks_ai AFTER INSERT ON tracks BEGIN
+    INSERT INTO tracks_fts(rowid, title, artist, album) VALUES (new.id, new.title, new.artist, new.album);
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_ad AFTER DELETE ON tracks BEGIN
+    INSERT INTO tracks_fts(tracks_fts, rowid, title, artist, album) VALUES ('delete', old.id, old.title, old.artist, old.album);
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_au AFTER UPDATE ON tracks BEGIN
+    INSERT INTO tracks_fts(tracks_fts, rowid, title, artist, album) VALUES ('delete', old.id, old.title, old.artist, old.album);
+    INSERT INTO tracks_fts(rowid, title, artist, album) VALUES (new.id, new.title, new.artist, new.album);
+END;
+"""
+
+
+class MusicLibrary:
+    """SQLite full-text catalog of the audio files in the configured library folders.
+
+    Rescans are incremental: only files whose mtime or size changed have
+    their tags read again, and rows for deleted files are dropped.
+    """
+
+    def __init__(self, db_path, folders):
+        self.db_path = db_path
+        self.folders = folders
+        self._local = threading.local()  # One connection per thread
+        self._scan_lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10)
+            conn.row_factory = sqlite3.Row
+            conn.execute('PRAGMA journal_mode=WAL')
+            self._local.conn = conn
+        return conn
+
+    def scan(self):
+        """Bring the catalog up to date with the library folders"""
+        with self._scan_lock:
+            started = time.perf_counter()
+            conn = self._connect()
+            known = {row['path']: (row['mtime'], row['size'])
+                     for row in conn.execute('SELECT path, mtime, size FROM tracks')}
+            seen = set()
+            updated = 0
+
+            for folder in self.folders:
+                for root, _, filenames in os.walk(folder):
+                    for filename in filenames:
+                        if not filename.lower().endswith(config.LIBRARY_EXTENSIONS):
+                            continue
+                        path = os.path.abspath(os.path.join(root, filename))
+                        try:
+                            stat = os.stat(path)
+                        except OSError:
+                            continue
+                        seen.add(path)
+                        if known.get(path) == (stat.st_mtime, stat.st_size):
+                            continue
+                        self._index_file(conn, path, stat)
+                        updated += 1
+
+            removed = [(path,) for path in known if path not in seen]
+            conn.executemany('DELETE FROM tracks WHERE path = ?', removed)
+            conn.commit()
+            print(f"Library scan: {len(seen)} tracks, {updated} updated, {len(removed)} removed "
+                  f"in {time.perf_counter() - started:.2f}s")
+
+    def _index_file(self, conn, path, stat):
+        title, artist, album, duration = read_tags(path)
+        conn.execute(
+            """INSERT INTO tracks (path, mtime, size, title, artist, album, duration)
+               VALUES (?, ?, ?, ?, ?, ?, ?)
+               ON CONFLICT(path) DO UPDATE SET mtime = excluded.mtime, size = excluded.size,
+                   title = excluded.title, artist = excluded.artist, album = excluded.album,
+                   duration = excluded.duration""",
+            (path, stat.st_mtime, stat.st_size, title, artist, album, duration)
+        )
+
+    def search(self, query, limit=5):
+        """Return the best matching local tracks as song dicts, ready to enqueue"""
+        match = _fts_query(query)
+        if not match:
+            return []
+        try:
+            rows = self._connect().execute(
+                """SELECT tracks.* FROM tracks_fts JOIN tracks ON tracks.id = tracks_fts.rowid
+                   WHERE tracks_fts MATCH ? ORDER BY bm25(tracks_fts) LIMIT ?""",
+                (match, limit)
+            ).fetchall()
+        except sqlite3.Error as e:
+            print(f"Library search failed for '{query}': {e}")
+            return []
+
+        tracks = [{
+            'title': f"{row['artist']} - {row['title']}" if row['artist'] else row['title'],
+            'path': row['path'],
+            'duration': row['duration'],
+            'local': True,
+        } for row in rows]
+        for track in tracks:
+            remember(track['title'], track)
+        return tracks
+
+
+def read_tags(path):
+    """Return (title, artist, album, duration) of an audio file, falling back to the filename"""
+    title = os.path.splitext(os.path.basename(path))[0]
+    artist = album = ''
+    duration = None
+    try:
+        audio = mutagen.File(path, easy=True)
+        if audio is not None:
+            tags = audio.tags or {}
+            title = (tags.get('title') or [title])[0]
+            artist = (tags.get('artist') or [''])[0]
+            album = (tags.get('album') or [''])[0]
+            duration = getattr(audio.info, 'length', None)
+    except Exception as e:
+        print(f"Could not read tags of {path}: {e}")
+    return title, artist, album, duration
+
+
+def _fts_query(query):
+    """Turn free text into an FTS5 query matching every word as a prefix"""
+    words = [''.join(ch for ch in word if ch.isalnum()) for word in query.split()]
+    return ' '.join(f'"{word}"*' for word in words if word)
+
+
+library = None
+
+
+def start_library(scan=True):
+    """Open the catalog and keep it rescanned in the background.
+
+    The child processes of the split layout pass scan=False: they only
+    search the catalog, which the engine process keeps up to date.
+    """
+    global library
+    if not config.LIBRARY_DIRS:
+        return
+    library = MusicLibrary(config.LIBRARY_DB, config.LIBRARY_DIRS)
+    if not scan:
+        return
+
+    def rescan_loop():
+        while True:
+            try:
+                library.scan()
+            except Exception as e:
+                print(f"Library scan failed: {e}")
+            time.sleep(config.LIBRARY_RESCAN_INTERVAL)
+
+    thread = threading.Thread(target=rescan_loop, name="library-scan")
+    thread.daemon = True
+    thread.start()
+
+
+def search_library(query, limit=5):
+    """Search the local library, returning [] when no library is configured"""
+    if library is None:
+        return []
+    return library.search(query, limit)
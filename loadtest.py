@@ -0,0 +1,293 @@
+"""Synthetic load for the Discord commands, run entirely offline.
+
+Drives the !play, !skip and !queue callbacks of discord_bot.py with fake
+contexts from many simulated users, at a configurable rate and mix, through
+the real queue, ingest pipeline, ffmpeg and (silent) playback. Searches and
+downloads are stubbed: every request resolves to a song from a synthetic
+catalog, and "downloading" copies a generated tone after a simulated delay.
+
+    python loadtest.py --rate 20 --users 50 --duration 60 --mix play=3,skip=1,queue=6
+
+Prints command latency percentiles, throughput, thread count and memory
+every --interval seconds, and a per-command summary at the end. Nothing is
+written outside a temporary directory.
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+
+import config  # Imported first so main() can redirect its paths before other modules read them
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline load test of the Discord command handlers")
+    parser.add_argument('--duration', type=float, default=60, help="Seconds to generate load for")
+    parser.add_argument('--rate', type=float, default=20, help="Commands per second, Poisson arrivals")
+    parser.add_argument('--users', type=int, default=50, help="Simulated Discord users")
+    parser.add_argument('--mix', default='play=3,skip=1,queue=6', help="Relative weights of the commands")
+    parser.add_argument('--catalog', type=int, default=200, help="Distinct songs requests are drawn from")
+    parser.add_argument('--search-delay', type=float, default=0.3, help="Mean simulated search time in seconds")
+    parser.add_argument('--fetch-delay', type=float, default=0.5, help="Mean simulated download time in seconds")
+    parser.add_argument('--track-seconds', type=float, default=20, help="Length of the generated track")
+    parser.add_argument('--interval', type=float, default=5, help="Seconds between progress reports")
+    parser.add_argument('--verbose', action='store_true', help="Keep the application's own output")
+    args = parser.parse_args()
+    args.mix = parse_mix(args.mix)
+    return args
+
+
+def parse_mix(text):
+    """Parse "play=3,skip=1" into {'play': 3.0, 'skip': 1.0}"""
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in COMMANDS:
+            raise SystemExit(f"Unknown command in --mix: {name.strip()} (known: {', '.join(COMMANDS)})")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+COMMANDS = {
+    'play': lambda ctx, args: {'query': f"load test song {random.randrange(args.catalog)}"},
+    'skip': lambda ctx, args: {},
+    'queue': lambda ctx, args: {},
+}
+
+
+class FakeAuthor:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = self.display_name = f"user{user_id}"
+        self.mention = f"<@{user_id}>"
+
+
+class FakeMessage:
+    async def edit(self, **kwargs):
+        pass
+
+    async def delete(self):
+        pass
+
+
+class FakeContext:
+    """Just enough of a commands.Context for the command callbacks"""
+
+    def __init__(self, user_id):
+        self.author = FakeAuthor(user_id)
+        self.channel = None
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeMessage()
+
+
+def make_track(path, seconds):
+    """Generate the one mp3 every stubbed download returns"""
+    subprocess.run([
+        'ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-y',
+        '-f', 'lavfi', '-i', f"sine=frequency=440:duration={seconds}",
+        '-codec:a', 'libmp3lame', '-b:a', '128k', path,
+    ], check=True)
+
+
+def install_stubs(args, track_path):
+    """Replace the network with the synthetic catalog"""
+    import batch
+    import discord_bot
+    import ingest
+
+    def resolve(query):
+        if args.search_delay:
+            time.sleep(random.expovariate(1 / args.search_delay))
+        number = query.rsplit(' ', 1)[-1]
+        return {'title': f"Load test song {number}", 'url': f"https://example.invalid/{number}", 'id': f"load{number}"}
+
+    def fetch_audio(video_info, directory=None, extra_opts=None, queue_depth=0, target_kbps=None):
+        deadline = time.monotonic() + random.expovariate(1 / args.fetch_delay) if args.fetch_delay else 0
+        hooks = (extra_opts or {}).get('progress_hooks', [])
+        while True:
+            for hook in hooks:
+                hook({'status': 'downloading'})  # Lets cancellation abort the "download"
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(min(0.1, deadline - time.monotonic()))
+        fetched_path = os.path.join(directory or config.DOWNLOADS_DIR, f"{video_info['id']}.src.mp3")
+        shutil.copyfile(track_path, fetched_path)
+        return fetched_path, None
+
+    batch.resolve = discord_bot.resolve = resolve
+    ingest.fetch_audio = fetch_audio
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def rss_mb():
+    """Resident memory of this process in MiB (Linux)"""
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+class LoadRecorder:
+    """Latencies of finished commands, for interval and final reports"""
+
+    def __init__(self):
+        self.samples = []  # (finished at, command, seconds, ok)
+        self.in_flight = 0
+        self.peak_threads = 0
+        self._lock = threading.Lock()
+
+    def record(self, command, seconds, ok):
+        with self._lock:
+            self.samples.append((time.monotonic(), command, seconds, ok))
+
+    def since(self, start):
+        with self._lock:
+            return [sample for sample in self.samples if sample[0] >= start]
+
+
+async def generate_load(args, recorder, commands_by_name):
+    """Fire commands at Poisson arrivals for args.duration seconds, then wait for stragglers"""
+    names = list(args.mix)
+    weights = [args.mix[name] for name in names]
+    contexts = [FakeContext(user_id) for user_id in range(1, args.users + 1)]
+    tasks = set()
+
+    async def run(name, ctx):
+        recorder.in_flight += 1
+        started = time.perf_counter()
+        ok = True
+        try:
+            await commands_by_name[name].callback(ctx, **COMMANDS[name](ctx, args))
+        except Exception as e:
+            ok = False
+            print(f"!{name} failed: {e}", file=sys.__stderr__)
+        recorder.record(name, time.perf_counter() - started, ok)
+        recorder.in_flight -= 1
+
+    end = time.monotonic() + args.duration
+    while time.monotonic() < end:
+        await asyncio.sleep(random.expovariate(args.rate))
+        task = asyncio.ensure_future(run(random.choices(names, weights)[0], random.choice(contexts)))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    if tasks:
+        await asyncio.wait(tasks)
+
+
+def report_interval(recorder, start, seconds, out):
+    samples = recorder.since(start)
+    latencies = sorted(sample[2] for sample in samples)
+    errors = sum(1 for sample in samples if not sample[3])
+    threads = threading.active_count()
+    recorder.peak_threads = max(recorder.peak_threads, threads)
+    print(f"{time.strftime('%H:%M:%S')}  {len(samples) / seconds:7.1f} cmd/s  "
+          f"p50 {1000 * percentile(latencies, 0.50):7.1f} ms  p95 {1000 * percentile(latencies, 0.95):7.1f} ms  "
+          f"p99 {1000 * percentile(latencies, 0.99):7.1f} ms  errors {errors:3d}  in flight {recorder.in_flight:4d}  "
+          f"threads {threads:3d}  rss {rss_mb():7.1f} MiB  queue {len(config.queued_songs):4d}",
+          file=out, flush=True)
+
+
+def report_summary(recorder, elapsed, out):
+    print("\ncommand     count    cmd/s   p50 ms   p95 ms   p99 ms   max ms  errors", file=out)
+    for name in sorted({sample[1] for sample in recorder.samples}) + [None]:
+        samples = [sample for sample in recorder.samples if name is None or sample[1] == name]
+        latencies = sorted(1000 * sample[2] for sample in samples)
+        errors = sum(1 for sample in samples if not sample[3])
+        print(f"{name or 'all':<10} {len(samples):6d} {len(samples) / elapsed:8.1f} {percentile(latencies, 0.50):8.1f} "
+              f"{percentile(latencies, 0.95):8.1f} {percentile(latencies, 0.99):8.1f} "
+              f"{latencies[-1] if latencies else 0:8.1f} {errors:7d}", file=out)
+    peak_threads = max(recorder.peak_threads, threading.active_count())
+    print(f"\nPeak threads {peak_threads}, final rss {rss_mb():.1f} MiB", file=out)
+
+
+def main():
+    args = parse_args()
+    out = sys.stdout
+    workdir = tempfile.mkdtemp(prefix="loadtest-")
+
+    # Everything the app writes goes to the temporary directory
+    config.DOWNLOADS_DIR = os.path.join(workdir, 'downloads')
+    config.CACHE_DIR = os.path.join(workdir, 'cache')
+    config.PCM_CACHE_DIR = os.path.join(workdir, 'pcm_cache')
+    config.HISTORY_DB = os.path.join(workdir, 'history.db')
+    config.LIBRARY_DB = os.path.join(workdir, 'library.db')
+    config.DISCORD_TOKEN = None
+
+    import pygame
+    from core import core
+    from discord_bot import bot
+    from ingest import cancel_downloads, start_ingest
+    from player import handle_music_end_event, handle_next_song_event, handle_track_end_event, start_player
+
+    pygame.init()
+    pygame.display.set_mode((1, 1))
+    pygame.mixer.init()
+    start_player()
+    config.ensure_downloads_directory()
+
+    track_path = os.path.join(workdir, 'track.mp3')
+    make_track(track_path, args.track_seconds)
+    install_stubs(args, track_path)
+    start_ingest()
+
+    print(f"Load test: {args.rate:g} cmd/s from {args.users} users for {args.duration:g}s, "
+          f"mix {', '.join(f'{name}={weight:g}' for name, weight in args.mix.items())}", file=out, flush=True)
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+
+    recorder = LoadRecorder()
+    commands_by_name = {name: bot.get_command(name) for name in args.mix}
+    started = time.monotonic()
+    load = core.submit(generate_load(args, recorder, commands_by_name))
+
+    # Stand in for the UI's event loop: the player needs its timer and end events handled
+    last_report = started
+    frame_clock = pygame.time.Clock()
+    try:
+        while not load.done():
+            for event in pygame.event.get():
+                if event.type == config.MUSIC_END:
+                    handle_music_end_event()
+                elif event.type == config.NEXT_SONG_EVENT:
+                    handle_next_song_event()
+                elif event.type == config.TRACK_END_EVENT:
+                    handle_track_end_event()
+            now = time.monotonic()
+            if now - last_report >= args.interval:
+                report_interval(recorder, last_report, now - last_report, out)
+                last_report = now
+            frame_clock.tick(60)  # Same frame rate as the UI
+        load.result()
+        report_summary(recorder, time.monotonic() - started, out)
+    finally:
+        for user_id in range(1, args.users + 1):
+            cancel_downloads(user_id)  # Nothing left to write into the directory about to go
+        core.stop()
+        pygame.quit()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
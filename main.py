@@ -1,7 +1,15 @@
-import pygame
 from pygame import mixer
-from config import ensure_downloads_directory, MUSIC_END
+from api import start_api
+from config import ensure_downloads_directory, PROCESS_LAYOUT
+from control import LocalControl
+from core import start_core
 from discord_bot import start_discord_bot
+from ingest import start_ingest
+from library import start_library
+from pcm_cache import start_pcm_cache
+from player import start_player
+from prefetch import start_prefetcher
+from processes import run_engine
 from ui import MusicPlayerUI
 
 
@@ -10,18 +18,38 @@ def main():
     # Initialize pygame mixer
     mixer.init()
 
-    # Set up custom pygame events
-    pygame.mixer.music.set_endevent(MUSIC_END)
+    # Create the music backend, which reports song ends as MUSIC_END events
+    start_player()
 
     # Ensure downloads directory exists and is clean
     ensure_downloads_directory()
 
-    # Start Discord bot in background thread
-    start_discord_bot()
+    # One event loop runs the bot, searches, ingest and prefetch
+    start_core()
 
-    # Create and run the UI
-    ui = MusicPlayerUI()
-    ui.run()
+    # Start the download/transcode workers
+    start_ingest()
+
+    # Index the local music library in the background
+    start_library()
+
+    # Warm the audio cache with likely requests while idle
+    start_prefetcher()
+    start_pcm_cache()
+
+    # Serve the local HTTP/WebSocket control API on the core loop
+    start_api()
+
+    if PROCESS_LAYOUT == 'split':
+        # The UI and the Discord bot run in processes of their own, restarted if they crash
+        run_engine()
+    else:
+        # Start the Discord bot on the core loop
+        start_discord_bot()
+
+        # Create and run the UI
+        ui = MusicPlayerUI(LocalControl())
+        ui.run()
 
 
 if __name__ == "__main__":
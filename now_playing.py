@@ -0,0 +1,125 @@
+import asyncio
+import time
+
+import config
+
+
+class NowPlayingMessage:
+    """A message in one channel that is edited in place instead of re-sent.
+
+    `notify()` marks the message stale. Any number of notifications inside
+    one interval collapse into a single edit, and edits are spaced at least
+    `interval` seconds apart. The channel only needs an async
+    `send(embed=...)` returning an object with an async `edit(embed=...)`,
+    so a fake channel that records edits works as well as a Discord one.
+    """
+
+    def __init__(self, channel, render, interval, clock=time.monotonic):
+        self.channel = channel
+        self.render = render
+        self.interval = interval
+        self.clock = clock
+        self.message = None
+        self.edit_count = 0
+        self.notify_count = 0
+        self._dirty = False
+        self._last_edit = None
+        self._flusher = None
+
+    def notify(self):
+        """Request an update. Must be called on the event loop."""
+        self.notify_count += 1
+        self._dirty = True
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush())
+
+    async def _flush(self):
+        # Keep going while notifications arrive during a wait or an edit
+        while self._dirty:
+            if self._last_edit is not None:
+                wait = self._last_edit + self.interval - self.clock()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            self._dirty = False
+            await self._publish()
+            self._last_edit = self.clock()
+
+    async def _publish(self):
+        embed = self.render()
+        if self.message is not None:
+            try:
+                await self.message.edit(embed=embed)
+                self.edit_count += 1
+                return
+            except Exception as e:
+                # Message deleted or no longer editable, post a fresh one
+                print(f"Now playing message edit failed, re-sending: {e}")
+                self.message = None
+        try:
+            self.message = await self.channel.send(embed=embed)
+        except Exception as e:
+            print(f"Could not send now playing message: {e}")
+
+    def close(self):
+        """Stop pending updates"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+        self._dirty = False
+
+
+class NowPlayingBoard:
+    """Live now playing messages for every channel that opted in.
+
+    Track and pause changes come from the state of `control` (a LocalControl
+    or RemoteControl); while a song plays a ticker also refreshes the
+    progress bar every `progress_interval` seconds.
+    """
+
+    WATCHED_FIELDS = ['currently_playing', 'is_playing']
+
+    def __init__(self, render, control, interval=None, progress_interval=None):
+        self.render = render
+        self.control = control
+        self.interval = interval or config.NOW_PLAYING_EDIT_INTERVAL
+        self.progress_interval = progress_interval or config.NOW_PLAYING_PROGRESS_INTERVAL
+        self.messages = {}  # channel id -> NowPlayingMessage
+        self._loop = None
+        self._ticker = None
+
+    def enable(self, channel):
+        """Start a live message in a channel. Must be called on the event loop."""
+        if self._loop is None:
+            self._loop = asyncio.get_running_loop()
+            self.control.subscribe(self._on_state_change, self.WATCHED_FIELDS)
+
+        live_message = self.messages.get(channel.id)
+        if live_message is None:
+            live_message = NowPlayingMessage(channel, self.render, self.interval)
+            self.messages[channel.id] = live_message
+        live_message.notify()
+
+        if self._ticker is None or self._ticker.done():
+            self._ticker = asyncio.ensure_future(self._tick())
+        return live_message
+
+    def disable(self, channel):
+        """Stop updating the live message in a channel"""
+        live_message = self.messages.pop(channel.id, None)
+        if live_message is not None:
+            live_message.close()
+        return live_message is not None
+
+    def notify_all(self):
+        for live_message in self.messages.values():
+            live_message.notify()
+
+    def _on_state_change(self, change):
+        # Runs on the state dispatcher or status watcher thread, hop over to the bot's loop
+        if self.messages:
+            self._loop.call_soon_threadsafe(self.notify_all)
+
+    async def _tick(self):
+        while self.messages:
+            await asyncio.sleep(self.progress_interval)
+            if self.control.state.is_playing:
+                self.notify_all()
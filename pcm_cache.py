@@ -0,0 +1,258 @@
+import hashlib
+import io
+import mmap
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import threading
+from collections import OrderedDict
+
+import config
+from audio import start_low_priority
+
+
+def cache_key(song_info):
+    """Key a song by its video id, or its path for local tracks"""
+    return song_info.get('video_id') or song_info['path']
+
+
+def wav_header(sample_rate, channels, bytes_per_sample, data_size):
+    """Build a canonical 44 byte PCM WAV header"""
+    block_align = channels * bytes_per_sample
+    return struct.pack(
+        '<4sI4s4sIHHIIHH4sI',
+        b'RIFF', 36 + data_size, b'WAVE',
+        b'fmt ', 16, 1, channels, sample_rate, sample_rate * block_align, block_align, 8 * bytes_per_sample,
+        b'data', data_size,
+    )
+
+
+class MappedWavFile(io.RawIOBase):
+    """A WAV file made of a generated header followed by a range of a memory map.
+
+    Handing pygame a view that starts at the right sample frame makes a seek
+    into a cached track free: nothing is decoded or copied up front, and the
+    OS pages the samples in as the mixer reads them.
+    """
+
+    def __init__(self, header, data, start, end):
+        self._header = header
+        self._data = data
+        self._start = start
+        self._size = len(header) + end - start
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = min(len(buffer), self._size - self._pos)
+        if count <= 0:
+            return 0
+        written = 0
+        header_length = len(self._header)
+        if self._pos < header_length:
+            chunk = self._header[self._pos:self._pos + count]
+            buffer[:len(chunk)] = chunk
+            written = len(chunk)
+        if written < count:
+            offset = self._start + self._pos + written - header_length
+            buffer[written:count] = self._data[offset:offset + count - written]
+        self._pos += count
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._pos = max(0, offset)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+
+class PcmTrack:
+    """A decoded track in the cache, memory-mapped read only"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as wav_file:
+            # The map keeps its own handle to the file, so this one can be closed
+            self.map = mmap.mmap(wav_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.map)
+        self._parse_header()
+
+    def _parse_header(self):
+        if self.map[0:4] != b'RIFF' or self.map[8:12] != b'WAVE':
+            raise ValueError(f"Not a WAV file: {self.path}")
+        pos = 12
+        fmt = None
+        while pos + 8 <= self.size:
+            chunk_id, chunk_size = struct.unpack_from('<4sI', self.map, pos)
+            if chunk_id == b'fmt ':
+                fmt = struct.unpack_from('<HHIIHH', self.map, pos + 8)
+            elif chunk_id == b'data':
+                self.data_offset = pos + 8
+                self.data_size = min(chunk_size, self.size - self.data_offset)
+                break
+            pos += 8 + chunk_size + (chunk_size & 1)
+        else:
+            raise ValueError(f"No data chunk in {self.path}")
+        if fmt is None or fmt[0] != 1:
+            raise ValueError(f"Not 16 bit PCM: {self.path}")
+        _, self.channels, self.sample_rate, _, self.block_align, bits = fmt
+        self.bytes_per_sample = bits // 8
+        self.duration = self.data_size / (self.sample_rate * self.block_align)
+
+    def open_at(self, seconds):
+        """Return (file object, exact start in seconds) for playback from `seconds`"""
+        frame = min(int(seconds * self.sample_rate), self.data_size // self.block_align)
+        start = self.data_offset + frame * self.block_align
+        end = self.data_offset + self.data_size
+        header = wav_header(self.sample_rate, self.channels, self.bytes_per_sample, end - start)
+        return MappedWavFile(header, self.map, start, end), frame / self.sample_rate
+
+
+class PcmCache:
+    """Decoded PCM of the current and last few tracks, for instant replay, back and seeks.
+
+    A track is decoded to a WAV file by a background ffmpeg once it starts
+    playing, then memory-mapped. Memory use stays bounded: at most
+    `max_tracks` tracks and `max_bytes` are mapped, least recently played
+    first out, and mapped pages are clean so the OS can drop them any time.
+    The directory is cleared on startup; this is a hot set, not a cache
+    that outlives the process.
+    """
+
+    def __init__(self, directory, max_tracks, max_bytes):
+        self.directory = directory
+        self.max_tracks = max_tracks
+        self.max_bytes = max_bytes
+        self._tracks = OrderedDict()  # key -> PcmTrack, most recently played last
+        self._decoding = set()
+        self._lock = threading.Lock()
+        self._jobs = queue.SimpleQueue()
+        self._thread = None
+        self.hits = 0
+        self.misses = 0
+
+    def start(self):
+        if self._thread is None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            os.makedirs(self.directory, exist_ok=True)
+            self._thread = threading.Thread(target=self._decode_loop, name="pcm-decoder")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def contains(self, song_info):
+        with self._lock:
+            return cache_key(song_info) in self._tracks
+
+    def open_at(self, song_info, seconds):
+        """Return (file object, exact start) from the cache, or None if the track is not decoded"""
+        key = cache_key(song_info)
+        with self._lock:
+            track = self._tracks.get(key)
+            if track is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._tracks.move_to_end(key)
+        return track.open_at(seconds)
+
+    def warm(self, song_info):
+        """Decode a track in the background unless it is cached or being decoded"""
+        if self._thread is None:
+            return
+        key = cache_key(song_info)
+        with self._lock:
+            if key in self._tracks or key in self._decoding:
+                if key in self._tracks:
+                    self._tracks.move_to_end(key)
+                return
+            self._decoding.add(key)
+        self._jobs.put((key, song_info['path']))
+
+    def _decode_loop(self):
+        while True:
+            key, source_path = self._jobs.get()
+            try:
+                track = self._decode(key, source_path)
+            except Exception as e:
+                print(f"Could not decode {source_path} into the PCM cache: {e}")
+                track = None
+            with self._lock:
+                self._decoding.discard(key)
+                if track is not None:
+                    self._tracks[key] = track
+                    self._evict()
+
+    def _decode(self, key, source_path):
+        wav_path = os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest()[:16] + ".wav")
+        temp_path = f"{wav_path}.part"
+        command = [
+            'ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-y',
+            '-threads', '1', '-i', source_path,
+            '-vn', '-map_metadata', '-1', '-fflags', '+bitexact',
+            '-codec:a', 'pcm_s16le', '-ar', str(config.PCM_SAMPLE_RATE), '-ac', '2',
+            '-f', 'wav', temp_path,
+        ]
+        process = start_low_priority(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        _, stderr = process.communicate()
+        if process.returncode != 0:
+            _remove(temp_path)
+            raise RuntimeError(f"ffmpeg exited with {process.returncode}: {stderr.decode(errors='replace').strip()}")
+        os.replace(temp_path, wav_path)
+        return PcmTrack(wav_path)
+
+    def _evict(self):
+        """Unmap least recently played tracks over the limits, never the one playing. Lock must be held."""
+        playing = config.state.currently_playing
+        keep = cache_key(playing) if playing else None
+        for key in list(self._tracks):
+            if len(self._tracks) <= self.max_tracks and self._mapped_bytes() <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            track = self._tracks.pop(key)
+            # Views still held by the mixer keep the mapping alive until they are dropped
+            _remove(track.path)
+
+    def _mapped_bytes(self):
+        return sum(track.size for track in self._tracks.values())
+
+    def resident_bytes(self):
+        """Bytes of decoded audio currently mapped"""
+        with self._lock:
+            return self._mapped_bytes()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._tracks)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass  # Still mapped on Windows, the directory is cleared on the next start
+
+
+pcm_cache = PcmCache(config.PCM_CACHE_DIR, config.PCM_CACHE_TRACKS, config.PCM_CACHE_MAX_BYTES)
+
+
+def start_pcm_cache():
+    """Start the background decoder of the PCM cache"""
+    if config.PCM_CACHE_ENABLED:
+        pcm_cache.start()
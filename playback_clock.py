@@ -0,0 +1,57 @@
+import threading
+import time
+
+
+class PlaybackClock:
+    """Monotonic playback position that survives pause, resume and seek.
+
+    `mixer.music.get_pos` only counts time since the last `play` call and
+    drifts across pauses, so the position is tracked here instead.
+    """
+
+    STOPPED = 'stopped'
+    RUNNING = 'running'
+    PAUSED = 'paused'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._state = self.STOPPED
+        self._base = 0.0  # Position when the clock last started running or was paused
+        self._started_at = 0.0
+
+    def start(self, position=0.0):
+        """Start running from the given position"""
+        with self._lock:
+            self._base = position
+            self._started_at = time.monotonic()
+            self._state = self.RUNNING
+
+    def pause(self):
+        """Freeze the position"""
+        with self._lock:
+            if self._state == self.RUNNING:
+                self._base += time.monotonic() - self._started_at
+                self._state = self.PAUSED
+
+    def resume(self):
+        """Continue running from the frozen position"""
+        with self._lock:
+            if self._state == self.PAUSED:
+                self._started_at = time.monotonic()
+                self._state = self.RUNNING
+
+    def stop(self):
+        """Reset the position to zero"""
+        with self._lock:
+            self._base = 0.0
+            self._state = self.STOPPED
+
+    def is_paused(self):
+        return self._state == self.PAUSED
+
+    def position(self):
+        """Return the current playback position in seconds"""
+        with self._lock:
+            if self._state == self.RUNNING:
+                return self._base + time.monotonic() - self._started_at
+            return self._base
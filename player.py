@@ -1,18 +1,211 @@
 import os
+import time
 import pygame
 from pygame import mixer
 import config
+from fair_queue import fair_insert_index
+from frame_index import index_path_for
+from history import record_play
+from pcm_cache import pcm_cache
+from playback_clock import PlaybackClock
+from fingerprint import fingerprint_path_for
+from silence import trim_path_for
+from song_queue import is_ready, new_entry_id, publish_queue, queue_snapshot
+from suggest import remember
+from tracing import instant, span
+
+
+# Real playback position, independent of mixer.music.get_pos
+clock = PlaybackClock()
+
+
+def _create_music_backend():
+    """Return the software engine if configured and available, else pygame's mixer.music"""
+    if config.AUDIO_ENGINE == 'sounddevice':
+        try:
+            from engine import SoftwareEngine
+            return SoftwareEngine()
+        except Exception as e:
+            print(f"Software audio engine unavailable, using the pygame mixer: {e}")
+    return mixer.music
+
+
+# Everything that plays audio goes through this, both backends share the mixer.music API. Only the
+# process that plays audio creates it (start_player), so other processes may import this module.
+music = None
+
+
+def start_player():
+    """Create the music backend and route its end event to MUSIC_END. Call once after mixer.init()."""
+    global music
+    if music is None:
+        music = _create_music_backend()
+        music.set_endevent(config.MUSIC_END)
+    return music
+
+
+# When the player started waiting for a pending song at the head of the queue
+_head_wait_since = None
+
+
+def enqueue_song(song_info, has_auto_play_chance):
+    """Add a playable song to the queue and start playback if it holds the auto-play chance"""
+    enqueue_songs([song_info], has_auto_play_chance)
+
+
+def enqueue_songs(song_infos, has_auto_play_chance, downloaded=()):
+    """Add songs to the queue in order under one lock hold, so nothing lands between them.
+
+    Songs in `downloaded` have their files deleted by cleanup once they are
+    no longer needed. Entries get a stable `id`; placeholders for songs
+    still being ingested come with `status` 'pending'. The auto-play chance
+    starts playback if one of the songs is ready to play, and so does a
+    ready song added while the player is idle without it.
+    """
+
+    # Thread-safe queue modifications with lock
+    with config.queue_lock:
+        config.downloaded_songs.extend(downloaded)
+        for song_info in song_infos:
+            song_info.setdefault('id', new_entry_id())
+            song_info.setdefault('status', 'ready')
+            # Interleave requesters instead of appending in completion order
+            position = fair_insert_index(config.queued_songs, song_info.get('requester'))
+            config.queued_songs.insert(position, song_info)
+            print(f"Added to queue: {song_info['title']}")
+        publish_queue()
+        print(f"Queue now has {len(config.queued_songs)} songs")
+
+    any_ready = any(is_ready(song_info) for song_info in song_infos)
+    should_actually_play_now = False
+    if has_auto_play_chance:
+        with config.auto_play_lock:
+            if config.is_auto_play_pending and not config.state.is_playing and not music.get_busy():
+                # play_next_song decides between these and any pending song ahead of them
+                should_actually_play_now = any_ready
+
+            config.is_auto_play_pending = False
+    elif any_ready and _is_idle():
+        # Idle while another request holds the chance, e.g. waiting for a pending head: let
+        # play_next_song apply HEAD_PENDING_POLICY to the new song too
+        should_actually_play_now = True
+
+    if should_actually_play_now:
+        instant('player.next_song_timer')
+        pygame.time.set_timer(config.NEXT_SONG_EVENT, 10)  # Schedule play_next_song instead of calling directly
+
+
+def fill_placeholder(entry_id, song_info, downloaded=False):
+    """Make a pending placeholder playable in place. Returns False if it left the queue meanwhile."""
+    with config.queue_lock:
+        i = _entry_index(entry_id)
+        if i is None:
+            return False
+        # A new dict, published snapshots keep showing the placeholder they were taken with
+        ready_song_info = dict(song_info, id=entry_id, status='ready')
+        config.queued_songs[i] = ready_song_info
+        if downloaded:
+            config.downloaded_songs.append(ready_song_info)
+        publish_queue()
+    print(f"Ready in queue: {ready_song_info['title']}")
+
+    if _is_idle():
+        instant('player.next_song_timer', song_info.get('trace_id'))
+        pygame.time.set_timer(config.NEXT_SONG_EVENT, 10)  # Possibly waiting for this very song
+    return True
+
+
+def remove_placeholder(entry_id):
+    """Drop a pending placeholder from the queue. Returns False if it is not pending in the queue."""
+    with config.queue_lock:
+        i = _entry_index(entry_id)
+        if i is None or is_ready(config.queued_songs[i]):
+            return False
+        del config.queued_songs[i]
+        publish_queue()
+
+    if _is_idle():
+        pygame.time.set_timer(config.NEXT_SONG_EVENT, 10)  # The player may have been waiting for it
+    return True
+
+
+def move_entry(entry_id, before_id=None):
+    """Move a queue entry in front of the entry `before_id`, or to the end if that is None.
+
+    Both are named by id, so the entry lands where it was aimed even if the
+    queue changed since the caller's snapshot. Returns False if either entry
+    is no longer queued.
+    """
+    with config.queue_lock:
+        i = _entry_index(entry_id)
+        if i is None:
+            return False
+        entry = config.queued_songs.pop(i)
+        index = len(config.queued_songs) if before_id is None else _entry_index(before_id)
+        if index is None:
+            config.queued_songs.insert(i, entry)  # The target left the queue meanwhile, stay put
+            return False
+        config.queued_songs.insert(index, entry)
+        publish_queue()
+    print(f"Moved in queue: {entry['title']} to position {index + 1}")
+    return True
+
+
+def remove_entry(entry_id):
+    """Take an entry out of the queue and return it, or None if it is no longer queued.
+
+    A pending entry's download carries on; use ingest.remove_queued to cancel it as well.
+    """
+    with config.queue_lock:
+        i = _entry_index(entry_id)
+        if i is None:
+            return None
+        entry = config.queued_songs.pop(i)
+        publish_queue()
+    print(f"Removed from queue: {entry['title']}")
+    return entry
+
+
+def _is_idle():
+    """Return True if nothing plays and nothing is paused: after the last song ended, a skip, or at startup"""
+    return not config.state.is_playing and not is_busy() and not clock.is_paused()
+
+
+def _entry_index(entry_id):
+    """Position of an entry in config.queued_songs, or None. Caller must hold config.queue_lock."""
+    for i, entry in enumerate(config.queued_songs):
+        if entry['id'] == entry_id:
+            return i
+    return None
+
+
+def claim_auto_play_chance():
+    """Return True if a new song should start playback as soon as it is ingested"""
+    if not config.state.is_playing and not music.get_busy():
+        with config.auto_play_lock:
+            if not config.is_auto_play_pending:
+                config.is_auto_play_pending = True
+                return True
+    return False
+
+
+def release_auto_play_chance(has_auto_play_chance):
+    """Give up the auto-play chance of a song that failed to ingest"""
+    if has_auto_play_chance:
+        with config.auto_play_lock:
+            config.is_auto_play_pending = False
 
 
 def play_next_song():
     """Play the next song in the queue"""
 
     # First make sure no other playback is happening
-    if mixer.music.get_busy():
-        mixer.music.stop()
+    if music.get_busy():
+        music.stop()
 
     # Get the next song from queue with proper locking
     next_song_info = None
+    retry_after = None
 
     with config.queue_lock:
         queue_size = len(config.queued_songs)
@@ -24,46 +217,243 @@ def play_next_song():
         # cleanup_songs_internal()
 
         # Now get the next song if available
-        if config.queued_songs:
-            next_song_info = config.queued_songs.pop(0)
+        index, retry_after = _next_playable_index()
+        if index is not None:
+            next_song_info = config.queued_songs.pop(index)
+            publish_queue()
             print(f"Popped song from queue: {next_song_info['title']}")
             print(f"Remaining queue: {len(config.queued_songs)} songs")
             if config.queued_songs:
                 print(f"Next in queue will be: {config.queued_songs[0]['title']}")
 
+    previous_song_info = config.state.currently_playing
+    if previous_song_info is not None:
+        config.recently_played.append(previous_song_info)
+
     # If we got a song to play, try to play it
     if next_song_info:
         # Set playing state before actually playing to prevent race conditions
-        config.current_song = next_song_info['path']
-        config.currently_playing = next_song_info
+        config.state.update(current_song=next_song_info['path'], currently_playing=next_song_info)
 
-        if os.path.exists(next_song_info['path']):
+        if is_playable(next_song_info):
             try:
-                mixer.music.load(next_song_info['path'])
-                mixer.music.set_volume(config.volume_level)
-                mixer.music.play()
-                config.is_playing = True  # Only set to True if successful
-                config.paused_time = 0
+                with span('player.start_playback', next_song_info.get('trace_id'), title=next_song_info['title']):
+                    _start_playback(next_song_info)
+                config.state.update(is_playing=True)  # Only set to True if successful
                 print(f"Now playing: {next_song_info['title']}")
+                remember(next_song_info['title'])
+                record_play(next_song_info)
             except Exception as e:
                 print(f"Error playing {next_song_info['path']}: {e}")
                 # Don't call play_next_song recursively - use timer
-                config.current_song = None
-                config.currently_playing = None
-                config.is_playing = False
+                config.state.update(current_song=None, currently_playing=None, is_playing=False)
                 pygame.time.set_timer(config.NEXT_SONG_EVENT, 10)  # Try next song
         else:
             print(f"Error: Song file not found: {next_song_info['path']}. Skipping.")
-            config.current_song = None
-            config.currently_playing = None
-            config.is_playing = False
+            config.state.update(current_song=None, currently_playing=None, is_playing=False)
             pygame.time.set_timer(config.NEXT_SONG_EVENT, 10)  # Try next song
+    elif queue_snapshot().songs:
+        # Only pending songs are up next, filling one of them starts playback
+        print("Waiting for the next song to finish downloading.")
+        config.state.update(currently_playing=None, current_song=None, is_playing=False)
+        if retry_after is not None:
+            pygame.time.set_timer(config.NEXT_SONG_EVENT, int(retry_after * 1000) + 1)
     else:
         # No songs in queue
         print("No songs in queue to play.")
-        config.currently_playing = None
-        config.current_song = None
-        config.is_playing = False
+        config.state.update(currently_playing=None, current_song=None, is_playing=False)
+
+
+def _next_playable_index():
+    """Pick the queue entry to play next under HEAD_PENDING_POLICY. Caller must hold config.queue_lock.
+
+    Returns (index, retry_after). index is None when nothing should play
+    now; retry_after is then the seconds until the wait for a pending head
+    runs out, or None if only a placeholder being filled can start playback.
+    """
+    global _head_wait_since
+    ready = next((i for i, song in enumerate(config.queued_songs) if is_ready(song)), None)
+    if ready is None:
+        _head_wait_since = None
+        return None, None
+    if ready == 0 or config.HEAD_PENDING_POLICY == 'play_ready':
+        _head_wait_since = None
+        return ready, None
+
+    # 'wait': hold the head's turn for a while before playing around it
+    now = time.monotonic()
+    if _head_wait_since is None:
+        _head_wait_since = now
+    remaining = config.HEAD_PENDING_WAIT - (now - _head_wait_since)
+    if remaining <= 0:
+        _head_wait_since = None
+        return ready, None
+    return None, remaining
+
+
+def is_playable(song_info):
+    """Return True if a song can be played, from its file or from the PCM cache"""
+    return pcm_cache.contains(song_info) or os.path.exists(song_info['path'])
+
+
+def _start_playback(song_info, start=None):
+    """Load a song into the mixer and play it from `start` seconds, by default where its leading silence ends"""
+    if start is None:
+        start = song_info.get('trim_start', 0.0)
+    index = song_info.get('frame_index')
+    cached = pcm_cache.open_at(song_info, start)
+    if cached:
+        # Recently played: decoded samples are already mapped, nothing to decode or scan
+        song_file, start = cached
+        music.load(song_file, 'wav')
+        music.set_volume(config.state.volume_level)
+        music.play()
+    elif index and start > 0:
+        # Constant time seek: hand the mixer a view of the file starting at the right frame
+        song_file, start = index.open_at(start)
+        music.load(song_file, 'mp3')
+        music.set_volume(config.state.volume_level)
+        music.play()
+    else:
+        music.load(song_info['path'])
+        music.set_volume(config.state.volume_level)
+        music.play(start=start)
+    clock.start(start)
+    _schedule_trim_end(song_info)
+    pcm_cache.warm(song_info)
+
+
+def _schedule_trim_end(song_info):
+    """Arm TRACK_END_EVENT for where the trailing silence of the playing song starts"""
+    trim_end = song_info.get('trim_end')
+    if trim_end is None:
+        pygame.time.set_timer(config.TRACK_END_EVENT, 0)
+        return
+    remaining = trim_end - clock.position()
+    pygame.time.set_timer(config.TRACK_END_EVENT, max(1, int(remaining * 1000)), loops=1)
+
+
+def _stop_without_end_event():
+    """Stop the mixer without posting MUSIC_END, so the queue does not advance"""
+    music.set_endevent()
+    music.stop()
+    music.set_endevent(config.MUSIC_END)
+
+
+def is_busy():
+    """Return True if the backend is playing a song (False while paused)"""
+    return music.get_busy()
+
+
+def skip():
+    """Stop the current song and move on to the next one. Returns False if nothing is playing."""
+    with config.queue_lock:
+        if not (config.state.is_playing or music.get_busy()):
+            return False
+        music.stop()
+        pygame.time.set_timer(config.NEXT_SONG_EVENT, 10)
+    return True
+
+
+def set_volume(level):
+    """Set the playback volume (0.0 - 1.0)"""
+    config.state.update(volume_level=float(max(0.0, min(1.0, level))))
+    music.set_volume(config.state.volume_level)
+
+
+def set_eq(bass_db, treble_db):
+    """Set the equalizer in dB. Returns False if the backend has no equalizer."""
+    if not hasattr(music, 'set_eq'):
+        return False
+    return music.set_eq(bass_db, treble_db)
+
+
+def get_position():
+    """Return the playback position of the current song in seconds"""
+    return clock.position() if config.state.currently_playing else 0.0
+
+
+def get_duration():
+    """Return the length of the current song in seconds, or None if unknown"""
+    if config.state.currently_playing:
+        return config.state.currently_playing.get('duration')
+    return None
+
+
+def seek(seconds):
+    """Jump to a position in the current song, keeping its paused/playing state"""
+    song_info = config.state.currently_playing
+    if not song_info or not is_playable(song_info):
+        return False
+
+    duration = get_duration()
+    if duration:
+        seconds = min(seconds, max(0.0, duration - 1.0))
+    seconds = max(0.0, seconds)
+
+    was_paused = clock.is_paused()
+    _stop_without_end_event()
+    try:
+        _start_playback(song_info, seconds)
+    except Exception as e:
+        print(f"Error seeking in {song_info['path']}: {e}")
+        return False
+
+    if was_paused:
+        music.pause()
+        clock.pause()
+    else:
+        config.state.update(is_playing=True)
+    return True
+
+
+def replay():
+    """Restart the current song from the beginning"""
+    song_info = config.state.currently_playing
+    if not song_info or not is_playable(song_info):
+        return False
+
+    _stop_without_end_event()
+    try:
+        _start_playback(song_info)
+    except Exception as e:
+        print(f"Error replaying {song_info['path']}: {e}")
+        return False
+    config.state.update(is_playing=True)
+    return True
+
+
+def back():
+    """Play the previously played song again; the current one goes back to the front of the queue.
+
+    Returns the song now playing, or None if there is nothing to go back to.
+    """
+    with config.queue_lock:
+        previous_song_info = None
+        while config.recently_played and previous_song_info is None:
+            candidate = config.recently_played.pop()
+            if is_playable(candidate):
+                previous_song_info = candidate
+        if previous_song_info is None:
+            return None
+
+        current_song_info = config.state.currently_playing
+        if current_song_info is not None:
+            config.queued_songs.insert(0, current_song_info)
+            publish_queue()
+
+    config.state.update(current_song=previous_song_info['path'], currently_playing=previous_song_info)
+    _stop_without_end_event()
+    try:
+        _start_playback(previous_song_info)
+    except Exception as e:
+        print(f"Error playing {previous_song_info['path']}: {e}")
+        config.state.update(current_song=None, currently_playing=None, is_playing=False)
+        pygame.time.set_timer(config.NEXT_SONG_EVENT, 10)
+        return None
+    config.state.update(is_playing=True)
+    print(f"Back to: {previous_song_info['title']}")
+    return previous_song_info
 
 
 def cleanup_songs_internal():
@@ -71,29 +461,34 @@ def cleanup_songs_internal():
 
     # Build a set of active song paths (songs in queue or currently playing)
     active_song_paths = {song['path'] for song in config.queued_songs}
-    if config.currently_playing and config.currently_playing['path']:
-        active_song_paths.add(config.currently_playing['path'])
+    if config.state.currently_playing and config.state.currently_playing['path']:
+        active_song_paths.add(config.state.currently_playing['path'])
 
     # Also consider the current_song path separately, as it might be playing
-    if config.current_song:
-        active_song_paths.add(config.current_song)
+    if config.state.current_song:
+        active_song_paths.add(config.state.current_song)
 
     # Check if mixer is busy
-    mixer_busy = mixer.music.get_busy()
+    mixer_busy = music.get_busy()
 
     songs_to_remove = []
     for song_info in config.downloaded_songs:
         # Skip current song if mixer is busy
-        if mixer_busy and song_info['path'] == config.current_song:
+        if mixer_busy and song_info['path'] == config.state.current_song:
             continue
 
         if song_info['path'] not in active_song_paths:
             try:
                 if os.path.exists(song_info['path']):
                     # Check if file is not currently playing before deleting
-                    if not (mixer_busy and song_info['path'] == config.current_song):
+                    if not (mixer_busy and song_info['path'] == config.state.current_song):
                         try:
                             os.remove(song_info['path'])
+                            sidecar_paths = (index_path_for(song_info['path']), trim_path_for(song_info['path']),
+                                             fingerprint_path_for(song_info['path']))
+                            for sidecar_path in sidecar_paths:
+                                if os.path.exists(sidecar_path):
+                                    os.remove(sidecar_path)
                         except PermissionError:
                             print(f"Skipping delete of in-use file: {song_info['path']}")
                 songs_to_remove.append(song_info)
@@ -114,40 +509,71 @@ def cleanup_songs():
 def toggle_play_pause():
     """Toggle between play and pause states"""
 
-    if config.is_playing:
-        mixer.music.pause()
-        config.is_playing = False
-        config.paused_time = mixer.music.get_pos()
+    if config.state.is_playing:
+        music.pause()
+        clock.pause()
+        config.state.update(is_playing=False)
     else:
-        if config.current_song:  # If there's a song loaded (paused or previously played)
-            if config.paused_time > 0:  # Resuming a paused song
-                mixer.music.unpause()
+        if config.state.current_song:  # If there's a song loaded (paused or previously played)
+            if clock.is_paused():  # Resuming a paused song
+                music.unpause()
+                clock.resume()
+                _schedule_trim_end(config.state.currently_playing)
             else:  # Starting a song from the beginning
-                if os.path.exists(config.current_song):
-                    mixer.music.play()
+                if is_playable(config.state.currently_playing):
+                    _start_playback(config.state.currently_playing)
                 else:
-                    print(f"Error: Song file not found: {config.current_song}")
+                    print(f"Error: Song file not found: {config.state.current_song}")
                     return
         else:
             # No current song, try to play the next one in queue
-            if config.queued_songs:
+            if queue_snapshot().songs:
                 pygame.time.set_timer(config.NEXT_SONG_EVENT, 10)
                 return
             else:
                 print("No songs to play")
                 return
-        config.is_playing = True
+        config.state.update(is_playing=True)
 
 
 def handle_music_end_event():
     """Handle when a song finishes playing naturally"""
 
     # Set is_playing to False to indicate we're ready for the next song
-    config.is_playing = False
+    config.state.update(is_playing=False)
+    clock.stop()
 
-    with config.queue_lock:
-        if config.queued_songs:  # If there are more songs in the queue
-            # Schedule next song to play on main thread
-            pygame.time.set_timer(config.NEXT_SONG_EVENT, 10)  # Small delay
-        else:
-            print("Queue is empty. Playback stopped.")
+    if queue_snapshot().songs:  # If there are more songs in the queue
+        # Schedule next song to play on main thread
+        pygame.time.set_timer(config.NEXT_SONG_EVENT, 10)  # Small delay
+    else:
+        print("Queue is empty. Playback stopped.")
+
+
+def handle_next_song_event():
+    """Handle the next song timer firing"""
+    pygame.time.set_timer(config.NEXT_SONG_EVENT, 0)  # Turn off the timer
+
+    print("Playing next song from queue...")
+    songs = queue_snapshot().songs
+    if songs:
+        print(f"Queue has {len(songs)} songs. Next up: {songs[0]['title']}")
+
+    # Only play next song if we're not already playing something
+    if not config.state.is_playing and not is_busy():
+        with span('player.next_song_event'):
+            play_next_song()
+
+
+def handle_track_end_event():
+    """Move on once the current song reaches its trailing silence"""
+    song_info = config.state.currently_playing
+    if not song_info or song_info.get('trim_end') is None or not config.state.is_playing:
+        return  # Paused or stopped meanwhile; resuming or the next song arms the timer again
+    remaining = song_info['trim_end'] - clock.position()
+    if remaining > 0.05:
+        _schedule_trim_end(song_info)  # Woken early, e.g. the song was seeked back
+        return
+    print(f"Skipping the trailing silence of {song_info['title']}")
+    _stop_without_end_event()
+    handle_music_end_event()
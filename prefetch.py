@@ -0,0 +1,118 @@
+import asyncio
+import os
+
+import yt_dlp
+
+import config
+from audio_cache import cache_path_for, cached_song_path, cache_stats, evict_to
+from core import core
+from frame_index import load_or_build_index
+from history import get_history
+from ingest import pipeline, transcode_analysed
+from song_queue import queue_snapshot
+from youtube import fetch_audio
+
+
+class Prefetcher:
+    """Warms the audio cache with the most likely requests while the box is idle.
+
+    Candidates come from play history (count decayed by recency). A prefetch
+    only starts when no user download is queued and the CPU is mostly idle,
+    runs rate limited, and is abandoned mid-download as soon as a user
+    download shows up. It runs as a task on the core loop.
+    """
+
+    def __init__(self):
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            os.makedirs(config.CACHE_DIR, exist_ok=True)
+            self._task = core.keep_running(self._run, "Prefetcher")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(config.PREFETCH_INTERVAL)
+            try:
+                await self._prefetch_next()
+            except Exception as e:
+                print(f"Prefetch error: {e}")
+
+    def _is_idle(self):
+        if not pipeline.is_idle():
+            return False
+        if hasattr(os, 'getloadavg'):
+            return os.getloadavg()[0] < config.PREFETCH_MAX_LOAD * config.CPU_COUNT
+        return True
+
+    async def _prefetch_next(self):
+        """Fetch the highest ranked track that is not cached yet, one per idle period.
+
+        A full cache makes room by evicting its least recently used songs,
+        but never one in use or ranked above the candidate: evicting those
+        would only churn the cache.
+        """
+        if not self._is_idle():
+            return
+        ranked_higher = set()
+        for candidate in await core.run_blocking(get_history().top_tracks, config.PREFETCH_CANDIDATES):
+            cached_path = cached_song_path(candidate['id'])
+            if cached_path:
+                ranked_higher.add(cached_path)
+                continue
+            room = config.PREFETCH_MAX_BYTES - config.PREFETCH_SONG_BYTES
+            if await core.run_blocking(evict_to, room, songs_in_use(*ranked_higher)) > room:
+                return  # Everything left is in use or ranked higher
+            await self._prefetch(candidate)
+            return
+
+    async def _prefetch(self, video_info):
+        print(f"Prefetching: {video_info['title']}")
+        song_path = cache_path_for(video_info['id'])
+
+        def pause_for_user_downloads(progress):
+            if not pipeline.is_idle():
+                raise yt_dlp.utils.DownloadCancelled("User download queued, pausing prefetch")
+
+        try:
+            fetched_path, _ = await core.run_blocking(fetch_audio, video_info, directory=config.CACHE_DIR, extra_opts={
+                'ratelimit': config.PREFETCH_RATE_LIMIT,
+                'progress_hooks': [pause_for_user_downloads],
+            })
+        except yt_dlp.utils.DownloadCancelled as e:
+            # The .part file stays behind, so the next idle period resumes where this one stopped
+            print(f"Prefetch of '{video_info['title']}' stopped: {e}")
+            return
+
+        try:
+            # Cached by video id, so another upload of the same song still needs a file of its own
+            await transcode_analysed(fetched_path, song_path, reuse=False)
+            await core.run_blocking(load_or_build_index, song_path)
+        finally:
+            if os.path.exists(fetched_path):
+                os.remove(fetched_path)
+
+        cache_stats.record_prefetch()
+        await core.run_blocking(evict_to, config.PREFETCH_MAX_BYTES, songs_in_use(song_path))
+
+
+def songs_in_use(*paths):
+    """Paths eviction must not touch: the given ones, every queued song and the one playing.
+
+    Cache hits and reused duplicates queue files of the cache itself.
+    """
+    keep = set(paths)
+    keep.update(song['path'] for song in queue_snapshot().songs if song.get('path'))
+    playing = config.state.currently_playing
+    if playing and playing.get('path'):
+        keep.add(playing['path'])
+    return keep
+
+
+prefetcher = Prefetcher()
+
+
+def start_prefetcher():
+    """Start warming the audio cache in the background"""
+    if config.PREFETCH_ENABLED:
+        prefetcher.start()
@@ -0,0 +1,176 @@
+"""Split layout: the audio engine, the pygame UI and the Discord bot in separate processes.
+
+The main process is the engine: player, queue, ingest, prefetch and the
+control API on the core loop, with a headless pygame event pump for the
+player's end and timer events. The UI and the Discord bot run in child
+processes started with the spawn method, so they share no interpreter state
+with the engine, and their searches (yt-dlp, the library) run there too
+instead of on the engine's executor. Both read the player status from a
+StatusBlock in shared memory and send commands through a ControlServer
+connection.
+
+A child that crashes is restarted (after UI_RESTART_DELAY or
+BOT_RESTART_DELAY seconds) while the music keeps playing; closing the
+window or stopping the engine (SIGTERM or Ctrl+C) exits every process.
+Only the engine creates the music backend (player.start_player), so the
+children open no audio output of their own.
+"""
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+import pygame
+
+import config
+from control import ControlServer, LocalControl, RemoteControl
+from core import core
+from library import start_library
+from player import get_duration, get_position
+from song_queue import queue_snapshot
+from status_block import StatusBlock
+
+
+class StatusPublisher:
+    """Keeps the StatusBlock in step with the engine's state"""
+
+    DRIFT = 0.25  # Seconds the extrapolated position may be off before it is rewritten
+
+    def __init__(self, status):
+        self.status = status
+        self._queue_version = None
+        self._pending = 0
+        config.state.subscribe(self._on_state_change)
+        self.publish()
+
+    def _on_state_change(self, change):
+        """State store subscriber, runs on the dispatcher thread"""
+        self.publish()
+
+    def publish(self):
+        state = config.state
+        snapshot = queue_snapshot()
+        if snapshot.version != self._queue_version:
+            self._pending = sum(1 for song in snapshot.songs if song.get('status', 'ready') != 'ready')
+            self._queue_version = snapshot.version
+        self.status.write(state.is_playing, state.currently_playing, get_position(), get_duration(),
+                          state.volume_level, snapshot.version, len(snapshot.songs), self._pending,
+                          state.discord_status, state.discord_last_command, state.connected_audio_device)
+
+    def close(self):
+        config.state.unsubscribe(self._on_state_change)
+
+    def tick(self):
+        """Called every frame: republish after a queue change, a seek or a stall of the clock"""
+        if queue_snapshot().version != self._queue_version:
+            self.publish()
+        elif self.status.read().currently_playing and abs(self.status.position() - get_position()) > self.DRIFT:
+            self.publish()
+
+
+class ChildProcess:
+    """A spawned child process of the engine, started again `restart_delay` seconds after it crashes"""
+
+    def __init__(self, context, label, name, target, args, restart_delay):
+        self.context = context
+        self.label = label
+        self.name = name
+        self.target = target
+        self.args = args
+        self.restart_delay = restart_delay
+        self.restart_at = None
+        self.process = None
+        self.start()
+
+    def start(self):
+        self.process = self.context.Process(target=self.target, args=self.args, name=self.name)
+        self.process.start()
+
+    def check(self):
+        """Called every frame: restart the process if it crashed. Returns True once it has exited cleanly."""
+        if self.restart_at is not None:
+            if time.monotonic() >= self.restart_at:
+                print(f"Restarting the {self.label} process")
+                self.start()
+                self.restart_at = None
+            return False
+        if self.process.is_alive():
+            return False
+        if self.process.exitcode == 0:
+            return True
+        print(f"{self.label} process exited with code {self.process.exitcode}, playback continues")
+        self.restart_at = time.monotonic() + self.restart_delay
+        return False
+
+    def stop(self):
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(2)
+
+
+def _run_ui(address, authkey, status_name):
+    """Entry point of the UI process"""
+    from ui import MusicPlayerUI
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C stops the engine, which then stops the UI
+    start_library(scan=False)  # For the search box
+    MusicPlayerUI(RemoteControl(address, authkey, status_name)).run()
+
+
+def _run_bot(address, authkey, status_name):
+    """Entry point of the Discord bot process, which runs the bot and its searches on a core loop of its own"""
+    import discord_bot
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C stops the engine, which then stops the bot
+    control = RemoteControl(address, authkey, status_name)
+    discord_bot.use_control(control)
+    start_library(scan=False)
+    bot_run = core.submit(discord_bot.run_discord_bot())
+    while not bot_run.done():
+        control.poll()  # Leaves once the engine is gone
+        time.sleep(1.0)
+    core.stop()
+
+
+def run_engine():
+    """Run the engine in this process and supervise the UI and bot processes until the window is closed"""
+    control = LocalControl()
+    status = StatusBlock()
+    server = ControlServer(control, authkey=os.urandom(32))
+    publisher = StatusPublisher(status)
+    context = multiprocessing.get_context('spawn')
+
+    child_args = (server.address, server.authkey, status.name)
+    ui = ChildProcess(context, "UI", "music-ui", _run_ui, child_args, config.UI_RESTART_DELAY)
+    bot = None
+    if config.DISCORD_TOKEN:
+        bot = ChildProcess(context, "Discord bot", "discord-bot", _run_bot, child_args, config.BOT_RESTART_DELAY)
+    else:
+        config.state.update(discord_status="Discord bot: No token found")
+    frame_clock = pygame.time.Clock()
+    try:
+        while True:
+            events = pygame.event.get()
+            if any(event.type == pygame.QUIT for event in events):
+                break  # SDL turns SIGTERM into a quit event
+            for event in events:
+                control.handle_player_event(event)
+            control.poll()
+            publisher.tick()
+
+            if ui.check():
+                break  # Window closed
+            if bot is not None:
+                bot.check()  # A bot that gave up (e.g. a bad token) stays stopped
+            frame_clock.tick(60)  # Same frame rate as the UI
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ui.stop()
+        if bot is not None:
+            bot.stop()
+        server.close()
+        publisher.close()
+        core.stop()
+        status.close()
+        pygame.quit()
+    sys.exit(0)
@@ -0,0 +1,147 @@
+from collections import OrderedDict
+
+import pygame
+
+import config
+from song_queue import is_ready
+
+
+class QueueView:
+    """Scrollable queue panel that renders only the rows in view.
+
+    Rows are read from the control's queue snapshot, so drawing takes no
+    lock and costs the same for ten entries or fifty thousand. Rendered row
+    text is cached by entry id and status, so a frame usually only blits.
+    Drag a row to move it; click the x at its right end to remove it, which
+    also cancels the download of a pending entry.
+    """
+
+    SCROLL_ROWS = 3  # Rows per mouse wheel step
+    REMOVE_WIDTH = 18  # Width of the remove zone at the right end of a row
+    SCROLLBAR_WIDTH = 6
+
+    def __init__(self, control, rect, font, row_height, cache_size):
+        self.control = control
+        self.rect = rect
+        self.font = font
+        self.row_height = row_height
+        self.cache_size = cache_size
+        self.first = 0  # Index of the top visible row
+        self._surfaces = OrderedDict()  # Rendered text, least recently drawn first
+        self._drag = None  # Entry id of the row being dragged
+        self._drop_index = None
+
+    @property
+    def visible_rows(self):
+        return self.rect.height // self.row_height
+
+    def handle_event(self, event):
+        """Handle a mouse event aimed at the panel. Returns True if it was consumed."""
+        if event.type == pygame.MOUSEWHEEL:
+            if not self.rect.collidepoint(pygame.mouse.get_pos()):
+                return False
+            self.scroll_to(self.first - event.y * self.SCROLL_ROWS)
+            return True
+
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.rect.collidepoint(event.pos):
+            songs = self.control.queue_snapshot().songs
+            index = self._row_at(event.pos[1])
+            if index < len(songs):
+                if event.pos[0] >= self._text_right():
+                    self.control.remove_queued(songs[index]['id'])
+                else:
+                    self._drag = songs[index]['id']
+                    self._drop_index = index
+            return True
+
+        if event.type == pygame.MOUSEMOTION and self._drag:
+            # Past the top or bottom edge scrolls, so an entry can travel further than one screen
+            if event.pos[1] < self.rect.top:
+                self.scroll_to(self.first - 1)
+            elif event.pos[1] >= self.rect.bottom:
+                self.scroll_to(self.first + 1)
+            self._drop_index = self._insertion_at(event.pos[1])
+            return True
+
+        if event.type == pygame.MOUSEBUTTONUP and event.button == 1 and self._drag:
+            entry_id, drop_index = self._drag, self._drop_index
+            self._drag = self._drop_index = None
+            if drop_index is not None:
+                # Aim at the entry below the drop line rather than at a position: the queue
+                # may have changed since the drag started, and the move may land later still
+                songs = self.control.queue_snapshot().songs
+                drop_index = min(drop_index, len(songs))
+                before_id = songs[drop_index]['id'] if drop_index < len(songs) else None
+                above_id = songs[drop_index - 1]['id'] if drop_index > 0 else None
+                if entry_id not in (before_id, above_id):  # Dropped right where it already is
+                    self.control.move_entry(entry_id, before_id)
+            return True
+
+        return False
+
+    def scroll_to(self, first):
+        count = len(self.control.queue_snapshot().songs)
+        self.first = max(0, min(first, count - self.visible_rows))
+
+    def _row_at(self, y):
+        return self.first + (y - self.rect.top) // self.row_height
+
+    def _insertion_at(self, y):
+        """Queue position a dragged row would be inserted at for pointer height y"""
+        count = len(self.control.queue_snapshot().songs)
+        offset = round((y - self.rect.top) / self.row_height)
+        return max(0, min(self.first + max(0, min(offset, self.visible_rows)), count))
+
+    def _text_right(self):
+        return self.rect.right - self.REMOVE_WIDTH - self.SCROLLBAR_WIDTH
+
+    def _render(self, key, text, color):
+        surface = self._surfaces.get(key)
+        if surface is None:
+            surface = self.font.render(text, True, color)
+            self._surfaces[key] = surface
+            if len(self._surfaces) > self.cache_size:
+                self._surfaces.popitem(last=False)
+        else:
+            self._surfaces.move_to_end(key)
+        return surface
+
+    def draw(self, screen):
+        songs = self.control.queue_snapshot().songs
+        self.first = max(0, min(self.first, len(songs) - self.visible_rows))
+        pygame.draw.rect(screen, config.GRAY, self.rect, 1)
+        if not songs:
+            empty = self._render(('empty',), "Queue is empty", config.GRAY)
+            screen.blit(empty, (self.rect.x + 6, self.rect.y + 4))
+            return
+
+        text_right = self._text_right()
+        dragged_id = self._drag
+        for row, index in enumerate(range(self.first, min(self.first + self.visible_rows, len(songs)))):
+            song = songs[index]
+            y = self.rect.y + row * self.row_height
+            if song['id'] == dragged_id:
+                pygame.draw.rect(screen, (50, 50, 50), (self.rect.x + 1, y, text_right - self.rect.x - 1, self.row_height))
+
+            number = self._render(('number', index), f"{index + 1}.", config.GRAY)
+            ready = is_ready(song)
+            # Pending entries are greyed out until their download fills them in
+            title = self._render(('title', song['id'], ready), song['title'], config.WHITE if ready else config.GRAY)
+            text_y = y + (self.row_height - title.get_height()) // 2
+            screen.blit(number, (self.rect.x + 4, text_y))
+            title_x = self.rect.x + 44
+            screen.blit(title, (title_x, text_y), pygame.Rect(0, 0, text_right - title_x - 2, title.get_height()))
+            screen.blit(self._render(('remove',), "x", config.GRAY), (text_right + 4, text_y))
+
+        if self._drag and self._drop_index is not None:
+            drop_row = self._drop_index - self.first
+            if 0 <= drop_row <= self.visible_rows:
+                y = self.rect.y + drop_row * self.row_height
+                pygame.draw.line(screen, config.GREEN, (self.rect.x + 2, y), (text_right, y), 2)
+
+        if len(songs) > self.visible_rows:
+            track = pygame.Rect(self.rect.right - self.SCROLLBAR_WIDTH - 1, self.rect.y + 1,
+                                self.SCROLLBAR_WIDTH, self.rect.height - 2)
+            thumb_height = max(12, track.height * self.visible_rows // len(songs))
+            thumb_y = track.y + (track.height - thumb_height) * self.first // max(1, len(songs) - self.visible_rows)
+            pygame.draw.rect(screen, config.GRAY, (track.x, thumb_y, track.width, thumb_height))
@@ -0,0 +1,100 @@
+import asyncio
+import os
+import struct
+import subprocess
+
+try:
+    import numpy as np
+except ImportError:  # Trimming is skipped without numpy
+    np = None
+
+import config
+from audio import start_low_priority_async
+
+
+TRIM_MAGIC = b'TRIM1\0\0\0'
+TRIM_RECORD = struct.Struct('<8sdd')  # magic, start, end (0 when the end is not trimmed)
+
+
+def find_trim(samples, sample_rate):
+    """Return (start, end) seconds of the audible part of mono int16 samples.
+
+    The signal is cut into TRIM_WINDOW blocks and a block is audible when
+    its RMS level is above TRIM_THRESHOLD_DB. Silence shorter than
+    TRIM_MIN_SILENCE is left alone, TRIM_PAD is kept on either side of the
+    music, and at most TRIM_MAX_SECONDS is cut from each end so a quiet
+    intro is never mistaken for dead air. `end` is None if the end is kept.
+    """
+    window = max(1, int(sample_rate * config.TRIM_WINDOW))
+    blocks = len(samples) // window
+    if blocks == 0:
+        return 0.0, None
+    levels = samples[:blocks * window].reshape(blocks, window).astype(np.float32) / 32768.0
+    rms = np.sqrt(np.mean(np.square(levels), axis=1))
+    audible = np.flatnonzero(rms > 10 ** (config.TRIM_THRESHOLD_DB / 20))
+    if audible.size == 0:
+        return 0.0, None  # Silent all the way through, nothing sensible to cut
+
+    duration = len(samples) / sample_rate
+    lead = min(float(audible[0]) * window / sample_rate, config.TRIM_MAX_SECONDS)
+    tail = min(duration - float(audible[-1] + 1) * window / sample_rate, config.TRIM_MAX_SECONDS)
+    start = max(0.0, lead - config.TRIM_PAD) if lead >= config.TRIM_MIN_SILENCE else 0.0
+    end = min(duration, duration - tail + config.TRIM_PAD) if tail >= config.TRIM_MIN_SILENCE else None
+    return start, end
+
+
+async def decode_for_analysis(source_path):
+    """Decode a file to ANALYSIS_SAMPLE_RATE mono int16 samples with a low priority ffmpeg.
+
+    Returns None without numpy or if the file could not be decoded; the
+    analyses that use the samples are optional, so that only means the song
+    plays untrimmed and is not checked for duplicates.
+    """
+    if np is None:
+        return None
+    command = [
+        'ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error',
+        '-threads', '1',
+        '-i', source_path,
+        '-vn', '-ac', '1', '-ar', str(config.ANALYSIS_SAMPLE_RATE), '-f', 's16le', '-',
+    ]
+    try:
+        process = await start_low_priority_async(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            pcm, _ = await process.communicate()
+        except asyncio.CancelledError:
+            process.kill()
+            raise
+        if process.returncode != 0:
+            raise RuntimeError(f"ffmpeg exited with {process.returncode}")
+    except (OSError, RuntimeError) as e:
+        print(f"Could not decode {source_path} for analysis: {e}")
+        return None
+    return np.frombuffer(pcm[:len(pcm) // 2 * 2], dtype='<i2')
+
+
+def trim_path_for(song_path):
+    """Return the sidecar path the trim offsets of a song are stored at"""
+    return f"{song_path}.trim"
+
+
+def save_trim(song_path, trim):
+    """Store the trim offsets of a song next to it"""
+    start, end = trim
+    with open(trim_path_for(song_path), 'wb') as f:
+        f.write(TRIM_RECORD.pack(TRIM_MAGIC, start, end or 0.0))
+
+
+def load_trim(song_path):
+    """Return the stored (start, end) of a song, or None if it was never measured or has changed since"""
+    trim_path = trim_path_for(song_path)
+    try:
+        if os.path.getmtime(trim_path) < os.path.getmtime(song_path):
+            return None
+        with open(trim_path, 'rb') as f:
+            magic, start, end = TRIM_RECORD.unpack(f.read(TRIM_RECORD.size))
+    except (OSError, struct.error):
+        return None
+    if magic != TRIM_MAGIC:
+        return None
+    return start, end or None
@@ -0,0 +1,36 @@
+import itertools
+from collections import namedtuple
+
+import config
+
+
+# Immutable view of the queue. `songs` is a tuple, so readers can hold on to a
+# snapshot for as long as they like without seeing later modifications.
+QueueSnapshot = namedtuple('QueueSnapshot', ['version', 'songs'])
+
+_version = 0
+_entry_ids = itertools.count(1)
+config.queue_snapshot = QueueSnapshot(_version, ())
+
+
+def publish_queue():
+    """Publish a new snapshot of config.queued_songs. Caller must hold config.queue_lock."""
+    global _version
+    _version += 1
+    # A single attribute assignment, so readers see either the old or the new snapshot
+    config.queue_snapshot = QueueSnapshot(_version, tuple(config.queued_songs))
+
+
+def queue_snapshot():
+    """Return the latest published queue snapshot without taking any lock"""
+    return config.queue_snapshot
+
+
+def new_entry_id():
+    """Return a queue entry id that stays the same while the entry is pending, ready or moved"""
+    return next(_entry_ids)
+
+
+def is_ready(song_info):
+    """Return True if a queue entry can be played, False while it is a pending placeholder"""
+    return song_info.get('status', 'ready') == 'ready'
@@ -0,0 +1,107 @@
+import queue
+import threading
+from collections import namedtuple
+
+
+# One atomic update: `changes` maps each changed key to its (old, new) value
+StateChange = namedtuple('StateChange', ['version', 'changes'])
+
+
+class StateStore:
+    """Central store of typed state fields with change notifications.
+
+    Fields are read as attributes (`state.is_playing`) and written with
+    `update(**fields)`, which applies all changes atomically. Subscribers
+    register for specific keys and receive a StateChange on a dispatcher
+    thread, so a writer only pays for putting one event on a queue no
+    matter how many subscribers there are or how slow they are.
+    """
+
+    def __init__(self, fields):
+        # fields maps name -> (type or tuple of types, default value)
+        self._types = {name: field_type for name, (field_type, _) in fields.items()}
+        self._values = {name: default for name, (_, default) in fields.items()}
+        self._lock = threading.Lock()
+        self._version = 0
+        self._subscribers = {}  # key -> list of callbacks, None key means every change
+        self._events = queue.SimpleQueue()
+        self._dispatcher = None
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_values'][name]
+        except KeyError:
+            raise AttributeError(f"Unknown state field: {name}") from None
+
+    @property
+    def version(self):
+        return self._version
+
+    def snapshot(self):
+        """Return a copy of every field"""
+        with self._lock:
+            return dict(self._values)
+
+    def update(self, **fields):
+        """Set one or more fields atomically and notify subscribers of the ones that changed"""
+        for name, value in fields.items():
+            if name not in self._types:
+                raise AttributeError(f"Unknown state field: {name}")
+            if not isinstance(value, self._types[name]):
+                raise TypeError(f"State field {name} must be {self._types[name]}, got {type(value).__name__}")
+
+        with self._lock:
+            changes = {}
+            for name, value in fields.items():
+                old = self._values[name]
+                if old is not value and old != value:
+                    changes[name] = (old, value)
+                    self._values[name] = value
+            if not changes:
+                return None
+            self._version += 1
+            change = StateChange(self._version, changes)
+
+        if self._subscribers:
+            self._events.put(change)
+        return change
+
+    def subscribe(self, callback, keys=None):
+        """Call `callback(change)` whenever any of `keys` (or any field, if None) changes"""
+        with self._lock:
+            for key in (keys or [None]):
+                if key is not None and key not in self._types:
+                    raise AttributeError(f"Unknown state field: {key}")
+                # Copy on write so the dispatcher can iterate without the lock
+                self._subscribers = {**self._subscribers, key: self._subscribers.get(key, []) + [callback]}
+            self._start_dispatcher()
+
+    def unsubscribe(self, callback):
+        """Stop delivering changes to a callback"""
+        with self._lock:
+            self._subscribers = {
+                key: [cb for cb in callbacks if cb is not callback]
+                for key, callbacks in self._subscribers.items()
+            }
+
+    def _start_dispatcher(self):
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(target=self._dispatch_loop, name="state-dispatcher")
+            self._dispatcher.daemon = True
+            self._dispatcher.start()
+
+    def _dispatch_loop(self):
+        while True:
+            change = self._events.get()
+            subscribers = self._subscribers
+            callbacks = list(subscribers.get(None, []))
+            for key in change.changes:
+                for callback in subscribers.get(key, []):
+                    if callback not in callbacks:
+                        callbacks.append(callback)
+
+            for callback in callbacks:
+                try:
+                    callback(change)
+                except Exception as e:
+                    print(f"Error in state subscriber {getattr(callback, '__name__', callback)}: {e}")
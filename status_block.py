@@ -0,0 +1,101 @@
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+from types import SimpleNamespace
+
+
+# seq, is_playing, has_song, position, position_time, duration, volume,
+# queue_version, queue_length, pending, then fixed-size UTF-8 text fields
+_LAYOUT = struct.Struct('<Q??xxxxxxddddQII256s32s128s128s128s')
+_SEQ = struct.Struct('<Q')
+_TEXT_FIELDS = ('title', 'video_id', 'discord_status', 'discord_last_command', 'connected_audio_device')
+
+
+def _encode(text, size):
+    data = (text or '').encode('utf-8')[:size]
+    return data.decode('utf-8', errors='ignore').encode('utf-8')  # Never cut a character in half
+
+
+class StatusBlock:
+    """Player status in shared memory, written by the engine process and read by the UI.
+
+    A seqlock guards the block: the writer makes the sequence number odd,
+    packs every field and makes it even again; a reader copies the block and
+    retries if the number was odd or changed meanwhile. Readers never block
+    the writer and never take a lock, so a UI that hangs or crashes cannot
+    stall playback. Only the position needs per-frame accuracy, and that is
+    extrapolated from the time it was written instead of being rewritten
+    every frame.
+    """
+
+    def __init__(self, name=None):
+        if name is None:
+            self._memory = shared_memory.SharedMemory(create=True, size=_LAYOUT.size)
+            self._memory.buf[:_LAYOUT.size] = bytes(_LAYOUT.size)
+            self._owner = True
+        else:
+            self._memory = shared_memory.SharedMemory(name=name)
+            self._owner = False
+        self._write_lock = threading.Lock()
+        self._seq = 0
+        self._cached = None  # (seq, status) of the last read
+
+    @property
+    def name(self):
+        return self._memory.name
+
+    def write(self, is_playing, song, position, duration, volume, queue_version, queue_length, pending,
+              discord_status, discord_last_command, connected_audio_device):
+        """Publish the player status; `song` is the current queue entry or None"""
+        song = song or {}
+        with self._write_lock:
+            self._seq += 1
+            _SEQ.pack_into(self._memory.buf, 0, self._seq)  # Odd: write in progress
+            self._seq += 1
+            _LAYOUT.pack_into(
+                self._memory.buf, 0, self._seq - 1, is_playing, bool(song), position or 0.0, time.monotonic(),
+                duration or 0.0, volume, queue_version, queue_length, pending,
+                _encode(song.get('title'), 256), _encode(song.get('video_id'), 32), _encode(discord_status, 128),
+                _encode(discord_last_command, 128), _encode(connected_audio_device, 128))
+            _SEQ.pack_into(self._memory.buf, 0, self._seq)
+
+    def seq(self):
+        return _SEQ.unpack_from(self._memory.buf, 0)[0]
+
+    def read(self):
+        """Return a consistent copy of the status as a namespace"""
+        while True:
+            seq = self.seq()
+            if self._cached is not None and self._cached[0] == seq:
+                return self._cached[1]
+            if seq % 2:
+                time.sleep(0)  # The writer is mid-update, it only takes microseconds
+                continue
+            data = bytes(self._memory.buf[:_LAYOUT.size])
+            if self.seq() == seq:
+                break
+
+        fields = _LAYOUT.unpack(data)
+        status = SimpleNamespace(
+            is_playing=fields[1], position=fields[3], position_time=fields[4], duration=fields[5] or None,
+            volume_level=fields[6], queue_version=fields[7], queue_length=fields[8], pending=fields[9],
+            **{name: value.rstrip(b'\x00').decode('utf-8', errors='ignore')
+               for name, value in zip(_TEXT_FIELDS, fields[10:])})
+        # Shaped like a queue entry so the UI draws it the same way in either layout
+        status.currently_playing = {'title': status.title, 'video_id': status.video_id or None,
+                                    'duration': status.duration} if fields[2] else None
+        self._cached = (seq, status)
+        return status
+
+    def position(self):
+        """Playback position now, extrapolated while playing"""
+        status = self.read()
+        if status.is_playing:
+            return status.position + time.monotonic() - status.position_time
+        return status.position
+
+    def close(self):
+        self._memory.close()
+        if self._owner:
+            self._memory.unlink()
@@ -0,0 +1,111 @@
+import heapq
+import threading
+import time
+from collections import OrderedDict, defaultdict
+
+import config
+
+
+def normalize(text):
+    """Lowercase and strip punctuation so "Daft Punk - One More Time" matches "daft punk one more time" """
+    return ' '.join(''.join(ch if ch.isalnum() else ' ' for ch in text.lower()).split())
+
+
+def trigrams(text):
+    """Return the set of character trigrams of normalized text, padded so short words still count"""
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TrigramIndex:
+    """Bounded in-memory trigram index over track titles for fuzzy, typo tolerant lookup.
+
+    Holds at most `max_entries` titles; adding beyond that evicts the least
+    recently seen title and its postings, so memory stays bounded. Each entry
+    can carry the item it came from (search result or local track) so a
+    suggestion can be queued without searching again.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # normalized title -> (title, item, trigram set)
+        self._postings = defaultdict(set)  # trigram -> normalized titles containing it
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, title, item=None):
+        """Add or refresh a title. An existing item is kept if none is given."""
+        key = normalize(title)
+        if not key:
+            return
+        with self._lock:
+            existing = self._entries.get(key)
+            if existing is not None:
+                self._entries.move_to_end(key)
+                if item is not None:
+                    self._entries[key] = (title, item, existing[2])
+                return
+
+            grams = trigrams(key)
+            self._entries[key] = (title, item, grams)
+            for gram in grams:
+                self._postings[gram].add(key)
+
+            while len(self._entries) > self.max_entries:
+                self._evict_oldest()
+
+    def _evict_oldest(self):
+        key, (_, _, grams) = self._entries.popitem(last=False)
+        for gram in grams:
+            keys = self._postings[gram]
+            keys.discard(key)
+            if not keys:
+                del self._postings[gram]
+
+    def suggest(self, text, limit=5, budget=None):
+        """Return up to `limit` (title, item) pairs ranked by trigram similarity.
+
+        Query trigrams are scored rarest first and scoring stops once
+        `budget` seconds have passed, so a lookup always fits in a frame.
+        """
+        query = normalize(text)
+        if not query:
+            return []
+        deadline = time.perf_counter() + (budget if budget is not None else config.SUGGEST_BUDGET_MS / 1000)
+        query_grams = trigrams(query)
+
+        with self._lock:
+            postings = sorted((self._postings.get(gram, ()) for gram in query_grams), key=len)
+            shared = defaultdict(int)
+            for keys in postings:
+                for key in keys:
+                    shared[key] += 1
+                if time.perf_counter() > deadline:
+                    break
+
+            def similarity(key):
+                common = shared[key]
+                return common / (len(query_grams) + len(self._entries[key][2]) - common)
+
+            # Similarity can only reach the minimum if this many trigrams are shared
+            min_common = config.SUGGEST_MIN_SIMILARITY * len(query_grams)
+            candidates = [key for key, common in shared.items() if common >= min_common]
+            best = heapq.nlargest(limit, candidates, key=similarity)
+            results = [(self._entries[key][0], self._entries[key][1]) for key in best
+                       if similarity(key) >= config.SUGGEST_MIN_SIMILARITY]
+        return results
+
+
+suggestions = TrigramIndex(config.SUGGEST_MAX_ENTRIES)
+
+
+def remember(title, item=None):
+    """Record a searched, downloaded or played title for suggestions"""
+    suggestions.add(title, item)
+
+
+def suggest(text, limit=5):
+    """Return ranked (title, item) suggestions for partially typed text"""
+    return suggestions.suggest(text, limit)
@@ -0,0 +1,212 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import aiohttp
+import pygame
+
+import config
+from audio import sanitize_filename
+from core import core
+
+
+def video_id_of(info):
+    """Return the YouTube id of a search result or queue entry, None for local tracks"""
+    if 'video_id' in info:
+        return info['video_id']  # Queue entry, its 'id' is the entry id
+    if info.get('local'):
+        return None
+    return info.get('id')
+
+
+def thumbnail_url(info):
+    """Pick the smallest thumbnail at least THUMBNAIL_FETCH_WIDTH wide, falling back to YouTube's default"""
+    sized = sorted((thumbnail for thumbnail in info.get('thumbnails') or ()
+                    if thumbnail.get('url') and thumbnail.get('width')), key=lambda thumbnail: thumbnail['width'])
+    for thumbnail in sized:
+        if thumbnail['width'] >= config.THUMBNAIL_FETCH_WIDTH:
+            return thumbnail['url']
+    if sized:
+        return sized[-1]['url']
+    if info.get('thumbnail'):
+        return info['thumbnail']
+    video_id = video_id_of(info)
+    return f"https://i.ytimg.com/vi/{video_id}/mqdefault.jpg" if video_id else None
+
+
+def _decode(path, size):
+    """Load an image file and scale it to cover `size`, cropping the overflow. Runs on the core executor."""
+    image = pygame.image.load(path)
+    scale = max(size[0] / image.get_width(), size[1] / image.get_height())
+    scaled_size = (max(size[0], round(image.get_width() * scale)), max(size[1], round(image.get_height() * scale)))
+    try:
+        scaled = pygame.transform.smoothscale(image, scaled_size)
+    except ValueError:
+        scaled = pygame.transform.scale(image, scaled_size)  # smoothscale needs 24 or 32 bit pixels
+    crop = pygame.Rect((0, 0), size)
+    crop.center = scaled.get_rect().center
+    return scaled.subsurface(crop).copy()
+
+
+def _is_transient(error):
+    """Network trouble worth retrying, as opposed to a thumbnail that is missing or not an image"""
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status == 429 or error.status >= 500
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError, OSError))
+
+
+def _touch(path):
+    """Mark a stored image as recently used. Returns False if it is not on disk."""
+    try:
+        os.utime(path)  # Recently used, so it outlives older thumbnails on disk
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _surface_bytes(surface):
+    return surface.get_width() * surface.get_height() * surface.get_bytesize()
+
+
+class ThumbnailCache:
+    """Thumbnails for the UI, loaded in the background and never waited for.
+
+    get() returns the scaled surface if it is ready and a placeholder
+    otherwise, starting the load on the core loop: the image is fetched
+    with aiohttp into THUMBNAIL_DIR, then decoded and scaled once on the
+    core executor. Scaled surfaces are kept least recently drawn first out
+    within `max_bytes` of pixels; the files on disk within `disk_max_bytes`,
+    oldest first out. A failed download is tried again after
+    THUMBNAIL_RETRY_DELAY; a missing or undecodable thumbnail is not.
+    """
+
+    def __init__(self, directory, max_bytes, disk_max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self._surfaces = OrderedDict()  # (video id, size) -> Surface, most recently drawn last
+        self._bytes = 0
+        self._loading = set()
+        self._failed = set()  # Video ids without a usable thumbnail, not retried
+        self._retry_at = {}  # Video id -> monotonic time its failed download may be tried again
+        self._placeholders = {}
+        self._lock = threading.Lock()
+        self._session = None
+        self._fetches = None
+        self.version = 0  # Bumped when a thumbnail becomes ready, so the UI knows to redraw
+
+    def get(self, info, size):
+        """Return the thumbnail of a search result or queue entry at `size`, or a placeholder for now"""
+        video_id = video_id_of(info)
+        if video_id is None:
+            return self.placeholder(size)
+        key = (video_id, size)
+        with self._lock:
+            surface = self._surfaces.get(key)
+            if surface is not None:
+                self._surfaces.move_to_end(key)
+                return surface
+            if key in self._loading or video_id in self._failed \
+                    or self._retry_at.get(video_id, 0) > time.monotonic():
+                return self.placeholder(size)
+            self._loading.add(key)
+        core.submit(self._load(key, thumbnail_url(info)))
+        return self.placeholder(size)
+
+    def placeholder(self, size):
+        """A plain tile shown until a thumbnail is ready, and for tracks without one"""
+        surface = self._placeholders.get(size)
+        if surface is None:
+            surface = pygame.Surface(size)
+            surface.fill((40, 40, 40))
+            pygame.draw.rect(surface, config.GRAY, surface.get_rect(), 1)
+            self._placeholders[size] = surface
+        return surface
+
+    async def _load(self, key, url):
+        video_id, size = key
+        path = None
+        try:
+            path = await self._fetch(video_id, url)
+            surface = await core.run_blocking(_decode, path, size)
+        except Exception as e:
+            transient = _is_transient(e)
+            print(f"Could not load the thumbnail of {video_id}{', will retry' if transient else ''}: {e}")
+            if path is not None and not transient:
+                await core.run_blocking(_remove_quietly, path)  # Not an image, fetched afresh next session
+            with self._lock:
+                self._loading.discard(key)
+                if transient:
+                    self._retry_at[video_id] = time.monotonic() + config.THUMBNAIL_RETRY_DELAY
+                else:
+                    self._failed.add(video_id)
+            return
+
+        with self._lock:
+            self._loading.discard(key)
+            self._retry_at.pop(video_id, None)
+            self._surfaces[key] = surface
+            self._bytes += _surface_bytes(surface)
+            while self._bytes > self.max_bytes and len(self._surfaces) > 1:
+                _, evicted = self._surfaces.popitem(last=False)
+                self._bytes -= _surface_bytes(evicted)
+            self.version += 1
+
+    async def _fetch(self, video_id, url):
+        """Return the path of the image on disk, downloading it first if needed"""
+        path = os.path.join(self.directory, f"{sanitize_filename(video_id)}.img")
+        if await core.run_blocking(_touch, path):
+            return path
+        if url is None:
+            raise ValueError("no thumbnail URL")
+
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=config.THUMBNAIL_FETCH_TIMEOUT))
+            self._fetches = asyncio.Semaphore(config.THUMBNAIL_FETCHES)
+            core.at_stop(self._session.close)
+        async with self._fetches:
+            async with self._session.get(url) as response:
+                response.raise_for_status()
+                data = await response.read()
+
+        await core.run_blocking(self._store, path, data)
+        return path
+
+    def _store(self, path, data):
+        """Write a downloaded image and prune the directory. Runs on the core executor."""
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = f"{path}.part"
+        with open(temp_path, 'wb') as image_file:
+            image_file.write(data)
+        os.replace(temp_path, path)
+        self._prune_disk()
+
+    def _prune_disk(self):
+        """Delete the least recently used images beyond disk_max_bytes"""
+        entries = [entry for entry in os.scandir(self.directory) if entry.is_file()]
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in sorted(entries, key=lambda entry: entry.stat().st_mtime):
+            if total <= self.disk_max_bytes:
+                break
+            total -= entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+    def resident_bytes(self):
+        """Bytes of pixel data held by cached surfaces"""
+        with self._lock:
+            return self._bytes
+
+
+thumbnails = ThumbnailCache(config.THUMBNAIL_DIR, config.THUMBNAIL_MEMORY_BYTES, config.THUMBNAIL_DISK_MAX_BYTES)
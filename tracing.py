@@ -0,0 +1,163 @@
+"""Request tracing across the bot, ingest, ffmpeg and the player.
+
+A request gets an id when it enters (new_trace_id), and every stage it
+passes through records a span under that id: what ran, on which thread, and
+for how long. The id travels in a context variable within a task or thread,
+copied into the core executor by core.run_blocking, and on the IngestRequest
+and queue entry ('trace_id') where work hops between long-lived workers or a
+pygame timer event.
+
+Spans go into a fixed-size ring buffer and are exported on demand in the
+Chrome trace event format (`!trace`, then load the file in chrome://tracing
+or https://ui.perfetto.dev). Spans of one request are linked by flow arrows
+across threads, and across processes in the split layout: ids are unique per
+process, a remote control call carries the caller's id, and the exports of
+both processes merge into one timeline (perf_counter is system-wide). When tracing is off, span() hands out one shared no-op
+context manager and new_trace_id() returns None, so a stage pays well under
+a microsecond for being instrumented.
+"""
+import contextvars
+import functools
+import itertools
+import json
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+
+import config
+
+
+current_trace_id = contextvars.ContextVar('current_trace_id', default=None)
+
+
+class _NoSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'trace_id', 'args', 'start', 'token')
+
+    def __init__(self, tracer, name, trace_id, args):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.args = args
+
+    def __enter__(self):
+        self.token = current_trace_id.set(self.trace_id)  # Nested spans and executor calls inherit the id
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        end = time.perf_counter_ns()
+        current_trace_id.reset(self.token)
+        if exc_type is not None:
+            self.args = dict(self.args, error=exc_type.__name__)
+        self.tracer.record(self.name, self.trace_id, self.start, end - self.start, self.args)
+        return False
+
+
+class Tracer:
+    """Ring buffer of finished spans, appended to from any thread without a lock"""
+
+    def __init__(self, capacity, enabled):
+        self.enabled = enabled
+        self._spans = deque(maxlen=capacity)  # (name, trace id, start ns, duration ns, thread id, args)
+        self._thread_names = {}
+        self._ids = itertools.count(1)
+        self._pid = os.getpid()
+
+    def new_trace_id(self):
+        """Return an id for a new request, or None while tracing is off"""
+        return f"{self._pid}-{next(self._ids)}" if self.enabled else None
+
+    def span(self, name, trace_id=None, **args):
+        """Context manager timing a stage of a request, by default the request of the current context"""
+        if not self.enabled:
+            return _NO_SPAN
+        return _Span(self, name, trace_id if trace_id is not None else current_trace_id.get(), args)
+
+    def instant(self, name, trace_id=None, **args):
+        """Record a point in time of a request, such as it being queued"""
+        if self.enabled:
+            self.record(name, trace_id if trace_id is not None else current_trace_id.get(),
+                        time.perf_counter_ns(), None, args)
+
+    def record(self, name, trace_id, start, duration, args):
+        thread_id = threading.get_native_id()
+        if thread_id not in self._thread_names:
+            self._thread_names[thread_id] = threading.current_thread().name
+        self._spans.append((name, trace_id, start, duration, thread_id, args))
+
+    def clear(self):
+        self._spans.clear()
+
+    def __len__(self):
+        return len(self._spans)
+
+    def export(self):
+        """The buffered spans of this process, picklable, for chrome_trace()"""
+        return {'pid': os.getpid(), 'process': multiprocessing.current_process().name,
+                'threads': dict(self._thread_names), 'spans': list(self._spans)}
+
+    def chrome_trace(self):
+        """Return the buffered spans as a Chrome trace event JSON string"""
+        return chrome_trace([self.export()])
+
+
+def chrome_trace(exports):
+    """Merge Tracer.export()s of one or more processes into a Chrome trace event JSON string"""
+    events = []
+    by_request = {}
+    for export in exports:
+        pid = export['pid']
+        events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': export['process']}})
+        events.extend({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': thread_id, 'args': {'name': name}}
+                      for thread_id, name in export['threads'].items())
+        for name, trace_id, start, duration, thread_id, args in export['spans']:
+            event = {'name': name, 'cat': 'request' if trace_id is not None else 'background',
+                     'ts': start / 1000, 'pid': pid, 'tid': thread_id, 'args': dict(args, request=trace_id)}
+            if duration is None:
+                event.update(ph='i', s='t')
+            else:
+                event.update(ph='X', dur=duration / 1000)
+            events.append(event)
+            if trace_id is not None:
+                by_request.setdefault(trace_id, []).append(event)
+
+    # Flow arrows from each stage of a request to the next, across threads and processes
+    for trace_id, request_events in by_request.items():
+        if len(request_events) < 2:
+            continue
+        request_events.sort(key=lambda event: event['ts'])
+        for i, event in enumerate(request_events):
+            phase = 's' if i == 0 else 'f' if i == len(request_events) - 1 else 't'
+            events.append({'name': 'request', 'cat': 'flow', 'ph': phase, 'id': trace_id, 'bp': 'e',
+                           'ts': event['ts'], 'pid': event['pid'], 'tid': event['tid']})
+    return json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'})
+
+
+def traced_request(name):
+    """Decorator for coroutine entry points such as bot commands: each call is a new request, one span long"""
+    def decorate(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with tracer.span(name, trace_id=tracer.new_trace_id()):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+tracer = Tracer(config.TRACE_BUFFER_SPANS, config.TRACING_ENABLED)
+span = tracer.span
+instant = tracer.instant
+new_trace_id = tracer.new_trace_id
@@ -1,16 +1,20 @@
 import pygame
 import sys
 import config
-from audio import get_connected_audio_devices
-from youtube import search_youtube, download_audio_worker
-from player import toggle_play_pause, handle_music_end_event, play_next_song
-from pygame import mixer
-import threading
+from audio import format_time
+from batch import resolve_queries, split_queries
+from core import core
+from library import search_library
+from queue_view import QueueView
+from suggest import suggest
+from thumbnails import thumbnails
+from youtube import search_youtube
 
 
 class MusicPlayerUI:
-    def __init__(self):
-        """Initialize the pygame UI"""
+    def __init__(self, control):
+        """Initialize the pygame UI on a control.LocalControl or control.RemoteControl"""
+        self.control = control
         self.screen = pygame.display.set_mode((config.SCREEN_WIDTH, config.SCREEN_HEIGHT))
         pygame.display.set_caption("Music Player with Discord Integration")
         self.clock = pygame.time.Clock()
@@ -19,110 +23,198 @@ class MusicPlayerUI:
         self.font = pygame.font.Font(None, 32)
         self.small_font = pygame.font.Font(None, 24)
 
-        # Audio device check timing
-        self.last_audio_check = 0
-
         # Initialize result rectangles list
         config.result_rects = []
 
+        # Scrollable queue panel
+        self.queue_view = QueueView(control, config.QUEUE_PANEL, self.small_font, config.QUEUE_ROW_HEIGHT,
+                                    config.QUEUE_ROW_CACHE)
+
+        # Search running on the core loop, checked every frame; results of older searches are dropped
+        self.search_future = None
+
+        # Cached queue size text and the queue version it was rendered for
+        self.queue_text = None
+        self.queue_text_version = None
+
+        # Redraw only when something visible changed: a new state or queue
+        # version, input, or the progress clock ticking over a second
+        self.dirty = True
+        self.last_frame_key = None
+
     def handle_events(self):
         """Handle pygame events"""
 
         for event in pygame.event.get():
+            self.dirty = True
+
             if event.type == pygame.QUIT:
+                core.stop()
                 pygame.quit()
                 sys.exit()
 
+            elif self.queue_view.handle_event(event):
+                pass  # Scrolling, dragging or removing in the queue panel
+
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 self._handle_mouse_click(event)
 
-            elif event.type == config.MUSIC_END:
-                handle_music_end_event()
-
-            elif event.type == config.NEXT_SONG_EVENT:
-                self._handle_next_song_event()
+            elif self.control.handle_player_event(event):
+                pass  # Song end and next song timers, only in the engine process
 
             elif event.type == pygame.KEYDOWN:
                 self._handle_keyboard_input(event)
 
+    def _needs_redraw(self):
+        """Return True if the frame on screen is out of date"""
+        position = int(self.control.get_position()) if self.control.state.currently_playing else None
+        frame_key = (self.control.state_version(), self.control.queue_snapshot().version, position, thumbnails.version)
+        if frame_key != self.last_frame_key:
+            self.last_frame_key = frame_key
+            return True
+        return self.dirty
+
     def _handle_mouse_click(self, event):
         """Handle mouse click events"""
 
-        # Search box click
-        if config.SEARCH_BOX.collidepoint(event.pos):
-            config.search_active = True
-        else:
-            config.search_active = False
+        # Suggestion clicks (drawn over the results, so they win while the search box has focus)
+        if config.search_active:
+            for i, rect in enumerate(config.suggestion_rects):
+                if rect.collidepoint(event.pos) and i < len(config.suggestions):
+                    title, item = config.suggestions[i]
+                    config.search_active = False
+                    self._clear_suggestions()
+                    if item is not None:
+                        self._enqueue_result(item)  # Seen before, no need to search again
+                    else:
+                        config.search_text = title
+                        self._run_search()
+                    return
+
+        # Search box click; the hidden suggestions go with the focus
+        config.search_active = config.SEARCH_BOX.collidepoint(event.pos)
+        if not config.search_active:
+            self._clear_suggestions()
 
         # Search result clicks
         for i, rect in enumerate(config.result_rects):
             if rect.collidepoint(event.pos) and i < len(config.search_results):
-                video_info = config.search_results[i]
-
-                this_song_gets_auto_play_chance = False
-                if not config.is_playing and not mixer.music.get_busy():
-                    with config.auto_play_lock:
-                        if not config.is_auto_play_pending:
-                            config.is_auto_play_pending = True
-                            this_song_gets_auto_play_chance = True
-
-                thread = threading.Thread(
-                    target=download_audio_worker,
-                    args=(video_info, this_song_gets_auto_play_chance)
-                )
-                thread.daemon = True
-                thread.start()
-
-                if this_song_gets_auto_play_chance:
-                    print(f"Pygame: Attempting auto-play with {video_info['title']}")
+                self._enqueue_result(config.search_results[i])
 
         # Play/Pause button
         if config.PLAY_BUTTON.collidepoint(event.pos):
-            toggle_play_pause()
+            self.control.toggle_play_pause()
 
         # Skip button
         if config.SKIP_BUTTON.collidepoint(event.pos):
-            with config.queue_lock:
-                if config.is_playing or mixer.music.get_busy():
-                    mixer.music.stop()
-                    pygame.time.set_timer(config.NEXT_SONG_EVENT, 10)
+            self.control.skip()
+
+        # Progress bar (inflated so the thin bar is easy to hit)
+        if config.PROGRESS_BAR.inflate(0, 12).collidepoint(event.pos):
+            duration = self.control.get_duration()
+            if duration:
+                fraction = (event.pos[0] - config.PROGRESS_BAR.x) / config.PROGRESS_BAR.width
+                self.control.seek(max(0, min(1, fraction)) * duration)
 
         # Volume slider
         if config.VOLUME_SLIDER.collidepoint(event.pos):
-            config.volume_level = (event.pos[0] - config.VOLUME_SLIDER.x) / config.VOLUME_SLIDER.width
-            config.volume_level = max(0, min(1, config.volume_level))
-            mixer.music.set_volume(config.volume_level)
-
-    def _handle_next_song_event(self):
-        """Handle the next song event"""
-        pygame.time.set_timer(config.NEXT_SONG_EVENT, 0)  # Turn off the timer
-
-        print("Playing next song from queue...")
-        if config.queued_songs:
-            print(f"Queue has {len(config.queued_songs)} songs. Next up: {config.queued_songs[0]['title'] if config.queued_songs else 'None'}")
+            volume_level = (event.pos[0] - config.VOLUME_SLIDER.x) / config.VOLUME_SLIDER.width
+            self.control.set_volume(volume_level)
 
-        # Only play next song if we're not already playing something
-        if not config.is_playing and not mixer.music.get_busy():
-            play_next_song()
+    def _enqueue_result(self, video_info):
+        """Queue a search result or suggestion, downloading it unless it is a local track"""
+        got_auto_play_chance = self.control.enqueue(video_info)
+        if got_auto_play_chance is None:
+            print(f"Pygame: Queue limit of {config.MAX_QUEUED_PER_USER} songs reached")
+        elif got_auto_play_chance:
+            print(f"Pygame: Attempting auto-play with {video_info['title']}")
 
     def _handle_keyboard_input(self, event):
         """Handle keyboard input events"""
         if config.search_active:
             if event.key == pygame.K_RETURN:
-                config.search_results = search_youtube(config.search_text)
-                config.result_rects = [pygame.Rect(50, 100 + i*40, 500, 32)
-                              for i in range(len(config.search_results))]
+                self._clear_suggestions()
+                self._run_search()
+            elif event.key == pygame.K_TAB:
+                # Accept the top suggestion
+                if config.suggestions:
+                    config.search_text = config.suggestions[0][0]
+                    self._update_suggestions()
+            elif event.key == pygame.K_v and event.mod & (pygame.KMOD_CTRL | pygame.KMOD_META):
+                self._paste()
             elif event.key == pygame.K_BACKSPACE:
                 config.search_text = config.search_text[:-1]
+                self._update_suggestions()
             else:
                 config.search_text += event.unicode
-
-    def update_audio_devices(self):
-        """Periodically update audio device information"""
-        current_time = pygame.time.get_ticks()
-        if current_time - self.last_audio_check > config.AUDIO_CHECK_INTERVAL:
-            config.connected_audio_device = get_connected_audio_devices()
-            self.last_audio_check = current_time
+                self._update_suggestions()
+
+    def _paste(self):
+        """Paste into the search box; a pasted list of songs is queued as a batch"""
+        text = self._clipboard_text()
+        queries = split_queries(text)
+        if len(queries) > 1:
+            config.search_text = ""
+            self._clear_suggestions()
+            core.submit(self._play_batch(queries))
+        elif queries:
+            config.search_text += queries[0]
+            self._update_suggestions()
+
+    def _clipboard_text(self):
+        try:
+            if not pygame.scrap.get_init():
+                pygame.scrap.init()
+            data = pygame.scrap.get(pygame.SCRAP_TEXT)
+        except pygame.error as e:
+            print(f"Pygame: Could not read the clipboard: {e}")
+            return ""
+        return data.decode('utf-8', errors='ignore').replace('\x00', '') if data else ""
+
+    async def _play_batch(self, queries):
+        """Search and queue a pasted list of songs, on the core loop"""
+        print(f"Pygame: Queueing {len(queries)} pasted songs")
+        items = await resolve_queries(queries)
+        items = await core.run_blocking(self.control.enqueue_batch, items)
+        for item in items:
+            if item.error:
+                print(f"Pygame: Not queued '{item.query}': {item.error}")
+        print(f"Pygame: Queued {sum(1 for item in items if item.error is None)} of {len(items)} pasted songs")
+
+    def _run_search(self):
+        """Search for config.search_text on the core loop; the result rows appear once it finishes"""
+        self.search_future = core.submit(self._search(config.search_text))
+
+    async def _search(self, query):
+        # Local library hits come back in milliseconds, only go to YouTube without them
+        return search_library(query) or await core.run_blocking(search_youtube, query)
+
+    def _show_search_results(self):
+        """Lay out the result rows once the search has finished, checked every frame"""
+        # Applied on the pygame thread, which also handles the clicks, rather than on the core
+        # loop: a click never sees the rects of one search with the results of another
+        future = self.search_future
+        if future is None or not future.done():
+            return
+        self.search_future = None
+        try:
+            results = future.result()
+        except Exception as e:
+            print(f"Pygame: Search failed: {e}")
+            results = []
+        config.result_rects = [pygame.Rect(50, 100 + i*40, 500, 32) for i in range(len(results))]
+        config.search_results = results
+        self.dirty = True
+
+    def _update_suggestions(self):
+        """Refresh the as-you-type suggestions, bounded by the index's time budget"""
+        config.suggestions = suggest(config.search_text, config.SUGGEST_LIMIT)
+        config.suggestion_rects = [pygame.Rect(config.SEARCH_BOX.x, config.SEARCH_BOX.bottom + i*24, config.SEARCH_BOX.width, 24)
+                                   for i in range(len(config.suggestions))]
+
+    def _clear_suggestions(self):
+        config.suggestions = []
+        config.suggestion_rects = []
 
     def draw(self):
         """Draw all UI elements"""
@@ -131,10 +223,13 @@ class MusicPlayerUI:
         self._draw_search_box()
         self._draw_search_results()
         self._draw_playback_controls()
+        self._draw_progress_bar()
         self._draw_volume_slider()
         self._draw_audio_status()
         self._draw_song_info()
+        self.queue_view.draw(self.screen)
         self._draw_discord_status()
+        self._draw_suggestions()
 
         pygame.display.update()
 
@@ -148,16 +243,29 @@ class MusicPlayerUI:
     def _draw_search_results(self):
         """Draw the search results list"""
         for i, result in enumerate(config.search_results):
-            result_surface = self.font.render(result['title'][:50], True, config.WHITE)
-            self.screen.blit(result_surface, (50, 100 + i*40))
+            # A placeholder until the thumbnail has loaded, drawing never waits for it
+            self.screen.blit(thumbnails.get(result, config.RESULT_THUMBNAIL_SIZE), (50, 100 + i*40))
+            result_surface = self.font.render(result['title'][:44], True, config.WHITE)
+            self.screen.blit(result_surface, (50 + config.RESULT_THUMBNAIL_SIZE[0] + 6, 100 + i*40))
             if i < len(config.result_rects):
                 pygame.draw.rect(self.screen, config.GRAY, config.result_rects[i], 1)
 
+    def _draw_suggestions(self):
+        """Draw the suggestion dropdown under the search box"""
+        if not config.search_active:
+            return
+        for (title, item), rect in zip(config.suggestions, config.suggestion_rects):
+            pygame.draw.rect(self.screen, config.BLACK, rect)
+            pygame.draw.rect(self.screen, config.GRAY, rect, 1)
+            marker = "▶ " if item is not None else ""
+            suggestion_surface = self.small_font.render(f"{marker}{title}"[:60], True, config.WHITE)
+            self.screen.blit(suggestion_surface, (rect.x + 5, rect.y + 4))
+
     def _draw_playback_controls(self):
         """Draw play/pause and skip buttons"""
         # Play/Pause button
-        pygame.draw.rect(self.screen, config.GREEN if config.is_playing else config.WHITE, config.PLAY_BUTTON)
-        play_text = self.font.render("⏸" if config.is_playing else "▶", True, config.BLACK)
+        pygame.draw.rect(self.screen, config.GREEN if self.control.state.is_playing else config.WHITE, config.PLAY_BUTTON)
+        play_text = self.font.render("⏸" if self.control.state.is_playing else "▶", True, config.BLACK)
         self.screen.blit(play_text, (config.PLAY_BUTTON.centerx - 10, config.PLAY_BUTTON.centery - 10))
 
         # Skip button
@@ -165,44 +273,73 @@ class MusicPlayerUI:
         skip_text = self.font.render("⏭", True, config.BLACK)
         self.screen.blit(skip_text, (config.SKIP_BUTTON.centerx - 10, config.SKIP_BUTTON.centery - 10))
 
+    def _draw_progress_bar(self):
+        """Draw the seekable progress bar with elapsed/total time"""
+        duration = self.control.get_duration()
+        if not self.control.state.currently_playing or not duration:
+            return
+
+        position = min(self.control.get_position(), duration)
+        bar = config.PROGRESS_BAR
+        pygame.draw.rect(self.screen, config.GRAY, bar)
+        filled = bar.copy()
+        filled.width = int(bar.width * position / duration)
+        pygame.draw.rect(self.screen, config.GREEN, filled)
+
+        time_text = self.small_font.render(f"{format_time(position)} / {format_time(duration)}", True, config.WHITE)
+        self.screen.blit(time_text, (bar.right + 10, bar.centery - time_text.get_height() // 2))
+
     def _draw_volume_slider(self):
         """Draw the volume control slider"""
         pygame.draw.rect(self.screen, config.GRAY, config.VOLUME_SLIDER)
-        volume_pos = config.VOLUME_SLIDER.x + (config.VOLUME_SLIDER.width * config.volume_level)
+        volume_pos = config.VOLUME_SLIDER.x + (config.VOLUME_SLIDER.width * self.control.state.volume_level)
         pygame.draw.circle(self.screen, config.WHITE, (int(volume_pos), config.VOLUME_SLIDER.centery), 8)
 
     def _draw_audio_status(self):
         """Draw audio device status"""
-        audio_status_surface = self.small_font.render(config.connected_audio_device, True, config.WHITE)
+        audio_status_surface = self.small_font.render(self.control.state.connected_audio_device, True, config.WHITE)
         self.screen.blit(audio_status_surface, (config.VOLUME_SLIDER.x, config.VOLUME_SLIDER.y - 25))
 
     def _draw_song_info(self):
         """Draw current song and queue information"""
         # Current song
-        if config.currently_playing:
-            current_text = self.small_font.render(f"Now Playing: {config.currently_playing['title'][:40]}", True, config.WHITE)
+        if self.control.state.currently_playing:
+            thumbnail = thumbnails.get(self.control.state.currently_playing, config.NOW_PLAYING_THUMBNAIL.size)
+            self.screen.blit(thumbnail, config.NOW_PLAYING_THUMBNAIL)
+            current_text = self.small_font.render(f"Now Playing: {self.control.state.currently_playing['title'][:40]}", True, config.WHITE)
             self.screen.blit(current_text, (50, 450))
 
-        # Queue size
-        queue_size = len(config.queued_songs)
-        queue_text = self.small_font.render(f"Queue: {queue_size} song{'s' if queue_size != 1 else ''}", True, config.WHITE)
-        self.screen.blit(queue_text, (50, 475))
+        # Queue size, re-rendered only when a new queue version is published
+        snapshot = self.control.queue_snapshot()
+        if snapshot.version != self.queue_text_version:
+            queue_size = len(snapshot.songs)
+            queue_label = f"Queue: {queue_size} song{'s' if queue_size != 1 else ''}"
+            pending = self.control.pending_count(snapshot)
+            if pending:
+                queue_label += f" ({pending} downloading)"
+            self.queue_text = self.small_font.render(queue_label, True, config.WHITE)
+            self.queue_text_version = snapshot.version
+        self.screen.blit(self.queue_text, (50, 475))
 
     def _draw_discord_status(self):
         """Draw Discord bot status and last command"""
         # Discord status
-        bot_status = self.small_font.render(config.discord_status, True, config.WHITE)
+        bot_status = self.small_font.render(self.control.state.discord_status, True, config.WHITE)
         self.screen.blit(bot_status, (50, 550))
 
         # Last Discord command
-        if config.discord_last_command:
-            cmd_text = self.small_font.render(f"Last command: {config.discord_last_command}", True, config.WHITE)
+        if self.control.state.discord_last_command:
+            cmd_text = self.small_font.render(f"Last command: {self.control.state.discord_last_command}", True, config.WHITE)
             self.screen.blit(cmd_text, (50, 575))
 
     def run(self):
         """Main UI loop"""
         while True:
             self.handle_events()
-            self.update_audio_devices()
-            self.draw()
+            self._show_search_results()
+            self.control.poll()
+            if self._needs_redraw():
+                # Clear before drawing so a change made mid-draw triggers another frame
+                self.dirty = False
+                self.draw()
             self.clock.tick(60)
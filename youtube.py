@@ -1,91 +1,70 @@
-import yt_dlp
 import os
+import time
 
-import pygame
 from audio import sanitize_filename
 import config
-from pygame import mixer
+from formats import choose_target_kbps, fetch_stats, format_selector, largest_audio_bytes
+from suggest import remember
+from tracing import span
+from ytdl_pool import download_pool, search_pool
 
 
 def search_youtube(query):
     """Search YouTube for videos matching the query"""
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'quiet': True,
-        'no_warnings': True,
-        'extract_flat': True,
-        'cookiefile': 'cookies.txt',  # Use the cookies.txt file
-    }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+    with span('ytdl.search'), search_pool.session() as ydl:
         results = ydl.extract_info(f"ytsearch5:{query}", download=False)
-        return results.get('entries', [])
-
-
-def download_audio_worker(video_info, has_auto_play_chance):
-    """Download audio from YouTube video and add to queue"""
+        entries = results.get('entries', [])
 
-    # Create sanitized filename based on title
-    original_title = video_info['title']
-    sanitized_title = sanitize_filename(original_title)
-    song_path = f"{config.DOWNLOADS_DIR}/{sanitized_title}.mp3"
-
-    # Use consistent quiet and no_warnings options
-    ydl_opts = {
-        'format': 'bestaudio/best',
-        'postprocessors': [{
-            'key': 'FFmpegExtractAudio',
-            'preferredcodec': 'mp3',
-            'preferredquality': '192',
-        }],
-        'outtmpl': f'{config.DOWNLOADS_DIR}/{sanitized_title}.%(ext)s',
-        'quiet': True,
-        'no_warnings': True,
-        'cookiefile': 'cookies.txt',  # Use the cookies.txt file
-    }
+    for entry in entries:
+        remember(entry['title'], entry)
+    return entries
 
-    download_succeeded = False
-    downloaded_song_info = None
 
-    try:
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([video_info['url']])
+def song_path_for(video_info):
+    """Return the final mp3 path a video will be stored at"""
+    sanitized_title = sanitize_filename(video_info['title'])
+    return f"{config.DOWNLOADS_DIR}/{sanitized_title}.mp3"
 
-        # Verify file exists after download
-        if os.path.exists(song_path):
-            downloaded_song_info = {'title': original_title, 'path': song_path}
 
-            # Thread-safe queue modifications with lock
-            with config.queue_lock:
-                config.queued_songs.append(downloaded_song_info)
-                config.downloaded_songs.append(downloaded_song_info)
-                download_succeeded = True
-                print(f"Added to queue: {original_title}")
-                print(f"Queue now has {len(config.queued_songs)} songs")
-        else:
-            print(f"Error: File not found after download: {song_path}")
-            download_succeeded = False
+def fetch_audio(video_info, directory=None, extra_opts=None, queue_depth=0, target_kbps=None):
+    """Download an audio stream as-is and return (fetched path, format details).
 
-    except yt_dlp.utils.DownloadError as de:
-        print(f"yt-dlp DownloadError for '{original_title}': {de}")
-    except Exception as e:
-        print(f"Error downloading '{original_title}': {e}")
+    The stream is picked by the bitrate policy in formats.py, stepping down
+    a tier when `queue_depth` downloads are waiting or the network is slow,
+    unless `target_kbps` pins the tier.
+    No post-processing happens here; the transcode stage of the ingest
+    pipeline turns the fetched file into an mp3. `extra_opts` override the
+    pooled session's yt-dlp options for this call (e.g. a rate limit or
+    progress hooks).
+    """
+    sanitized_title = sanitize_filename(video_info['title'])
+    target_kbps = target_kbps or choose_target_kbps(queue_depth)
 
-    if not download_succeeded:
-        if has_auto_play_chance:
-            with config.auto_play_lock:
-                config.is_auto_play_pending = False
-        return
-
-    # Download succeeded and song is queued
-    if has_auto_play_chance:
-        should_actually_play_now = False
-        with config.auto_play_lock:
-            if config.is_auto_play_pending and not config.is_playing and not mixer.music.get_busy():
-                with config.queue_lock:
-                    if config.queued_songs and downloaded_song_info and config.queued_songs[0]['path'] == downloaded_song_info['path']:
-                        should_actually_play_now = True
-
-            config.is_auto_play_pending = False
-
-        if should_actually_play_now:
-            pygame.time.set_timer(config.NEXT_SONG_EVENT, 10)  # Schedule play_next_song instead of calling directly
+    ydl_opts = {
+        'format': format_selector(target_kbps),
+        'outtmpl': f'{directory or config.DOWNLOADS_DIR}/{sanitized_title}.src.%(ext)s',
+    }
+    ydl_opts.update(extra_opts or {})
+
+    started = time.monotonic()
+    with span('ytdl.download', url=video_info['url']), download_pool.session(**ydl_opts) as ydl:
+        info = ydl.extract_info(video_info['url'], download=True)
+        downloads = info.get('requested_downloads') or []
+        fetched_path = downloads[0]['filepath'] if downloads else ydl.prepare_filename(info)
+
+    if not os.path.exists(fetched_path):
+        raise FileNotFoundError(f"File not found after download: {fetched_path}")
+
+    bytes_fetched = os.path.getsize(fetched_path)
+    fetch_stats.record(bytes_fetched, largest_audio_bytes(info.get('formats') or [], info.get('duration')),
+                       time.monotonic() - started)
+    format_info = {
+        'format_id': info.get('format_id'),
+        'acodec': info.get('acodec'),
+        'abr': info.get('abr'),
+        'target_kbps': target_kbps,
+        'bytes_fetched': bytes_fetched,
+    }
+    print(f"Fetched '{video_info['title']}' as format {format_info['format_id']} "
+          f"({format_info['acodec']}, {format_info['abr']} kbps, {bytes_fetched / 1024:.0f} KiB)")
+    return fetched_path, format_info
@@ -0,0 +1,179 @@
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+import yt_dlp
+
+import config
+
+
+_MISSING = object()
+
+
+class YoutubeDLSession:
+    """A long-lived YoutubeDL plus the per-checkout settings it dispatches to.
+
+    The format selector and progress hooks are set per checkout. The
+    YoutubeDL instance always holds callables that forward to them, so a
+    checkout never has to rebuild the instance. Everything else a caller
+    overrides is written to the instance's params and restored afterwards.
+    """
+
+    def __init__(self, params):
+        params = dict(params)
+        default_format = params.pop('format', 'bestaudio/best')
+        params['format'] = self._select_format
+        params['progress_hooks'] = [self._progress]
+        self.format = None
+        self.progress_hooks = []
+        self.ydl = yt_dlp.YoutubeDL(params)
+        self._default_format = self.ydl.build_format_selector(default_format)
+        self.cookie_mtime = _mtime(params.get('cookiefile'))
+        self.ydl.cookiejar  # Load cookies now so it counts as setup, not as the first call
+
+    def _select_format(self, ctx):
+        yield from (self.format or self._default_format)(ctx)
+
+    def _progress(self, progress):
+        for hook in self.progress_hooks:
+            hook(progress)
+
+    def apply(self, overrides):
+        """Apply per-call options and return what is needed to undo them"""
+        saved = {}
+        for key, value in overrides.items():
+            if key == 'format':
+                self.format = value
+            elif key == 'progress_hooks':
+                self.progress_hooks = list(value)
+            elif key == 'outtmpl':
+                saved[key] = self.ydl.params[key]
+                self.ydl.params[key] = dict(self.ydl.params[key], default=value)
+            else:
+                saved[key] = self.ydl.params.get(key, _MISSING)
+                self.ydl.params[key] = value
+        return saved
+
+    def reset(self, saved):
+        self.format = None
+        self.progress_hooks = []
+        for key, value in saved.items():
+            if value is _MISSING:
+                self.ydl.params.pop(key, None)
+            else:
+                self.ydl.params[key] = value
+
+    def reload_cookies_if_changed(self):
+        """Reload the cookie file into the existing jar if it changed on disk"""
+        cookie_file = self.ydl.params.get('cookiefile')
+        mtime = _mtime(cookie_file)
+        if mtime == self.cookie_mtime:
+            return False
+        jar = self.ydl.cookiejar
+        jar.clear()
+        if mtime is not None:
+            jar.load()
+        self.cookie_mtime = mtime
+        return True
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns if path else None
+    except OSError:
+        return None
+
+
+class YoutubeDLPool:
+    """A fixed number of reusable YoutubeDL sessions sharing one configuration.
+
+    A YoutubeDL instance is not thread safe, so each session is checked out
+    by one caller at a time. Sessions are created lazily up to `size`;
+    when all of them are busy, callers wait for one to be returned.
+    Building a session loads cookies and sets up the extractors, so that
+    cost is paid once per session instead of once per call.
+    """
+
+    def __init__(self, name, params, size):
+        self.name = name
+        self.params = params
+        self.size = size
+        self._idle = queue.LifoQueue()  # Most recently used first, its connections are warmest
+        self._lock = threading.Lock()
+        self.created = 0
+        self.build_seconds = 0.0
+        self.checkouts = 0
+        self.checkout_seconds = 0.0  # Per-call setup of a reused session (cookie check, overrides)
+        self.cookie_reloads = 0
+
+    @contextmanager
+    def session(self, **overrides):
+        """Check out a YoutubeDL with per-call `overrides` of its params"""
+        session = self._acquire()
+        started = time.monotonic()
+        if session.reload_cookies_if_changed():
+            with self._lock:
+                self.cookie_reloads += 1
+            print(f"Reloaded cookies for a {self.name} yt-dlp session")
+        saved = session.apply(overrides)
+        with self._lock:
+            self.checkouts += 1
+            self.checkout_seconds += time.monotonic() - started
+        try:
+            yield session.ydl
+        finally:
+            session.reset(saved)
+            self._idle.put(session)
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            can_create = self.created < self.size
+            if can_create:
+                self.created += 1
+        if not can_create:
+            return self._idle.get()
+
+        started = time.monotonic()
+        try:
+            session = YoutubeDLSession(self.params)
+        except Exception:
+            with self._lock:
+                self.created -= 1
+            raise
+        with self._lock:
+            self.build_seconds += time.monotonic() - started
+        return session
+
+    def average_build_ms(self):
+        return 1000 * self.build_seconds / self.created if self.created else 0.0
+
+    def average_checkout_ms(self):
+        return 1000 * self.checkout_seconds / self.checkouts if self.checkouts else 0.0
+
+    def stats(self):
+        """The pool's counters as plain values, for !stats in another process"""
+        return SimpleNamespace(name=self.name, created=self.created, size=self.size,
+                               average_build_ms=self.average_build_ms(), checkouts=self.checkouts,
+                               average_checkout_ms=self.average_checkout_ms())
+
+
+search_pool = YoutubeDLPool('search', {
+    'format': 'bestaudio/best',
+    'quiet': True,
+    'no_warnings': True,
+    'extract_flat': True,
+    'cookiefile': config.COOKIE_FILE,
+}, config.YTDL_SEARCH_SESSIONS)
+
+download_pool = YoutubeDLPool('download', {
+    'quiet': True,
+    'no_warnings': True,
+    'cookiefile': config.COOKIE_FILE,
+}, config.YTDL_DOWNLOAD_SESSIONS)